@@ -0,0 +1,97 @@
+# admission.py
+"""
+Admission control for /api/ws handshakes.
+
+A surge of connections (a deploy, a reconnect storm after a network blip) can
+push a worker past its file descriptor and memory budget. Every handshake with
+a valid session goes through admit() before it is registered; it is refused when
+- the worker already holds WS_MAX_SOCKETS sockets,
+- the user already has WS_MAX_SOCKETS_PER_USER sockets on this worker, or
+- handshakes arrive faster than WS_ACCEPT_RATE per second (WS_ACCEPT_BURST at once).
+
+A refused socket is closed with 1013 (Try Again Later) and a reason like
+"Server busy, retry in 3.7s". The delay is randomised (WS_ADMISSION_RETRY_AFTER
+seconds, +-50%) so that clients refused together don't all come back together.
+
+Any cap set to 0 is disabled.
+"""
+import logging
+import os
+import random
+import time
+from typing import Optional
+
+from fastapi import WebSocket
+
+from connection_manager import CLOSE_TRY_AGAIN_LATER, ConnectionManager
+from rate_limit import TokenBucket
+
+logger = logging.getLogger("websocket")
+
+# Sockets per worker process
+WS_MAX_SOCKETS = int(os.getenv("WS_MAX_SOCKETS", "10000"))
+# Sockets per user on one worker (tabs and devices)
+WS_MAX_SOCKETS_PER_USER = int(os.getenv("WS_MAX_SOCKETS_PER_USER", "10"))
+# Handshakes admitted per second, and how many may arrive at once
+WS_ACCEPT_RATE = float(os.getenv("WS_ACCEPT_RATE", "100"))
+WS_ACCEPT_BURST = float(os.getenv("WS_ACCEPT_BURST", "200"))
+# Mean delay (seconds) a refused client is asked to wait before retrying
+WS_ADMISSION_RETRY_AFTER = float(os.getenv("WS_ADMISSION_RETRY_AFTER", "5"))
+
+
+class AdmissionController:
+    """Decides whether this worker takes another socket, and counts refusals."""
+
+    def __init__(self, manager: ConnectionManager, max_sockets: int = WS_MAX_SOCKETS,
+                 max_per_user: int = WS_MAX_SOCKETS_PER_USER, accept_rate: float = WS_ACCEPT_RATE,
+                 accept_burst: float = WS_ACCEPT_BURST, retry_after: float = WS_ADMISSION_RETRY_AFTER):
+        self.manager = manager
+        self.max_sockets = max_sockets
+        self.max_per_user = max_per_user
+        self.accepts = TokenBucket(accept_rate, max(accept_burst, 1)) if accept_rate > 0 else None
+        self.retry_after = retry_after
+        self.stats = {"admitted": 0, "rejected": 0}
+        # Dict[reason, count]
+        self.rejected_by_reason = {"max_sockets": 0, "max_per_user": 0, "accept_rate": 0}
+
+    def admit(self, user_id: int) -> Optional[str]:
+        """Returns None if the socket may be registered, else why it is refused."""
+        reason = None
+        if self.max_sockets and len(self.manager.outboxes) >= self.max_sockets:
+            reason = "max_sockets"
+        elif self.max_per_user and len(self.manager.user_connections.get(user_id, ())) >= self.max_per_user:
+            reason = "max_per_user"
+        elif self.accepts is not None and self.accepts.take(time.monotonic()):
+            reason = "accept_rate"
+
+        if reason is None:
+            self.stats["admitted"] += 1
+        else:
+            self.stats["rejected"] += 1
+            self.rejected_by_reason[reason] += 1
+        return reason
+
+    def jittered_retry_after(self) -> float:
+        return round(self.retry_after * random.uniform(0.5, 1.5), 1)
+
+    async def reject(self, websocket: WebSocket, reason: str):
+        """Close an accepted socket that admit() refused."""
+        retry_after = self.jittered_retry_after()
+        logger.warning(f"WebSocket refused ({reason}), client asked to retry in {retry_after}s")
+        try:
+            await websocket.close(code=CLOSE_TRY_AGAIN_LATER, reason=f"Server busy, retry in {retry_after}s")
+        except Exception:
+            pass
+
+    def get_stats(self) -> dict:
+        sockets = len(self.manager.outboxes)
+        return {
+            "sockets": sockets,
+            "max_sockets": self.max_sockets,
+            "utilisation": round(sockets / self.max_sockets, 3) if self.max_sockets else None,
+            "users": len(self.manager.user_connections),
+            "max_sockets_per_user": self.max_per_user,
+            "accept_rate": self.accepts.rate if self.accepts is not None else None,
+            **self.stats,
+            "rejected_by_reason": dict(self.rejected_by_reason),
+        }
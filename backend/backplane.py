@@ -0,0 +1,335 @@
+# backplane.py
+"""
+Pub/sub backplanes that let several backend workers share WebSocket fan-out.
+
+Every worker subscribes to the same channels; a payload published by one
+worker is delivered to all subscribed workers (the publisher included), and
+each worker then delivers it to the sockets it holds locally.
+
+Select one with WS_BACKPLANE_URL:
+- memory://                  single process (default)
+- sqlite:///path/to/file.db  workers on one machine, no outside service
+- redis://host:6379          any Redis-protocol server (Redis, Valkey, KeyDB, ...)
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Iterable, List, Optional, Set
+from urllib.parse import urlparse, unquote
+
+logger = logging.getLogger("backplane")
+
+WS_BACKPLANE_URL = os.getenv("WS_BACKPLANE_URL", "memory://")
+
+# Called with (channel, payload) for every message received from the backplane
+Handler = Callable[[str, dict], Awaitable[None]]
+
+
+class Backplane(ABC):
+    """Base class for backplane implementations."""
+
+    def __init__(self):
+        self._handler: Optional[Handler] = None
+        self._channels: Set[str] = set()
+
+    async def start(self, handler: Handler, channels: Iterable[str]):
+        self._handler = handler
+        self._channels = set(channels)
+
+    async def subscribe(self, channels: Iterable[str]):
+        """Start receiving additional channels."""
+        self._channels.update(channels)
+
+    @abstractmethod
+    async def publish(self, channel: str, payload: dict):
+        """Deliver payload to every worker subscribed to channel."""
+
+    async def stop(self):
+        self._handler = None
+
+    async def _dispatch(self, channel: str, payload: dict):
+        if self._handler is None or channel not in self._channels:
+            return
+        try:
+            await self._handler(channel, payload)
+        except Exception as e:
+            logger.error(f"Backplane handler failed for channel {channel}: {e}", exc_info=True)
+
+    @staticmethod
+    def _decode(channel: str, data) -> Optional[dict]:
+        """Parse a received payload; a malformed one is logged and skipped (None)."""
+        try:
+            return json.loads(data)
+        except ValueError as e:
+            logger.error(f"Dropping malformed backplane payload on channel {channel}: {e}")
+            return None
+
+
+# -------------------------------
+# IN-PROCESS
+# -------------------------------
+class InProcessHub:
+    """Shared by InProcessBackplane instances that should see each other's messages."""
+
+    def __init__(self):
+        self.subscribers: List["InProcessBackplane"] = []
+
+
+class InProcessBackplane(Backplane):
+    """Delivers within the current process only (several managers can share a hub, e.g. in tests)."""
+
+    def __init__(self, hub: Optional[InProcessHub] = None):
+        super().__init__()
+        self.hub = hub if hub is not None else InProcessHub()
+
+    async def start(self, handler: Handler, channels: Iterable[str]):
+        await super().start(handler, channels)
+        self.hub.subscribers.append(self)
+
+    async def publish(self, channel: str, payload: dict):
+        for subscriber in list(self.hub.subscribers):
+            await subscriber._dispatch(channel, payload)
+
+    async def stop(self):
+        if self in self.hub.subscribers:
+            self.hub.subscribers.remove(self)
+        await super().stop()
+
+
+# -------------------------------
+# SQLITE (shared file, polled)
+# -------------------------------
+class SQLiteBackplane(Backplane):
+    """
+    Append-only event table in a SQLite file shared by all workers on a machine.
+    Each worker polls for rows newer than the last one it has seen; old rows are
+    pruned after `retention` seconds. WAL mode keeps readers and the writer from
+    blocking each other.
+    """
+
+    def __init__(self, path: str, poll_interval: float = 0.02, retention: float = 60.0):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        # sqlite3 connections are used from a single dedicated thread
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._last_id = 0
+        self._last_prune = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS backplane_events ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "channel TEXT NOT NULL, "
+            "payload TEXT NOT NULL, "
+            "created_at REAL NOT NULL)"
+        )
+        self._conn = conn
+        # Only deliver events published after this worker started
+        row = conn.execute("SELECT MAX(id) FROM backplane_events").fetchone()
+        self._last_id = row[0] or 0
+
+    def _insert(self, channel: str, data: str):
+        self._conn.execute(
+            "INSERT INTO backplane_events (channel, payload, created_at) VALUES (?, ?, ?)",
+            (channel, data, time.time())
+        )
+
+    def _fetch(self) -> list:
+        rows = self._conn.execute(
+            "SELECT id, channel, payload FROM backplane_events WHERE id > ? ORDER BY id LIMIT 500",
+            (self._last_id,)
+        ).fetchall()
+        now = time.time()
+        if now - self._last_prune > self.retention / 4:
+            self._last_prune = now
+            self._conn.execute("DELETE FROM backplane_events WHERE created_at < ?", (now - self.retention,))
+        return rows
+
+    async def start(self, handler: Handler, channels: Iterable[str]):
+        await super().start(handler, channels)
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backplane")
+        await self._run(self._open)
+        self._task = asyncio.create_task(self._poll())
+
+    async def publish(self, channel: str, payload: dict):
+        await self._run(self._insert, channel, json.dumps(payload))
+
+    async def _poll(self):
+        while True:
+            try:
+                rows = await self._run(self._fetch)
+            except Exception as e:
+                logger.warning(f"SQLite backplane poll failed: {e}")
+                rows = []
+            for row_id, channel, data in rows:
+                self._last_id = row_id
+                payload = self._decode(channel, data)
+                if payload is not None:
+                    await self._dispatch(channel, payload)
+            if not rows:
+                await asyncio.sleep(self.poll_interval)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        if self._conn is not None:
+            await self._run(self._conn.close)
+            self._conn = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+        await super().stop()
+
+
+# -------------------------------
+# REDIS PROTOCOL (RESP2)
+# -------------------------------
+def _encode_command(*args) -> bytes:
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode()
+        parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(parts)
+
+
+async def _read_reply(reader: asyncio.StreamReader):
+    line = await reader.readuntil(b"\r\n")
+    kind, rest = line[:1], line[1:-2]
+    if kind == b"+":
+        return rest
+    if kind == b"-":
+        raise ConnectionError(f"Redis error: {rest.decode(errors='replace')}")
+    if kind == b":":
+        return int(rest)
+    if kind == b"$":
+        length = int(rest)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if kind == b"*":
+        count = int(rest)
+        if count < 0:
+            return None
+        return [await _read_reply(reader) for _ in range(count)]
+    raise ConnectionError(f"Unexpected Redis reply: {line!r}")
+
+
+class RedisBackplane(Backplane):
+    """
+    PUBLISH/SUBSCRIBE over any Redis-protocol server, spoken directly over asyncio
+    streams (no client library needed). Uses one connection for publishing and one
+    for the subscription; both reconnect with backoff if the server goes away.
+    """
+
+    def __init__(self, url: str, prefix: str = "wazzap:"):
+        super().__init__()
+        parsed = urlparse(url)
+        self.host = parsed.hostname or "localhost"
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.prefix = prefix
+        self._pub: Optional[tuple] = None
+        self._pub_lock = asyncio.Lock()
+        self._sub_writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def _connect(self) -> tuple:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        if self.password:
+            auth = ("AUTH", self.username, self.password) if self.username else ("AUTH", self.password)
+            writer.write(_encode_command(*auth))
+            await writer.drain()
+            await _read_reply(reader)
+        return reader, writer
+
+    async def start(self, handler: Handler, channels: Iterable[str]):
+        await super().start(handler, channels)
+        self._task = asyncio.create_task(self._listen())
+
+    async def subscribe(self, channels: Iterable[str]):
+        new = set(channels) - self._channels
+        await super().subscribe(new)
+        if new and self._sub_writer is not None:
+            self._sub_writer.write(_encode_command("SUBSCRIBE", *(self.prefix + c for c in new)))
+            await self._sub_writer.drain()
+
+    async def publish(self, channel: str, payload: dict):
+        command = _encode_command("PUBLISH", self.prefix + channel, json.dumps(payload))
+        async with self._pub_lock:
+            for attempt in range(2):
+                try:
+                    if self._pub is None:
+                        self._pub = await self._connect()
+                    reader, writer = self._pub
+                    writer.write(command)
+                    await writer.drain()
+                    await _read_reply(reader)
+                    return
+                except (OSError, ConnectionError, asyncio.IncompleteReadError):
+                    self._pub = None
+                    if attempt:
+                        raise
+
+    async def _listen(self):
+        backoff = 0.1
+        while True:
+            try:
+                reader, writer = await self._connect()
+                self._sub_writer = writer
+                writer.write(_encode_command("SUBSCRIBE", *(self.prefix + c for c in self._channels)))
+                await writer.drain()
+                backoff = 0.1
+                while True:
+                    reply = await _read_reply(reader)
+                    if isinstance(reply, list) and reply and reply[0] == b"message":
+                        channel = reply[1].decode(errors="replace")[len(self.prefix):]
+                        payload = self._decode(channel, reply[2])
+                        if payload is not None:
+                            await self._dispatch(channel, payload)
+            except asyncio.CancelledError:
+                raise
+            except (OSError, ConnectionError, asyncio.IncompleteReadError) as e:
+                self._sub_writer = None
+                logger.warning(f"Redis backplane subscription lost ({e}), retrying in {backoff:.1f}s")
+                await asyncio.sleep(backoff)
+                backoff = min(backoff * 2, 5.0)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for writer in (self._sub_writer, self._pub[1] if self._pub else None):
+            if writer is not None:
+                writer.close()
+        self._sub_writer = None
+        self._pub = None
+        await super().stop()
+
+
+def create_backplane(url: str = WS_BACKPLANE_URL) -> Backplane:
+    """Build the backplane selected by a WS_BACKPLANE_URL-style URL."""
+    if url.startswith("memory://"):
+        return InProcessBackplane()
+    if url.startswith("sqlite:///"):
+        return SQLiteBackplane(url[len("sqlite:///"):])
+    if url.startswith("redis://"):
+        return RedisBackplane(url)
+    raise ValueError(f"Unsupported WS_BACKPLANE_URL: {url}")
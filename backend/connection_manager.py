@@ -1,216 +1,664 @@
 # connection_manager.py
+import asyncio
+import json
+import logging
+import os
+import secrets
+import socket
+from collections import deque
+from dataclasses import dataclass, field
 from fastapi import WebSocket
-from typing import Dict, List, Set, Optional, Callable
+from typing import Deque, Dict, List, Set, Optional, Callable, Hashable
+from starlette.concurrency import run_in_threadpool
 from starlette.websockets import WebSocketState
+from backplane import Backplane
+from event_log import EventLog, is_durable
+from wire import JSON_CODEC, JsonCodec
+
+logger = logging.getLogger("websocket")
+
+# Seconds a single send_text may take before the recipient is considered stalled
+# and gets disconnected (configurable via WS_SEND_TIMEOUT in .env)
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "5"))
+# Maximum number of frames waiting to be written to one socket
+WS_OUTBOX_SIZE = int(os.getenv("WS_OUTBOX_SIZE", "256"))
+# What to do when a socket's outbound queue is full:
+#   drop_oldest - discard the oldest queued frame
+#   coalesce    - replace a queued frame with the same coalesce key (read receipts),
+#                 else discard the oldest coalescable frame, else disconnect
+#   disconnect  - close the socket with 1013 (Try Again Later)
+WS_OUTBOX_POLICY = os.getenv("WS_OUTBOX_POLICY", "coalesce")
+
+OUTBOX_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+
+# Close code sent to clients whose outbound queue overflowed
+CLOSE_TRY_AGAIN_LATER = 1013
+
+# Backplane channels used by the manager itself
+CHANNEL_CHAT = "chat"              # chat broadcasts
+CHANNEL_USER = "user"              # send_to_user
+CHANNEL_MEMBERSHIP = "membership"  # membership index invalidation
+
+
+def default_node_id() -> str:
+    """Identifies this worker on the backplane (unique per process start)."""
+    return f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(3)}"
+
+
+@dataclass
+class BroadcastReport:
+    """
+    Outcome of a fan-out. queued / dropped / disconnected are known when broadcast()
+    returns (frames put on the sockets' outboxes). delivered / superseded / failed
+    are filled in later by the sockets' writer tasks, as each frame is written or
+    its send times out; await wait() to see them complete.
+    """
+    chat_id: Optional[int]
+    queued: int = 0
+    # Sockets that had to drop an older frame to take this one
+    dropped: List[WebSocket] = field(default_factory=list)
+    disconnected: List[WebSocket] = field(default_factory=list)
+    # Frames written to their socket
+    delivered: int = 0
+    # Frames replaced by a newer update with the same coalesce key before they went out
+    superseded: int = 0
+    # Sockets this frame never reached: send timed out, peer gone, or discarded on overflow
+    failed: List[WebSocket] = field(default_factory=list)
+    _settled: Optional[asyncio.Event] = field(default=None, repr=False)
+
+    @property
+    def ok(self) -> bool:
+        return not self.dropped and not self.disconnected and not self.failed
+
+    @property
+    def pending(self) -> int:
+        """Queued frames the writers haven't finished with yet."""
+        return self.queued - self.delivered - self.superseded - len(self.failed)
+
+    def settle(self, websocket: WebSocket, outcome: str):
+        """Record what happened to one queued frame ("delivered", "superseded" or "failed")."""
+        if outcome == "delivered":
+            self.delivered += 1
+        elif outcome == "superseded":
+            self.superseded += 1
+        else:
+            self.failed.append(websocket)
+        if self.pending <= 0 and self._settled is not None:
+            self._settled.set()
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        """Wait until every queued frame was written or failed; False if timeout ran out first."""
+        if self.pending <= 0:
+            return True
+        if self._settled is None:
+            self._settled = asyncio.Event()
+        try:
+            await asyncio.wait_for(self._settled.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+
+class Outbox:
+    """
+    Bounded outbound queue for one socket, drained by its own writer task.
+    Producers never wait on the network: put() only appends to the queue and
+    applies the overflow policy when the queue is full.
+    """
+
+    def __init__(self, websocket: WebSocket, user_id: Optional[int], maxsize: int, policy: str,
+                 send_timeout: float, on_dead: Callable, codec: JsonCodec = JSON_CODEC):
+        if policy not in OUTBOX_POLICIES:
+            raise ValueError(f"Unknown outbox policy: {policy}")
+        self.websocket = websocket
+        self.user_id = user_id
+        self.maxsize = maxsize
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self._on_dead = on_dead
+        # How frames are written to this socket (JSON text or MessagePack, see wire.py)
+        self.codec = codec
+        # Each entry is [coalesce_key, message, report] so coalescing can swap the message in place
+        # (report: the BroadcastReport the frame belongs to, or None)
+        self._queue: Deque[list] = deque()
+        self._keyed: Dict[Hashable, list] = {}
+        self._wakeup = asyncio.Event()
+        self.closed = False
+        # Counters exposed through ConnectionManager.get_stats()
+        self.sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.task = asyncio.create_task(self._writer())
+
+    @property
+    def depth(self) -> int:
+        return len(self._queue)
+
+    def put(self, message: str, coalesce_key: Optional[Hashable] = None,
+            report: Optional[BroadcastReport] = None) -> str:
+        """
+        Queue a frame. Returns "queued", "coalesced", "dropped" or "disconnected".
+        A queued frame's report is settled once the writer is done with it.
+        """
+        if self.closed:
+            return "disconnected"
+
+        outcome = "queued"
+        if coalesce_key is not None and self.policy == "coalesce" and coalesce_key in self._keyed:
+            # A newer update supersedes the queued one - replace it in place
+            entry = self._keyed[coalesce_key]
+            self._settle(entry, "superseded")
+            entry[1], entry[2] = message, report
+            self.coalesced += 1
+            return "coalesced"
+
+        if len(self._queue) >= self.maxsize:
+            if self.policy == "drop_oldest":
+                self._discard(self._queue.popleft())
+                outcome = "dropped"
+            elif self.policy == "coalesce" and self._keyed:
+                # Make room by dropping the oldest superseded-able frame (read receipts)
+                oldest = next(entry for entry in self._queue if entry[0] is not None)
+                self._queue.remove(oldest)
+                self._discard(oldest)
+                outcome = "dropped"
+            else:
+                self.closed = True
+                self._on_dead(self, CLOSE_TRY_AGAIN_LATER)
+                return "disconnected"
+
+        entry = [coalesce_key, message, report]
+        self._queue.append(entry)
+        if coalesce_key is not None:
+            self._keyed[coalesce_key] = entry
+        self.max_depth = max(self.max_depth, len(self._queue))
+        self._wakeup.set()
+        return outcome
+
+    def _discard(self, entry: list):
+        self.dropped += 1
+        if entry[0] is not None and self._keyed.get(entry[0]) is entry:
+            del self._keyed[entry[0]]
+        self._settle(entry, "failed")
+
+    def _settle(self, entry: list, outcome: str):
+        if entry[2] is not None:
+            entry[2].settle(self.websocket, outcome)
+
+    async def _writer(self):
+        while not self.closed:
+            if not self._queue:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            entry = self._queue.popleft()
+            if entry[0] is not None and self._keyed.get(entry[0]) is entry:
+                del self._keyed[entry[0]]
+            try:
+                await asyncio.wait_for(self.codec.send(self.websocket, entry[1]), self.send_timeout)
+                self.sent += 1
+                self._settle(entry, "delivered")
+            except Exception:
+                # Closed or stalled peer (timeout) - stop writing and let the manager drop it
+                self._settle(entry, "failed")
+                self.closed = True
+                self._on_dead(self, None)
+                return
+
+    def stop(self):
+        self.closed = True
+        if self.task is not asyncio.current_task():
+            self.task.cancel()
+        # Frames still queued will never be written
+        while self._queue:
+            self._settle(self._queue.popleft(), "failed")
+        self._keyed.clear()
+
+    def stats(self) -> dict:
+        return {
+            "user_id": self.user_id,
+            "policy": self.policy,
+            "codec": self.codec.subprotocol,
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+        }
+
 
 class ConnectionManager:
-    def __init__(self):
-        # Dict[chat_id, List[WebSocket]] - for backward compatibility
-        self.active_connections: Dict[int, List[WebSocket]] = {}
-        # Dict[user_id, WebSocket] - track connections by user
-        self.user_connections: Dict[int, WebSocket] = {}
+    def __init__(self, send_timeout: float = WS_SEND_TIMEOUT, outbox_size: int = WS_OUTBOX_SIZE,
+                 outbox_policy: str = WS_OUTBOX_POLICY, backplane: Optional[Backplane] = None,
+                 node_id: Optional[str] = None, event_log: Optional[EventLog] = None):
+        # Per-frame send timeout used by each socket's writer task
+        self.send_timeout = send_timeout
+        # Outbound queue bound and overflow policy applied to every registered socket
+        if outbox_policy not in OUTBOX_POLICIES:
+            raise ValueError(f"Unknown outbox policy: {outbox_policy}")
+        self.outbox_size = outbox_size
+        self.outbox_policy = outbox_policy
+        # Dict[chat_id, Set[WebSocket]] - sockets that opened each chat
+        self.active_connections: Dict[int, Set[WebSocket]] = {}
+        # Dict[WebSocket, Set[chat_id]] - reverse index: chats each socket opened, so
+        # disconnect only touches that socket's own subscriptions
+        self.subscriptions: Dict[WebSocket, Set[int]] = {}
+        # Dict[user_id, Set[WebSocket]] - track connections by user (one per device/tab)
+        self.user_connections: Dict[int, Set[WebSocket]] = {}
+        # Dict[WebSocket, Outbox] - outbound queue + writer task for every registered socket
+        self.outboxes: Dict[WebSocket, Outbox] = {}
+        # Sequence numbers and replay buffers for the users connected here (see event_log.py)
+        self.event_log = event_log if event_log is not None else EventLog()
+        # Counters for sockets that are already gone (so totals survive disconnects)
+        self._closed_stats = {"sent": 0, "dropped": 0, "coalesced": 0, "overflow_disconnects": 0}
         # Dict[chat_id, Set[user_id]] - track which users are members of which chats
-        # This is populated when we broadcast, by getting chat members from DB
+        # This is populated lazily when we broadcast, by getting chat members from DB,
+        # and dropped by invalidate_chat_members() whenever membership changes
+        self.chat_members: Dict[int, Set[int]] = {}
+        # Dict[chat_id, int] - bumped on invalidation so that a DB load racing with
+        # a membership change doesn't put stale members back into the index
+        self._membership_versions: Dict[int, int] = {}
+        # Pub/sub shared with other workers; each worker delivers to its own sockets.
+        # Without one (or before start()) everything stays in this process.
+        self.backplane = backplane
+        self.node_id = node_id or default_node_id()
+        # Loads chat members for broadcasts that arrive from other workers
+        # (their get_chat_members_fn can't travel over the backplane)
+        self.members_loader: Optional[Callable] = None
+        # Dict[channel, handler] - extra backplane channels (e.g. session replication)
+        self._channel_handlers: Dict[str, Callable] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # Callbacks fired as fn(user_id, online) when a user's first device connects
+        # to this worker or their last one goes away
+        self._user_listeners: List[Callable[[int, bool], None]] = []
+        # Callbacks fired as fn(chat_id) when a chat's membership changes (here or on another worker)
+        self._membership_listeners: List[Callable[[int], None]] = []
 
-    async def connect(self, websocket: WebSocket, chat_id: int, user_id: Optional[int] = None):
+    # -------------------------------
+    # BACKPLANE
+    # -------------------------------
+    def add_channel_handler(self, channel: str, handler: Callable):
+        """Register `async handler(payload)` for a custom backplane channel (before start())."""
+        self._channel_handlers[channel] = handler
+
+    def backplane_channels(self) -> List[str]:
+        """Channels this worker subscribes to."""
+        return [CHANNEL_CHAT, CHANNEL_USER, CHANNEL_MEMBERSHIP, *self._channel_handlers]
+
+    async def start(self):
+        """Subscribe to the backplane. Call once from the app's startup event."""
+        self._loop = asyncio.get_running_loop()
+        if self.backplane is not None:
+            await self.backplane.start(self._on_backplane_message, self.backplane_channels())
+            logger.info(f"Backplane {type(self.backplane).__name__} started (node {self.node_id})")
+
+    async def stop(self):
+        if self.backplane is not None and self._loop is not None:
+            await self.backplane.stop()
+        self._loop = None
+
+    async def publish(self, channel: str, payload: dict):
+        """Publish to the other workers. A no-op until start() or without a backplane."""
+        if self.backplane is None or self._loop is None:
+            return
+        try:
+            await self.backplane.publish(channel, {"origin": self.node_id, **payload})
+        except Exception as e:
+            logger.error(f"Backplane publish on {channel} failed: {e}")
+
+    def publish_soon(self, channel: str, payload: dict):
+        """Fire-and-forget publish, callable from the event loop or from threadpool (sync endpoint) threads."""
+        if self.backplane is None or self._loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is self._loop:
+            self._loop.create_task(self.publish(channel, payload))
+        else:
+            asyncio.run_coroutine_threadsafe(self.publish(channel, payload), self._loop)
+
+    async def _on_backplane_message(self, channel: str, payload: dict):
+        if payload.get("origin") == self.node_id:
+            # Already delivered locally when it was published
+            return
+        if channel == CHANNEL_CHAT:
+            coalesce_key = payload.get("coalesce_key")
+            await self._deliver_chat(
+                payload["chat_id"],
+                payload["message"],
+                self.members_loader if payload.get("members") else None,
+                tuple(coalesce_key) if coalesce_key is not None else None
+            )
+        elif channel == CHANNEL_USER:
+            self.send_to_local_user(payload["user_id"], payload["message"])
+        elif channel == CHANNEL_MEMBERSHIP:
+            self._invalidate_local(payload["chat_id"])
+        elif channel in self._channel_handlers:
+            await self._channel_handlers[channel](payload)
+
+    # -------------------------------
+    # CONNECTIONS
+    # -------------------------------
+    async def connect(self, websocket: WebSocket, chat_id: int, user_id: Optional[int] = None,
+                      codec: Optional[JsonCodec] = None):
+        # A socket belongs to the user it was registered for; it never moves to another one
+        outbox = self.outboxes.get(websocket)
+        if user_id is not None and outbox is not None and outbox.user_id not in (None, user_id):
+            raise ValueError(f"WebSocket belongs to user {outbox.user_id}, not {user_id}")
         # Only accept if not already connected (handles both /api/ws and /ws/{chat_id}/{user_id} endpoints)
         if websocket.client_state != WebSocketState.CONNECTED:
             await websocket.accept()
-        if chat_id not in self.active_connections:
-            self.active_connections[chat_id] = []
-        self.active_connections[chat_id].append(websocket)
-        
-        # Track connection by user_id if provided
+        # Sets make repeated chat.open for the same chat a no-op
+        self.active_connections.setdefault(chat_id, set()).add(websocket)
+        self.subscriptions.setdefault(websocket, set()).add(chat_id)
+
+        if outbox is None:
+            outbox = self.outboxes[websocket] = Outbox(
+                websocket, user_id, self.outbox_size, self.outbox_policy,
+                self.send_timeout, self._on_outbox_dead, codec or JSON_CODEC
+            )
+
+        # Track connection by user_id if provided (every device of a user)
         if user_id is not None:
-            self.user_connections[user_id] = websocket
+            outbox.user_id = user_id
+            if user_id not in self.user_connections:
+                self.user_connections[user_id] = set()
+                self.event_log.attach(user_id)
+                self._notify_user_listeners(user_id, True)
+            self.user_connections[user_id].add(websocket)
 
-    async def send_to_user(self, user_id: int, message: str):
+    def _remove_user_connection(self, user_id: int, websocket: WebSocket):
+        connections = self.user_connections.get(user_id)
+        if connections is not None:
+            connections.discard(websocket)
+            if not connections:
+                del self.user_connections[user_id]
+                self.event_log.detach(user_id)
+                self._notify_user_listeners(user_id, False)
+
+    def resume(self, websocket: WebSocket, user_id: int, ready: dict,
+               stream: Optional[str] = None, last_seq: Optional[int] = None) -> dict:
         """
-        Send a message to a specific user if they're connected.
-        This is an async method that should be called from an async context.
+        Queue the session.ready frame on a just-registered socket, followed by the
+        user's events after last_seq if the client is resuming this worker's stream.
+        Adds stream / seq / resync / replayed to the frame and returns it; resync is
+        true when the missed events are no longer buffered and the client must refetch.
+        When events are replayed, seq is the client's own last_seq: the replayed frames
+        move it forward, so a socket dropped mid-replay resumes from what it really got.
         """
-        if user_id in self.user_connections:
-            websocket = self.user_connections[user_id]
+        missed = [] if last_seq is None else self.event_log.since(user_id, stream, last_seq)
+        ready = {
+            **ready,
+            "stream": self.event_log.stream,
+            "seq": last_seq if missed else self.event_log.last_seq(user_id),
+            "resync": missed is None,
+            "replayed": len(missed or ()),
+        }
+        self._enqueue(websocket, json.dumps(ready))
+        for frame in missed or ():
+            self._enqueue(websocket, frame)
+        return ready
+
+    def add_user_listener(self, listener: Callable[[int, bool], None]):
+        """Call listener(user_id, online) when a user comes online on / goes offline from this worker."""
+        self._user_listeners.append(listener)
+
+    def _notify_user_listeners(self, user_id: int, online: bool):
+        for listener in self._user_listeners:
             try:
-                await websocket.send_text(message)
-                return True
+                listener(user_id, online)
             except Exception as e:
-                # Connection might be closed, remove it
-                if user_id in self.user_connections:
-                    del self.user_connections[user_id]
-                return False
-        return False
+                logger.error(f"User listener failed for user {user_id}: {e}", exc_info=True)
+
+    def _enqueue(self, websocket: WebSocket, message: str, coalesce_key: Optional[Hashable] = None,
+                 report: Optional[BroadcastReport] = None) -> str:
+        outbox = self.outboxes.get(websocket)
+        if outbox is None:
+            return "disconnected"
+        return outbox.put(message, coalesce_key, report)
+
+    async def send_personal(self, websocket: WebSocket, message: str) -> bool:
+        """
+        Queue a reply for one registered socket (pong, errors, acks).
+        Goes through the socket's outbox so it is ordered with broadcasts;
+        falls back to a direct send for sockets that were never registered.
+        """
+        if websocket in self.outboxes:
+            return self._enqueue(websocket, message) != "disconnected"
+        try:
+            await asyncio.wait_for(websocket.send_text(message), self.send_timeout)
+            return True
+        except Exception:
+            return False
+
+    async def send_to_user(self, user_id: int, message: str):
+        """
+        Send a message to every connected device of a specific user, on every worker.
+        Returns True if at least one device held by this worker accepted it.
+        This is an async method that should be called from an async context.
+        """
+        delivered = self.send_to_local_user(user_id, message)
+        await self.publish(CHANNEL_USER, {"user_id": user_id, "message": message})
+        return delivered
+
+    def send_to_local_user(self, user_id: int, message: str) -> bool:
+        """Queue a message for the devices of a user held by this worker only."""
+        delivered = False
+        message = self.event_log.stamp(user_id, message)
+        for websocket in list(self.user_connections.get(user_id, ())):
+            if self._enqueue(websocket, message) != "disconnected":
+                delivered = True
+        return delivered
+
+    def _on_outbox_dead(self, outbox: Outbox, close_code: Optional[int]):
+        """Called by an outbox when its peer is gone, stalled, or overflowed under the disconnect policy."""
+        if close_code == CLOSE_TRY_AGAIN_LATER:
+            self._closed_stats["overflow_disconnects"] += 1
+        asyncio.get_running_loop().create_task(self.evict(outbox.websocket, close_code))
+
+    def _forget(self, websocket: WebSocket):
+        """Remove a socket from every index and stop its writer."""
+        outbox = self.outboxes.get(websocket)
+        if outbox is not None and outbox.user_id is not None:
+            self._remove_user_connection(outbox.user_id, websocket)
+        for cid in self.subscriptions.pop(websocket, ()):
+            self._unsubscribe(cid, websocket)
+        outbox = self.outboxes.pop(websocket, None)
+        if outbox is not None:
+            outbox.stop()
+            for key in ("sent", "dropped", "coalesced"):
+                self._closed_stats[key] += getattr(outbox, key)
+
+    def _unsubscribe(self, chat_id: int, websocket: WebSocket):
+        connections = self.active_connections.get(chat_id)
+        if connections is not None:
+            connections.discard(websocket)
+            if not connections:
+                del self.active_connections[chat_id]
+
+    async def evict(self, websocket: WebSocket, close_code: Optional[int] = None,
+                     reason: str = "Outbound queue full, try again later"):
+        """Drop a dead or stalled socket from every index and close it (without waiting on it forever)."""
+        self._forget(websocket)
+        try:
+            if close_code is not None:
+                await asyncio.wait_for(websocket.close(code=close_code, reason=reason), self.send_timeout)
+            else:
+                await asyncio.wait_for(websocket.close(), self.send_timeout)
+        except Exception:
+            pass
 
     async def disconnect(self, websocket: WebSocket, chat_id: int = None, user_id: Optional[int] = None):
         if chat_id is None:
-            # Disconnect from all chats
-            chats_to_remove = []
-            for cid, connections in list(self.active_connections.items()):
-                if websocket in connections:
-                    connections.remove(websocket)
-                    if not connections:
-                        chats_to_remove.append(cid)
-            for cid in chats_to_remove:
-                del self.active_connections[cid]
+            # Disconnect from all chats (also stops the socket's writer task)
+            self._forget(websocket)
             # Use try/except as the socket might already be closed by the client
             try:
                 await websocket.close()
             except Exception:
                 pass
         else:
-            if chat_id in self.active_connections and websocket in self.active_connections[chat_id]:
-                self.active_connections[chat_id].remove(websocket)
+            chats = self.subscriptions.get(websocket)
+            if chats is not None and chat_id in chats:
+                chats.discard(chat_id)
+                self._unsubscribe(chat_id, websocket)
                 # Use try/except as the socket might already be closed by the client
                 try:
                     await websocket.close()
                 except Exception:
                     pass
-                if not self.active_connections[chat_id]:
-                    del self.active_connections[chat_id]
-        
-        # Remove user connection if provided
-        if user_id is not None and user_id in self.user_connections:
-            # Only remove if it's the same websocket
-            if self.user_connections[user_id] == websocket:
-                del self.user_connections[user_id]
+            # Socket is closed, so it no longer needs a writer unless it's still subscribed elsewhere
+            if not self.subscriptions.get(websocket):
+                self._forget(websocket)
+
+        # Remove this device from the user's connections if provided (other devices stay)
+        if user_id is not None:
+            self._remove_user_connection(user_id, websocket)
+
+    def get_stats(self) -> dict:
+        """Outbound queue depth and drop counters, overall and per socket (to spot bad clients)."""
+        connections = [outbox.stats() for outbox in self.outboxes.values()]
+        totals = dict(self._closed_stats)
+        for stats in connections:
+            for key in ("sent", "dropped", "coalesced"):
+                totals[key] += stats[key]
+        totals["queued"] = sum(stats["depth"] for stats in connections)
+        return {
+            "policy": self.outbox_policy,
+            "outbox_size": self.outbox_size,
+            "connections": len(connections),
+            "totals": totals,
+            "replay": self.event_log.get_stats(),
+            "per_connection": sorted(connections, key=lambda s: (s["depth"], s["dropped"]), reverse=True),
+        }
+
+    async def get_chat_member_ids(self, chat_id: int, get_chat_members_fn: Callable) -> Set[int]:
+        """
+        Return the user IDs of a chat's members.
+        Served from the in-memory membership index; on a miss get_chat_members_fn
+        is awaited (async loaders) or run in the threadpool (sync loaders, they hit
+        the DB) and the result is cached until invalidate_chat_members is called
+        for the chat.
+        """
+        members = self.chat_members.get(chat_id)
+        if members is not None:
+            return members
+
+        version = self._membership_versions.get(chat_id, 0)
+        if asyncio.iscoroutinefunction(get_chat_members_fn):
+            rows = await get_chat_members_fn(chat_id)
+        else:
+            rows = await run_in_threadpool(get_chat_members_fn, chat_id)
+        members = {row.user_id for row in rows}
+        # Only cache if membership didn't change while we were loading
+        if self._membership_versions.get(chat_id, 0) == version:
+            self.chat_members[chat_id] = members
+        return members
+
+    def invalidate_chat_members(self, chat_id: int):
+        """
+        Drop the cached membership of a chat, here and on every other worker.
+        Must be called whenever members are added to or removed from the chat.
+        Safe to call from sync endpoints running in the threadpool.
+        """
+        self._invalidate_local(chat_id)
+        self.publish_soon(CHANNEL_MEMBERSHIP, {"chat_id": chat_id})
 
-    async def broadcast(self, chat_id: int, message: str, get_chat_members_fn: Optional[Callable] = None):
+    def _invalidate_local(self, chat_id: int):
+        self._membership_versions[chat_id] = self._membership_versions.get(chat_id, 0) + 1
+        self.chat_members.pop(chat_id, None)
+        for listener in self._membership_listeners:
+            listener(chat_id)
+
+    def add_membership_listener(self, listener: Callable[[int], None]):
+        """Call listener(chat_id) whenever a chat's membership is invalidated."""
+        self._membership_listeners.append(listener)
+
+    async def broadcast(
+        self,
+        chat_id: int,
+        message: str,
+        get_chat_members_fn: Optional[Callable] = None,
+        coalesce_key: Optional[Hashable] = None
+    ) -> BroadcastReport:
         """
         Broadcast message to all chat members.
-        If get_chat_members_fn is provided, it will be called to get all chat members
-        and send the message to all their connections (even if they haven't opened the chat).
+        If get_chat_members_fn is provided, it is used to fill the membership index
+        for this chat (see get_chat_member_ids) and the message is sent to all
+        members' connections (even if they haven't opened the chat).
         Otherwise, it falls back to only sending to connections that have opened the chat.
+
+        The message is only queued on each recipient's outbox, so a slow client never
+        holds up the sender or the rest of the group. Frames carrying the same
+        coalesce_key (e.g. read receipts) may replace each other while still queued.
+
+        With a backplane, the broadcast is also published so other workers deliver it
+        to their own sockets; the returned report covers this worker's sockets only.
         """
-        # #region agent log
-        import json
-        import time
-        sent_connections = set()
-        log_data = {
-            "sessionId": "debug-session",
-            "runId": "run1",
-            "hypothesisId": "H",
-            "location": "connection_manager.py:60",
-            "message": "broadcast method entry",
-            "data": {
-                "chat_id": chat_id,
-                "has_get_members_fn": get_chat_members_fn is not None,
-                "active_connections_count": len(self.active_connections.get(chat_id, [])),
-                "user_connections_count": len(self.user_connections)
-            },
-            "timestamp": int(time.time() * 1000)
+        report = await self._deliver_chat(chat_id, message, get_chat_members_fn, coalesce_key)
+        await self.publish(CHANNEL_CHAT, self._chat_payload(chat_id, message, get_chat_members_fn, coalesce_key))
+        return report
+
+    @staticmethod
+    def _chat_payload(chat_id: int, message: str, get_chat_members_fn: Optional[Callable],
+                      coalesce_key: Optional[Hashable]) -> dict:
+        """Backplane form of a broadcast (the members function itself can't be serialized)."""
+        return {
+            "chat_id": chat_id,
+            "message": message,
+            "members": get_chat_members_fn is not None,
+            "coalesce_key": list(coalesce_key) if coalesce_key is not None else None,
         }
-        with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-            f.write(json.dumps(log_data) + '\n')
-        # #endregion
-        
-        # Track which connections we've already sent to (by connection object id)
-        sent_connection_ids = set()
-        
-        # First, send to all connections that have opened this chat (backward compatibility)
-        if chat_id in self.active_connections:
-            for connection in self.active_connections[chat_id]:
-                conn_id = id(connection)
-                if conn_id not in sent_connection_ids:
-                    try:
-                        await connection.send_text(message)
-                        sent_connection_ids.add(conn_id)
-                        # #region agent log
-                        log_data = {
-                            "sessionId": "debug-session",
-                            "runId": "run1",
-                            "hypothesisId": "H",
-                            "location": "connection_manager.py:85",
-                            "message": "Sent to active connection",
-                            "data": {"chat_id": chat_id, "connection_id": conn_id},
-                            "timestamp": int(time.time() * 1000)
-                        }
-                        with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                            f.write(json.dumps(log_data) + '\n')
-                        # #endregion
-                    except Exception as e:
-                        # #region agent log
-                        log_data = {
-                            "sessionId": "debug-session",
-                            "runId": "run1",
-                            "hypothesisId": "H",
-                            "location": "connection_manager.py:95",
-                            "message": "Failed to send to active connection",
-                            "data": {"chat_id": chat_id, "error": str(e)},
-                            "timestamp": int(time.time() * 1000)
-                        }
-                        with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                            f.write(json.dumps(log_data) + '\n')
-                        # #endregion
-                        pass
-        
-        # Also send to all chat members' connections (if we have the function to get members)
+
+    async def _deliver_chat(
+        self,
+        chat_id: int,
+        message: str,
+        get_chat_members_fn: Optional[Callable],
+        coalesce_key: Optional[Hashable]
+    ) -> BroadcastReport:
+        """Queue a chat broadcast on the sockets held by this worker."""
+        # Collect each recipient connection once (keyed by connection object id)
+        recipients: Dict[int, WebSocket] = {}
+
+        # First, all connections that have opened this chat (backward compatibility)
+        for connection in self.active_connections.get(chat_id, ()):
+            recipients.setdefault(id(connection), connection)
+
+        # Also all chat members' connections (if we have the function to get members)
+        member_ids: Set[int] = set()
         if get_chat_members_fn is not None:
             try:
-                members = get_chat_members_fn(chat_id)
-                # #region agent log
-                log_data = {
-                    "sessionId": "debug-session",
-                    "runId": "run1",
-                    "hypothesisId": "H",
-                    "location": "connection_manager.py:110",
-                    "message": "Got chat members",
-                    "data": {"chat_id": chat_id, "members_count": len(members)},
-                    "timestamp": int(time.time() * 1000)
-                }
-                with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                    f.write(json.dumps(log_data) + '\n')
-                # #endregion
-                for member in members:
-                    user_id = member.user_id
-                    if user_id in self.user_connections:
-                        connection = self.user_connections[user_id]
-                        conn_id = id(connection)
-                        # Only send if not already sent (avoid duplicates)
-                        if conn_id not in sent_connection_ids:
-                            try:
-                                await connection.send_text(message)
-                                sent_connection_ids.add(conn_id)
-                                # #region agent log
-                                log_data = {
-                                    "sessionId": "debug-session",
-                                    "runId": "run1",
-                                    "hypothesisId": "H",
-                                    "location": "connection_manager.py:128",
-                                    "message": "Sent to user connection",
-                                    "data": {"chat_id": chat_id, "user_id": user_id, "connection_id": conn_id},
-                                    "timestamp": int(time.time() * 1000)
-                                }
-                                with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                                    f.write(json.dumps(log_data) + '\n')
-                                # #endregion
-                            except Exception as e:
-                                # #region agent log
-                                log_data = {
-                                    "sessionId": "debug-session",
-                                    "runId": "run1",
-                                    "hypothesisId": "H",
-                                    "location": "connection_manager.py:140",
-                                    "message": "Failed to send to user connection",
-                                    "data": {"chat_id": chat_id, "user_id": user_id, "error": str(e)},
-                                    "timestamp": int(time.time() * 1000)
-                                }
-                                with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                                    f.write(json.dumps(log_data) + '\n')
-                                # #endregion
-                                pass
-            except Exception as e:
-                # #region agent log
-                log_data = {
-                    "sessionId": "debug-session",
-                    "runId": "run1",
-                    "hypothesisId": "H",
-                    "location": "connection_manager.py:152",
-                    "message": "Error in broadcast get_members",
-                    "data": {"chat_id": chat_id, "error": str(e)},
-                    "timestamp": int(time.time() * 1000)
-                }
-                with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                    f.write(json.dumps(log_data) + '\n')
-                # #endregion
+                member_ids = await self.get_chat_member_ids(chat_id, get_chat_members_fn)
+            except Exception:
                 # If getting chat members fails, fall back to existing behavior
-                pass
\ No newline at end of file
+                member_ids = set()
+            for user_id in member_ids:
+                for connection in self.user_connections.get(user_id, ()):
+                    recipients.setdefault(id(connection), connection)
+
+        report = BroadcastReport(chat_id=chat_id)
+        # Dict[user_id, frame] - each user's copy carries their own sequence number
+        frames: Dict[Optional[int], str] = {}
+        for connection in recipients.values():
+            outbox = self.outboxes.get(connection)
+            user_id = outbox.user_id if outbox is not None else None
+            if user_id not in frames:
+                frames[user_id] = self.event_log.stamp(user_id, message)
+            outcome = self._enqueue(connection, frames[user_id], coalesce_key, report)
+            if outcome in ("queued", "coalesced"):
+                report.queued += 1
+            elif outcome == "dropped":
+                report.queued += 1
+                report.dropped.append(connection)
+            else:
+                report.disconnected.append(connection)
+        # Members between reconnects still get the event numbered, so it can be replayed
+        if member_ids and is_durable(message):
+            for user_id in member_ids:
+                if user_id not in frames and self.event_log.tracks(user_id):
+                    self.event_log.stamp(user_id, message)
+        return report
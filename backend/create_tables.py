@@ -1,6 +1,9 @@
 from database import Base, engine
 from models import User, Chat, ChatMember, Message, MessageStatus  # <- import all models
+from migrations import run_migrations
 
 # Create all tables
 Base.metadata.create_all(bind=engine)
+# Add columns that are newer than existing tables
+run_migrations(engine)
 
@@ -1,3 +1,6 @@
+from collections import Counter
+
+from sqlalchemy import and_, case, func, or_, select, update
 from sqlalchemy.orm import Session
 
 from models import User, Chat, ChatMember, Message, MessageStatus
@@ -40,12 +43,62 @@ def get_chat(db: Session, chat_id: int) -> Optional[Chat]:
 
 
 def list_chats_for_user(db: Session, user_id: int) -> list[type[Chat]]:
+    """
+    The user's chats, most recent activity first (from the chats' summary columns).
+    The rows come from the user's memberships (ix_chat_members_user_chat) and are
+    sorted after that, so the sort covers only this user's chats and never reads messages.
+    """
     return (
         db.query(Chat)
         .join(ChatMember)
         .filter(ChatMember.user_id == user_id)
+        .order_by(func.coalesce(Chat.last_message_at, Chat.created_at).desc(), Chat.id.desc())
+        .all()
+    )
+
+
+def list_chat_summaries(db: Session, user_id: int) -> list[dict]:
+    """
+    The user's chats with last_message_at, unread_count and (for direct chats) the
+    other member, newest activity first, in a single query. As in
+    list_chats_for_user, ordering is a sort of the user's own chats, not an index walk.
+    """
+    me = db.query(ChatMember.chat_id, ChatMember.unread_count).filter(ChatMember.user_id == user_id).subquery()
+    others = (
+        db.query(ChatMember.chat_id, func.min(ChatMember.user_id).label("other_user_id"))
+        .join(me, me.c.chat_id == ChatMember.chat_id)
+        .filter(ChatMember.user_id != user_id)
+        .group_by(ChatMember.chat_id)
+        .subquery()
+    )
+    activity = func.coalesce(Chat.last_message_at, Chat.created_at)
+    rows = (
+        db.query(
+            Chat,
+            activity.label("last_message_at"),
+            me.c.unread_count,
+            others.c.other_user_id,
+            User.username.label("other_user_name"),
+        )
+        .join(me, me.c.chat_id == Chat.id)
+        .outerjoin(others, and_(others.c.chat_id == Chat.id, Chat.type == "direct"))
+        .outerjoin(User, User.id == others.c.other_user_id)
+        .order_by(activity.desc(), Chat.id.desc())
         .all()
     )
+    return [
+        {
+            "id": chat.id,
+            "type": chat.type,
+            "title": chat.title,
+            "created_at": chat.created_at,
+            "last_message_at": last_message_at,
+            "other_user_name": other_user_name,
+            "other_user_id": other_user_id,
+            "unread_count": unread_count,
+        }
+        for chat, last_message_at, unread_count, other_user_id, other_user_name in rows
+    ]
 
 
 # -------------------------------
@@ -58,6 +111,9 @@ def add_member_to_chat(db: Session, chat_id: int, user_id: int) -> type[ChatMemb
 
     member = ChatMember(chat_id=chat_id, user_id=user_id)
     db.add(member)
+    db.flush()
+    # The chat's earlier messages count as unread for the new member
+    db.execute(unread_recount(chat_id, user_id))
     db.commit()
     db.refresh(member)
     return member
@@ -67,6 +123,18 @@ def get_chat_members(db: Session, chat_id: int) -> list[type[ChatMember]]:
     return db.query(ChatMember).filter(ChatMember.chat_id == chat_id).all()
 
 
+def get_chat_peer_ids(db: Session, user_id: int) -> set[int]:
+    """IDs of all users sharing at least one chat with user_id (excluding user_id)."""
+    chat_ids = db.query(ChatMember.chat_id).filter(ChatMember.user_id == user_id)
+    rows = (
+        db.query(ChatMember.user_id)
+        .filter(ChatMember.chat_id.in_(chat_ids), ChatMember.user_id != user_id)
+        .distinct()
+        .all()
+    )
+    return {row.user_id for row in rows}
+
+
 def remove_member_from_chat(db: Session, chat_id: int, user_id: int) -> bool:
     """
     Remove a member from a chat.
@@ -99,6 +167,7 @@ def get_chat_members_with_users(db: Session, chat_id: int) -> list[dict]:
             "user_id": member.user_id,
             "username": user.username if user else None,
             "last_seen_at": member.last_seen_at,
+            "last_read_message_id": member.last_read_message_id,
             "active_chat_id": member.active_chat_id
         })
     return result
@@ -131,30 +200,53 @@ def find_existing_dm(db: Session, user1_id: int, user2_id: int) -> Optional[Chat
 
 def get_unread_count(db: Session, chat_id: int, user_id: int) -> int:
     """
-    Calculate unread message count for a user in a chat.
-    Counts messages created after the user's last_seen_at timestamp
-    that are not from the user themselves.
+    Unread message count for a user in a chat: messages from others created after
+    the user's last_seen_at. Read from the member's counter, not counted.
     """
-    # Get the user's last_seen_at for this chat
-    chat_member = db.query(ChatMember).filter(
+    unread_count = db.query(ChatMember.unread_count).filter(
         ChatMember.chat_id == chat_id,
         ChatMember.user_id == user_id
-    ).first()
-    
-    if not chat_member:
-        return 0
-    
-    # Count messages created after last_seen_at (or all messages if last_seen_at is None)
-    # that are not from the user
-    query = db.query(Message).filter(
-        Message.chat_id == chat_id,
-        Message.sender_id != user_id
+    ).scalar()
+    return unread_count or 0
+
+
+def unread_increment(chat_id: int, sender_ids: list[Optional[int]]):
+    """
+    UPDATE adding a chat's new messages (by sender_ids) to every other member's
+    unread_count. Execute it in the transaction that inserts them. System messages
+    (no sender) don't count. Returns None when there is nothing to add.
+    """
+    senders = [sender_id for sender_id in sender_ids if sender_id is not None]
+    if not senders:
+        return None
+    # Each member gets the messages not sent by themselves
+    added = case(
+        {sender_id: len(senders) - sent for sender_id, sent in Counter(senders).items()},
+        value=ChatMember.user_id,
+        else_=len(senders)
+    )
+    return update(ChatMember).where(ChatMember.chat_id == chat_id).values(unread_count=ChatMember.unread_count + added)
+
+
+def unread_recount(chat_id: int, user_id: int):
+    """
+    UPDATE recounting a member's unread_count from their last_seen_at. Run it when
+    last_seen_at moves; it only reads the messages after it (usually none).
+    """
+    unread = (
+        select(func.count(Message.id))
+        .where(
+            Message.chat_id == ChatMember.chat_id,
+            Message.sender_id != ChatMember.user_id,
+            or_(ChatMember.last_seen_at.is_(None), Message.created_at > ChatMember.last_seen_at)
+        )
+        .scalar_subquery()
+    )
+    return (
+        update(ChatMember)
+        .where(ChatMember.chat_id == chat_id, ChatMember.user_id == user_id)
+        .values(unread_count=unread)
     )
-    
-    if chat_member.last_seen_at:
-        query = query.filter(Message.created_at > chat_member.last_seen_at)
-    
-    return query.count()
 
 
 def update_last_seen(db: Session, chat_id: int, user_id: int, last_message_id: Optional[int] = None) -> None:
@@ -190,6 +282,8 @@ def update_last_seen(db: Session, chat_id: int, user_id: int, last_message_id: O
     else:
         chat_member.last_seen_at = datetime.utcnow()
     
+    db.flush()
+    db.execute(unread_recount(chat_id, user_id))
     db.commit()
     db.refresh(chat_member)
 
@@ -213,13 +307,58 @@ def create_message(
         media_url=media_url
     )
     db.add(message)
+    db.flush()
+    db.execute(chat_summary_update(chat_id, message.id, message.created_at))
+    unread = unread_increment(chat_id, [sender_id])
+    if unread is not None:
+        db.execute(unread)
     db.commit()
     db.refresh(message)
     return message
 
 
-def get_messages_for_chat(db: Session, chat_id: int) -> list[type[Message]]:
-    return db.query(Message).filter(Message.chat_id == chat_id).order_by(Message.created_at).all()
+def chat_summary_update(chat_id: int, last_message_id: int, last_message_at: datetime, count: int = 1):
+    """
+    UPDATE recording `count` new messages of a chat, the newest being last_message_id.
+    Execute it in the transaction that inserts them. Atomic, so concurrent writers
+    can't lose a count, and the last message only ever moves forward.
+    """
+    newer = or_(Chat.last_message_id.is_(None), Chat.last_message_id < last_message_id)
+    # last_message_at first: MySQL evaluates SET left to right, seeing values already assigned
+    return update(Chat).where(Chat.id == chat_id).ordered_values(
+        (Chat.last_message_at, case((newer, last_message_at), else_=Chat.last_message_at)),
+        (Chat.last_message_id, case((newer, last_message_id), else_=Chat.last_message_id)),
+        (Chat.message_count, Chat.message_count + count),
+    )
+
+
+def get_chat_history(
+    db: Session,
+    chat_id: int,
+    before_id: Optional[int] = None,
+    after_id: Optional[int] = None,
+    limit: int = 100
+) -> tuple[list[tuple[Message, Optional[str]]], bool]:
+    """
+    One page of a chat's messages, oldest first, each with its sender's username
+    (one joined query, walking the (chat_id, id) index).
+
+    Without a cursor this is the newest `limit` messages; with before_id the
+    `limit` messages just older than it, with after_id the ones just newer.
+    Returns (rows, more): whether there are further messages in the direction paged.
+    """
+    query = (
+        db.query(Message, User.username)
+        .outerjoin(User, User.id == Message.sender_id)
+        .filter(Message.chat_id == chat_id)
+    )
+    if after_id is not None:
+        rows = query.filter(Message.id > after_id).order_by(Message.id).limit(limit + 1).all()
+        return rows[:limit], len(rows) > limit
+    if before_id is not None:
+        query = query.filter(Message.id < before_id)
+    rows = query.order_by(Message.id.desc()).limit(limit + 1).all()
+    return rows[:limit][::-1], len(rows) > limit
 
 
 def get_message_status(db: Session, message_id: int, user_id: int) -> Optional[type[MessageStatus]]:
@@ -0,0 +1,88 @@
+"""
+Async versions of the CRUD functions used by the /api/ws handler.
+
+Same behaviour as their counterparts in crud.py, but they take an AsyncSession
+(see database.async_session) so the WebSocket handler can await them directly
+instead of hopping to the threadpool with a connection-long sync Session.
+"""
+from typing import Optional
+
+from sqlalchemy import or_, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from crud import unread_recount
+from models import User, Chat, ChatMember, Message
+
+
+# -------------------------------
+# USERS
+# -------------------------------
+async def get_user(db: AsyncSession, user_id: int) -> Optional[User]:
+    return await db.get(User, user_id)
+
+
+# -------------------------------
+# CHATS
+# -------------------------------
+async def get_chat(db: AsyncSession, chat_id: int) -> Optional[Chat]:
+    return await db.get(Chat, chat_id)
+
+
+async def get_chat_members(db: AsyncSession, chat_id: int) -> list[ChatMember]:
+    result = await db.execute(select(ChatMember).where(ChatMember.chat_id == chat_id))
+    return list(result.scalars())
+
+
+async def get_chat_peer_ids(db: AsyncSession, user_id: int) -> set[int]:
+    """IDs of all users sharing at least one chat with user_id (excluding user_id)."""
+    chat_ids = select(ChatMember.chat_id).where(ChatMember.user_id == user_id)
+    result = await db.execute(
+        select(ChatMember.user_id)
+        .where(ChatMember.chat_id.in_(chat_ids), ChatMember.user_id != user_id)
+        .distinct()
+    )
+    return set(result.scalars())
+
+
+# -------------------------------
+# MESSAGES
+# -------------------------------
+
+
+async def advance_read_watermark(
+    db: AsyncSession,
+    chat_id: int,
+    user_id: int,
+    message_id: int
+) -> Optional[int]:
+    """
+    Record that a member has read the chat up to message_id.
+
+    The member's last_read_message_id only ever moves forward, and last_seen_at
+    follows it (for unread counts). message_id is clamped to the newest message
+    in the chat at or below it. Returns the new watermark, or None if nothing
+    changed (already read that far, no such message, or not a member).
+    """
+    result = await db.execute(
+        select(Message.id, Message.created_at).where(
+            Message.chat_id == chat_id,
+            Message.id <= message_id
+        ).order_by(Message.id.desc()).limit(1)
+    )
+    row = result.first()
+    if row is None:
+        return None
+    up_to_message_id, created_at = row
+
+    # Conditional update so concurrent reads from several devices can't move it backwards
+    result = await db.execute(
+        update(ChatMember).where(
+            ChatMember.chat_id == chat_id,
+            ChatMember.user_id == user_id,
+            or_(ChatMember.last_read_message_id.is_(None), ChatMember.last_read_message_id < up_to_message_id)
+        ).values(last_read_message_id=up_to_message_id, last_seen_at=created_at)
+    )
+    if result.rowcount:
+        await db.execute(unread_recount(chat_id, user_id))
+    await db.commit()
+    return up_to_message_id if result.rowcount else None
@@ -52,3 +52,69 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+# -------------------------------
+# ASYNC ENGINE (WebSocket handler)
+# -------------------------------
+# Async driver used for each database in DATABASE_URL (install the matching package:
+# aiosqlite, asyncpg or aiomysql). Override with ASYNC_DATABASE_URL if needed.
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+    "mariadb": "mariadb+aiomysql",
+}
+
+
+def to_async_url(url: str) -> str:
+    """Turn a sync DATABASE_URL (e.g. mysql+pymysql://...) into its async-driver equivalent."""
+    scheme, separator, rest = url.partition("://")
+    dialect = scheme.split("+")[0]
+    if not separator or dialect not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver known for DATABASE_URL scheme: {scheme}")
+    return f"{ASYNC_DRIVERS[dialect]}://{rest}"
+
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL")
+
+# Created on first use so the async driver is only imported when it's needed
+_async_engine = None
+_async_session_factory = None
+
+
+def get_async_engine():
+    global _async_engine
+    if _async_engine is None:
+        from sqlalchemy.ext.asyncio import create_async_engine
+        _async_engine = create_async_engine(ASYNC_DATABASE_URL or to_async_url(DATABASE_URL), echo=SQL_ECHO)
+    return _async_engine
+
+
+def async_session():
+    """
+    New short-lived AsyncSession; use one per operation so no connection is held
+    between WebSocket frames:
+
+        async with async_session() as db:
+            chat = await crud_async.get_chat(db, chat_id)
+    """
+    global _async_session_factory
+    if _async_session_factory is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker
+        _async_session_factory = async_sessionmaker(
+            get_async_engine(),
+            autoflush=False,
+            expire_on_commit=False
+        )
+    return _async_session_factory()
+
+
+async def dispose_async_engine():
+    """Close the async engine's pooled connections (app shutdown)."""
+    global _async_engine, _async_session_factory
+    if _async_engine is not None:
+        await _async_engine.dispose()
+    _async_engine = None
+    _async_session_factory = None
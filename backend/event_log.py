@@ -0,0 +1,145 @@
+# event_log.py
+"""
+Per-user event sequence numbers and replay buffers for /api/ws reconnects.
+
+Every durable event this worker queues for a user (broadcasts, send_to_user)
+gets the next number of that user's sequence, as a leading "seq" field, and is
+kept in a bounded ring buffer. Ephemeral events (typing.update, presence.update)
+go out unnumbered: replaying them would show stale state, and buffering them
+would push real messages out of the buffer. A client reconnecting with the `stream` and `last_seq` it
+saw last is sent only the frames it missed, instead of refetching its chats and
+history; it is told to resync only when the gap can't be covered:
+- the buffer has rolled over (more than WS_REPLAY_BUFFER events missed),
+- it was away longer than WS_REPLAY_TTL (the buffer is gone), or
+- the stream differs: this worker restarted, or the client landed on another
+  worker (each worker numbers its own users' events; see WS_ROUTING to keep a
+  user's devices on one node).
+"""
+import json
+import logging
+import os
+import re
+import secrets
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+logger = logging.getLogger("websocket")
+
+# Events kept per user for replay (keep it below WS_OUTBOX_SIZE: a replay is queued in one go)
+WS_REPLAY_BUFFER = int(os.getenv("WS_REPLAY_BUFFER", "128"))
+# Seconds a user's buffer is kept after their last socket on this worker went away
+WS_REPLAY_TTL = float(os.getenv("WS_REPLAY_TTL", "120"))
+
+# Event types that are numbered and replayed after a reconnect
+DURABLE_EVENTS = frozenset({"message.new", "message.status", "chat.read.update", "chat.member.added"})
+
+# Frames are built with "type" as their first key
+_LEADING_TYPE = re.compile(r'\{\s*"type":\s*"([^"\\]*)"')
+
+
+def event_type(message: str) -> Optional[str]:
+    """The "type" of a JSON object frame (None if it has none)."""
+    match = _LEADING_TYPE.match(message)
+    if match is not None:
+        return match.group(1)
+    try:
+        payload = json.loads(message)
+    except ValueError:
+        return None
+    return payload.get("type") if isinstance(payload, dict) else None
+
+
+def is_durable(message: str) -> bool:
+    return event_type(message) in DURABLE_EVENTS
+
+
+class UserEvents:
+    """Sequence counter and ring buffer of one user's recent frames."""
+
+    __slots__ = ("seq", "frames")
+
+    def __init__(self, size: int):
+        self.seq = 0
+        # (seq, frame) pairs, oldest first
+        self.frames: Deque[Tuple[int, str]] = deque(maxlen=size)
+
+
+class EventLog:
+    """Numbers and remembers the events of the users connected to this worker."""
+
+    def __init__(self, size: int = WS_REPLAY_BUFFER, ttl: float = WS_REPLAY_TTL):
+        self.size = size
+        self.ttl = ttl
+        # Identifies this log: sequence numbers from another stream mean nothing here
+        self.stream = secrets.token_hex(6)
+        # Dict[user_id, UserEvents] - users with a socket here, or who had one within ttl
+        self.users: Dict[int, UserEvents] = {}
+        # Dict[user_id, detached at] - users with no socket left, oldest first
+        self._detached: "OrderedDict[int, float]" = OrderedDict()
+        self.stats = {"stamped": 0, "replays": 0, "replayed": 0, "resyncs": 0}
+
+    def attach(self, user_id: int):
+        """The user's first socket connected: keep (or start) their buffer."""
+        self._detached.pop(user_id, None)
+        if user_id not in self.users:
+            self.users[user_id] = UserEvents(self.size)
+
+    def detach(self, user_id: int):
+        """The user's last socket went away: their buffer expires after ttl."""
+        if user_id in self.users:
+            self._detached[user_id] = time.monotonic()
+            self._detached.move_to_end(user_id)
+        self.expire()
+
+    def expire(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._detached:
+            user_id, detached_at = next(iter(self._detached.items()))
+            if detached_at > cutoff:
+                break
+            del self._detached[user_id]
+            self.users.pop(user_id, None)
+
+    def tracks(self, user_id: int) -> bool:
+        return user_id in self.users
+
+    def stamp(self, user_id: int, message: str) -> str:
+        """
+        Give a durable event frame the user's next sequence number and remember it.
+        Ephemeral events, and frames for users without a buffer (never connected
+        here), go out unchanged.
+        """
+        events = self.users.get(user_id)
+        if events is None or not message.startswith("{") or not is_durable(message):
+            return message
+        events.seq += 1
+        body = message[1:].lstrip()
+        frame = f'{{"seq": {events.seq}' + (", " + body if body != "}" else "}")
+        events.frames.append((events.seq, frame))
+        self.stats["stamped"] += 1
+        return frame
+
+    def last_seq(self, user_id: int) -> int:
+        events = self.users.get(user_id)
+        return events.seq if events is not None else 0
+
+    def since(self, user_id: int, stream: Optional[str], last_seq: int) -> Optional[List[str]]:
+        """Frames after last_seq, or None if they can't all be replayed (client must resync)."""
+        events = self.users.get(user_id)
+        missing = None
+        if stream == self.stream and events is not None and 0 <= last_seq <= events.seq:
+            if last_seq == events.seq:
+                missing = []
+            elif events.frames and events.frames[0][0] <= last_seq + 1:
+                missing = [frame for seq, frame in events.frames if seq > last_seq]
+        if missing is None:
+            self.stats["resyncs"] += 1
+        else:
+            self.stats["replays"] += 1
+            self.stats["replayed"] += len(missing)
+        return missing
+
+    def get_stats(self) -> dict:
+        return {"stream": self.stream, "size": self.size, "users": len(self.users),
+                "detached": len(self._detached), **self.stats}
@@ -0,0 +1,160 @@
+# heartbeat.py
+"""
+Server-driven liveness for WebSocket connections.
+
+Every inbound frame marks its socket as active (touch(), a dict write). Sockets
+sit in a timing wheel: one slot per tick, so each tick only looks at the
+sockets due in that slot, no matter how many are connected. When a socket comes
+due:
+- if it was active since it was scheduled, it is rescheduled for later;
+- after WS_PING_AFTER idle seconds the server sends it {"type": "ping"}, which
+  clients answer with {"type": "pong"};
+- after WS_IDLE_TIMEOUT idle seconds (no pong either) it is half-open or
+  gone: it is removed from every ConnectionManager index and closed with
+  CLOSE_IDLE_TIMEOUT, so broadcasts stop queueing frames for it.
+
+Protocol-level ping frames are not visible to ASGI apps; uvicorn sends those
+itself (--ws-ping-interval / --ws-ping-timeout).
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Set
+
+from fastapi import WebSocket
+
+from connection_manager import ConnectionManager
+
+logger = logging.getLogger("websocket")
+
+# Idle seconds before the server pings a socket
+WS_PING_AFTER = float(os.getenv("WS_PING_AFTER", "45"))
+# Idle seconds before a socket is considered dead and reaped
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "90"))
+# Seconds per timing wheel slot (reaping happens up to one tick late)
+WS_HEARTBEAT_TICK = float(os.getenv("WS_HEARTBEAT_TICK", "1"))
+
+# Close code for reaped sockets (application range: clients reconnect)
+CLOSE_IDLE_TIMEOUT = 4408
+
+
+class TimingWheel:
+    """
+    Hashed timing wheel: schedule() and cancel() are O(1), and advance() returns
+    the keys of the next slot. Delays longer than the wheel are capped to it;
+    callers reschedule whatever is not due yet.
+    """
+
+    def __init__(self, tick: float, slots: int):
+        self.tick = tick
+        self.slots: List[Set[Hashable]] = [set() for _ in range(slots)]
+        self.position = 0
+        # Dict[key, slot index]
+        self._slot_of: Dict[Hashable, int] = {}
+
+    def __len__(self):
+        return len(self._slot_of)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._slot_of
+
+    def schedule(self, key: Hashable, delay: float):
+        self.cancel(key)
+        ticks = min(max(1, math.ceil(delay / self.tick)), len(self.slots) - 1)
+        slot = (self.position + ticks) % len(self.slots)
+        self.slots[slot].add(key)
+        self._slot_of[key] = slot
+
+    def cancel(self, key: Hashable):
+        slot = self._slot_of.pop(key, None)
+        if slot is not None:
+            self.slots[slot].discard(key)
+
+    def advance(self) -> Set[Hashable]:
+        """Move one tick forward and return the keys that came due."""
+        self.position = (self.position + 1) % len(self.slots)
+        due, self.slots[self.position] = self.slots[self.position], set()
+        for key in due:
+            del self._slot_of[key]
+        return due
+
+
+class HeartbeatService:
+    """Pings idle sockets and reaps the ones that stay silent."""
+
+    def __init__(self, manager: ConnectionManager, ping_after: float = WS_PING_AFTER,
+                 idle_timeout: float = WS_IDLE_TIMEOUT, tick: float = WS_HEARTBEAT_TICK,
+                 clock: Callable[[], float] = time.monotonic):
+        self.manager = manager
+        self.clock = clock
+        self.ping_after = min(ping_after, idle_timeout)
+        self.idle_timeout = idle_timeout
+        self.wheel = TimingWheel(tick, math.ceil(idle_timeout / tick) + 2)
+        # Dict[WebSocket, clock() time of the last inbound frame]
+        self.last_activity: Dict[WebSocket, float] = {}
+        # Sockets pinged since their last activity
+        self._pinged: Set[WebSocket] = set()
+        self._task: Optional[asyncio.Task] = None
+        # Counters exposed through the admin stats endpoint
+        self.stats = {"pings": 0, "reaped": 0, "ticks": 0}
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.wheel.tick)
+            try:
+                await self.tick()
+            except Exception as e:
+                logger.error(f"Heartbeat tick failed: {e}", exc_info=True)
+
+    def track(self, websocket: WebSocket):
+        """Start watching a registered socket."""
+        self.touch(websocket)
+        self.wheel.schedule(websocket, self.ping_after)
+
+    def touch(self, websocket: WebSocket):
+        """The socket sent something; it is alive."""
+        self.last_activity[websocket] = self.clock()
+        self._pinged.discard(websocket)
+
+    def forget(self, websocket: WebSocket):
+        self.wheel.cancel(websocket)
+        self.last_activity.pop(websocket, None)
+        self._pinged.discard(websocket)
+
+    async def tick(self):
+        self.stats["ticks"] += 1
+        now = self.clock()
+        for websocket in self.wheel.advance():
+            if websocket not in self.manager.outboxes:
+                # Disconnected normally; nothing to watch any more
+                self.forget(websocket)
+                continue
+            idle = now - self.last_activity.get(websocket, now)
+            if idle >= self.idle_timeout:
+                self.forget(websocket)
+                self.stats["reaped"] += 1
+                logger.info(f"Reaping idle WebSocket ({idle:.0f}s without a frame)")
+                await self.manager.evict(websocket, CLOSE_IDLE_TIMEOUT, "Idle timeout")
+            elif idle >= self.ping_after:
+                if websocket not in self._pinged:
+                    self._pinged.add(websocket)
+                    self.stats["pings"] += 1
+                    await self.manager.send_personal(websocket, json.dumps({"type": "ping"}))
+                self.wheel.schedule(websocket, self.idle_timeout - idle)
+            else:
+                self.wheel.schedule(websocket, self.ping_after - idle)
+
+    def get_stats(self) -> dict:
+        return {"tracked": len(self.wheel), "ping_after": self.ping_after,
+                "idle_timeout": self.idle_timeout, **self.stats}
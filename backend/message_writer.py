@@ -0,0 +1,261 @@
+# message_writer.py
+"""
+Group-commit writer for chat messages.
+
+message.send handlers from every socket submit their message here instead of
+committing it themselves. The writer collects submissions for up to
+WS_WRITE_BATCH_MS milliseconds (or until WS_WRITE_BATCH_SIZE are waiting) and
+inserts them in one transaction, so a busy chat costs a few commits per second
+instead of one commit (and, on SQLite, one fsync) per message. Each submitter
+still gets back its own Message with the assigned id.
+
+Sends carrying a client_msg_id are idempotent: a retry of a message that is
+already stored (found in a small LRU of recent ids, in flight, or rejected by
+the unique (sender_id, client_msg_id) index) raises DuplicateMessage with the
+original id instead of writing it again.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from crud import chat_summary_update, unread_increment
+from models import Message
+
+logger = logging.getLogger("websocket")
+
+# Longest time a message waits for others to share its commit
+WS_WRITE_BATCH_MS = float(os.getenv("WS_WRITE_BATCH_MS", "5"))
+# Commit right away once this many messages are waiting
+WS_WRITE_BATCH_SIZE = int(os.getenv("WS_WRITE_BATCH_SIZE", "100"))
+# How many recent (sender_id, client_msg_id) -> message id entries to remember
+WS_DEDUPE_CACHE_SIZE = int(os.getenv("WS_DEDUPE_CACHE_SIZE", "10000"))
+
+
+class DuplicateMessage(Exception):
+    """The message was already stored under the same client_msg_id."""
+
+    def __init__(self, message_id: int):
+        super().__init__(f"Duplicate of message {message_id}")
+        self.message_id = message_id
+
+
+class RecentClientIds:
+    """LRU of (sender_id, client_msg_id) -> stored message id."""
+
+    def __init__(self, max_size: int = WS_DEDUPE_CACHE_SIZE):
+        self.max_size = max_size
+        self._ids: "OrderedDict[Tuple[int, str], int]" = OrderedDict()
+
+    def get(self, key: Tuple[int, str]) -> Optional[int]:
+        message_id = self._ids.get(key)
+        if message_id is not None:
+            self._ids.move_to_end(key)
+        return message_id
+
+    def add(self, key: Tuple[int, str], message_id: int):
+        self._ids[key] = message_id
+        self._ids.move_to_end(key)
+        while len(self._ids) > self.max_size:
+            self._ids.popitem(last=False)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+@dataclass
+class PendingMessage:
+    message: Message
+    future: asyncio.Future = field(repr=False)
+
+
+class MessageWriter:
+    """Batches message inserts from all sockets into shared transactions."""
+
+    def __init__(self, session_factory: Callable, max_delay_ms: float = WS_WRITE_BATCH_MS,
+                 max_batch: int = WS_WRITE_BATCH_SIZE, dedupe_size: int = WS_DEDUPE_CACHE_SIZE):
+        # Returns a new AsyncSession (database.async_session)
+        self.session_factory = session_factory
+        self.max_delay = max_delay_ms / 1000
+        self.max_batch = max_batch
+        self.recent = RecentClientIds(dedupe_size)
+        # (sender_id, client_msg_id) of sends still being written, so a fast retry waits for the first
+        self._in_flight: Dict[Tuple[int, str], asyncio.Future] = {}
+        self._pending: List[PendingMessage] = []
+        self._wakeup = asyncio.Event()
+        self._full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        # Counters exposed through the admin stats endpoint
+        self.stats = {"messages": 0, "commits": 0, "largest_batch": 0, "batch_failures": 0, "duplicates": 0}
+
+    async def start(self):
+        self._closing = False
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the writer after committing whatever is still waiting."""
+        task, self._task = self._task, None
+        if task is not None:
+            self._closing = True
+            self._wakeup.set()
+            self._full.set()
+            await task
+
+    async def submit(
+        self,
+        chat_id: int,
+        sender_id: Optional[int],
+        msg_type: str,
+        text: Optional[str] = None,
+        media_url: Optional[str] = None,
+        client_msg_id: Optional[str] = None
+    ) -> Message:
+        """
+        Queue a message and wait until its batch is committed. Returns the stored Message.
+        Raises DuplicateMessage if (sender_id, client_msg_id) was already stored.
+        """
+        key = (sender_id, client_msg_id) if client_msg_id else None
+        if key is not None:
+            message_id = self.recent.get(key)
+            if message_id is None and key in self._in_flight:
+                # A retry racing the original: wait for the original's outcome
+                try:
+                    message_id = (await asyncio.shield(self._in_flight[key])).id
+                except Exception:
+                    # The original failed, so this retry gets its own attempt
+                    message_id = self.recent.get(key)
+            if message_id is not None:
+                self.stats["duplicates"] += 1
+                raise DuplicateMessage(message_id)
+
+        message = Message(chat_id=chat_id, sender_id=sender_id, type=msg_type, text=text,
+                          media_url=media_url, client_msg_id=client_msg_id)
+        future = asyncio.get_running_loop().create_future()
+        if key is not None:
+            self._in_flight[key] = future
+        try:
+            if self._task is None:
+                # Not started (e.g. scripts/tests without the app's startup event): write it alone
+                try:
+                    await self._write_one(message)
+                    future.set_result(message)
+                except Exception as e:
+                    future.set_exception(e)
+            else:
+                self._pending.append(PendingMessage(message, future))
+                self._wakeup.set()
+                if len(self._pending) >= self.max_batch:
+                    self._full.set()
+            message = await future
+        except IntegrityError:
+            # Stored before this process saw it (e.g. sent to another worker or before a restart)
+            existing_id = await self._find_existing(key) if key is not None else None
+            if existing_id is None:
+                raise
+            self.recent.add(key, existing_id)
+            self.stats["duplicates"] += 1
+            raise DuplicateMessage(existing_id)
+        finally:
+            if key is not None and self._in_flight.get(key) is future:
+                del self._in_flight[key]
+
+        if key is not None:
+            self.recent.add(key, message.id)
+        return message
+
+    def _take(self) -> List[PendingMessage]:
+        batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+        if len(self._pending) < self.max_batch:
+            self._full.clear()
+        if not self._pending:
+            self._wakeup.clear()
+        return batch
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            # Give other sockets a moment to join this commit
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_delay)
+            except asyncio.TimeoutError:
+                pass
+            await self._write(self._take())
+            if self._closing and not self._pending:
+                return
+
+    async def _write(self, batch: List[PendingMessage]):
+        if not batch:
+            return
+        try:
+            async with self.session_factory() as db:
+                db.add_all([pending.message for pending in batch])
+                await self._update_chats(db, [pending.message for pending in batch])
+                await db.commit()
+            self.stats["commits"] += 1
+        except Exception as e:
+            # One bad row (e.g. unknown chat) must not fail everyone else's message
+            logger.warning(f"Batched insert of {len(batch)} messages failed ({e}), retrying one by one")
+            self.stats["batch_failures"] += 1
+            for pending in batch:
+                message = Message(
+                    chat_id=pending.message.chat_id, sender_id=pending.message.sender_id,
+                    type=pending.message.type, text=pending.message.text, media_url=pending.message.media_url,
+                    client_msg_id=pending.message.client_msg_id
+                )
+                try:
+                    await self._write_one(message)
+                    self._resolve(pending, message)
+                except Exception as single_error:
+                    if not pending.future.done():
+                        pending.future.set_exception(single_error)
+            return
+
+        for pending in batch:
+            self._resolve(pending, pending.message)
+        self.stats["messages"] += len(batch)
+        self.stats["largest_batch"] = max(self.stats["largest_batch"], len(batch))
+
+    async def _write_one(self, message: Message):
+        async with self.session_factory() as db:
+            db.add(message)
+            await self._update_chats(db, [message])
+            await db.commit()
+        self.stats["commits"] += 1
+        self.stats["messages"] += 1
+
+    @staticmethod
+    async def _update_chats(db, messages: List[Message]):
+        """Advance each chat's last message, count and members' unread counters in the inserting transaction."""
+        await db.flush()
+        by_chat: Dict[int, List[Message]] = {}
+        for message in messages:
+            by_chat.setdefault(message.chat_id, []).append(message)
+        # Fixed order, so concurrent batches lock the chat rows the same way
+        for chat_id in sorted(by_chat):
+            newest = max(by_chat[chat_id], key=lambda m: m.id)
+            await db.execute(chat_summary_update(chat_id, newest.id, newest.created_at, len(by_chat[chat_id])))
+            unread = unread_increment(chat_id, [message.sender_id for message in by_chat[chat_id]])
+            if unread is not None:
+                await db.execute(unread)
+
+    async def _find_existing(self, key: Tuple[int, str]) -> Optional[int]:
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(Message.id).where(Message.sender_id == key[0], Message.client_msg_id == key[1])
+            )
+            return result.scalar()
+
+    @staticmethod
+    def _resolve(pending: PendingMessage, message: Message):
+        if not pending.future.done():
+            pending.future.set_result(message)
+
+    def get_stats(self) -> dict:
+        return {"pending": len(self._pending), "max_delay_ms": self.max_delay * 1000,
+                "max_batch": self.max_batch, "dedupe_cache": len(self.recent), **self.stats}
@@ -0,0 +1,190 @@
+# migrations.py
+"""
+Additive schema migrations, run on startup right after create_all().
+
+create_all() only creates missing tables, so a column added to models.py after
+the database was created has to be added here. Each entry is added with
+ALTER TABLE ... ADD COLUMN (works on SQLite, MySQL/MariaDB and PostgreSQL) and
+its backfill statement, if any, runs once in the same transaction. Indexes
+(including unique ones, which SQLite can't add as constraints) come after.
+
+Indexes are built without blocking writes where the database allows it:
+InnoDB builds them online by default, and on PostgreSQL they are created
+CONCURRENTLY (outside a transaction). Before a unique index is built, rows that
+would violate it are removed (the oldest row of each group is kept). A
+concurrent build that failed or was interrupted leaves an INVALID index behind
+under the same name; such an index enforces nothing, so it is dropped and built
+again.
+"""
+import logging
+from typing import List, Optional, Set, Tuple, Union
+
+from sqlalchemy import DateTime, inspect, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.types import TypeEngine
+
+logger = logging.getLogger("database")
+
+# Recomputes every chat's summary columns from messages (initial backfill and
+# rebuild_chat_summaries()); the write path keeps them current in between
+CHAT_SUMMARY_BACKFILL = """
+    UPDATE chats SET
+        message_count = (SELECT COUNT(*) FROM messages WHERE messages.chat_id = chats.id),
+        last_message_id = (SELECT MAX(messages.id) FROM messages WHERE messages.chat_id = chats.id),
+        last_message_at = (
+            SELECT newest.created_at FROM messages AS newest
+            WHERE newest.id = (SELECT MAX(messages.id) FROM messages WHERE messages.chat_id = chats.id)
+        )
+"""
+
+# Recomputes every member's unread_count (initial backfill and rebuild_unread_counts());
+# same rule as the counters: others' messages after the member's last_seen_at
+UNREAD_COUNT_BACKFILL = """
+    UPDATE chat_members SET unread_count = (
+        SELECT COUNT(*) FROM messages
+        WHERE messages.chat_id = chat_members.chat_id
+          AND messages.sender_id != chat_members.user_id
+          AND (chat_members.last_seen_at IS NULL OR messages.created_at > chat_members.last_seen_at)
+    )
+"""
+
+# (table, column, column DDL or a type (nullable, rendered for the database), backfill SQL or None)
+COLUMNS: List[Tuple[str, str, Union[str, TypeEngine], Optional[str]]] = [
+    (
+        "chat_members", "last_read_message_id", "INTEGER NULL",
+        # Start the watermark at the newest message the member had marked read
+        # under the old per-message read receipts
+        """
+        UPDATE chat_members SET last_read_message_id = (
+            SELECT MAX(message_status.message_id)
+            FROM message_status JOIN messages ON messages.id = message_status.message_id
+            WHERE messages.chat_id = chat_members.chat_id
+              AND message_status.user_id = chat_members.user_id
+              AND message_status.read_at IS NOT NULL
+        )
+        """
+    ),
+    ("messages", "client_msg_id", "VARCHAR(64) NULL", None),
+    ("chats", "last_message_id", "INTEGER NULL", None),
+    ("chats", "last_message_at", DateTime(), None),
+    # Added last of the three, so its backfill fills all of them
+    ("chats", "message_count", "INTEGER NOT NULL DEFAULT 0", CHAT_SUMMARY_BACKFILL),
+    ("chat_members", "unread_count", "INTEGER NOT NULL DEFAULT 0", UNREAD_COUNT_BACKFILL),
+]
+
+# (table, index name, columns, unique)
+INDEXES: List[Tuple[str, str, Tuple[str, ...], bool]] = [
+    ("messages", "uq_messages_sender_client_msg", ("sender_id", "client_msg_id"), True),
+    ("messages", "ix_messages_chat_id_id", ("chat_id", "id"), False),
+    ("messages", "ix_messages_chat_created", ("chat_id", "created_at"), False),
+    ("chat_members", "uq_chat_members_chat_user", ("chat_id", "user_id"), True),
+    ("chat_members", "ix_chat_members_user_chat", ("user_id", "chat_id"), False),
+    ("message_status", "uq_message_status_message_user", ("message_id", "user_id"), True),
+]
+
+# Unique index name -> statement removing the duplicates that would make it fail
+# (the derived table keeps MySQL from rejecting a subquery on the table being deleted from)
+DEDUPLICATE = {
+    "uq_chat_members_chat_user": """
+        DELETE FROM chat_members WHERE id NOT IN (
+            SELECT id FROM (SELECT MIN(id) AS id FROM chat_members GROUP BY chat_id, user_id) AS keep
+        )
+    """,
+    "uq_message_status_message_user": """
+        DELETE FROM message_status WHERE id NOT IN (
+            SELECT id FROM (SELECT MIN(id) AS id FROM message_status GROUP BY message_id, user_id) AS keep
+        )
+    """,
+}
+
+
+def _invalid_indexes(engine: Engine) -> Set[str]:
+    """Names of PostgreSQL indexes left INVALID by a failed CREATE INDEX CONCURRENTLY."""
+    if engine.dialect.name != "postgresql":
+        return set()
+    with engine.connect() as conn:
+        return set(conn.execute(text(
+            "SELECT index_class.relname FROM pg_index"
+            " JOIN pg_class AS index_class ON index_class.oid = pg_index.indexrelid"
+            " JOIN pg_namespace ON pg_namespace.oid = index_class.relnamespace"
+            " WHERE NOT pg_index.indisvalid AND pg_namespace.nspname = current_schema()"
+        )).scalars())
+
+
+def _has_valid_index(engine: Engine, table: str, name: str) -> bool:
+    return name in {index["name"] for index in inspect(engine).get_indexes(table)} \
+        and name not in _invalid_indexes(engine)
+
+
+def run_migrations(engine: Engine) -> List[str]:
+    """Add any missing columns and indexes. Returns the "table.column" / index names added."""
+    added = []
+    inspector = inspect(engine)
+    tables = set(inspector.get_table_names())
+    for table, column, ddl, backfill in COLUMNS:
+        if table not in tables:
+            continue
+        if column in {col["name"] for col in inspector.get_columns(table)}:
+            continue
+        if not isinstance(ddl, str):
+            ddl = f"{ddl.compile(dialect=engine.dialect)} NULL"
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}"))
+                if backfill:
+                    conn.execute(text(backfill))
+        except Exception as e:
+            # Another worker may have added it first; anything else is worth a warning
+            if column in {col["name"] for col in inspect(engine).get_columns(table)}:
+                continue
+            logger.warning(f"Could not add {table}.{column}: {e}")
+            continue
+        logger.info(f"Migration completed: added {table}.{column}")
+        added.append(f"{table}.{column}")
+
+    invalid = _invalid_indexes(engine)
+    for table, name, columns, unique in INDEXES:
+        if table not in tables:
+            continue
+        if name in {index["name"] for index in inspector.get_indexes(table)} and name not in invalid:
+            continue
+        concurrently = "CONCURRENTLY " if engine.dialect.name == "postgresql" else ""
+        try:
+            if name in invalid:
+                logger.warning(f"Index {name} is invalid (interrupted concurrent build), rebuilding it")
+                with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                    conn.execute(text(f"DROP INDEX {concurrently}IF EXISTS {name}"))
+            if name in DEDUPLICATE:
+                with engine.begin() as conn:
+                    removed = conn.execute(text(DEDUPLICATE[name])).rowcount
+                if removed:
+                    logger.warning(f"Removed {removed} duplicate rows from {table} before creating {name}")
+            with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+                conn.execute(text(
+                    f"CREATE {'UNIQUE ' if unique else ''}INDEX {concurrently}{name} ON {table} ({', '.join(columns)})"
+                ))
+        except Exception as e:
+            # Another worker may have built it first (a failed build of ours may have left it invalid)
+            if _has_valid_index(engine, table, name):
+                continue
+            logger.warning(f"Could not create index {name}: {e}")
+            continue
+        logger.info(f"Migration completed: created index {name}")
+        added.append(name)
+    return added
+
+
+def rebuild_chat_summaries(engine: Engine) -> int:
+    """Recompute every chat's message_count / last_message_* from messages. Returns chats updated."""
+    with engine.begin() as conn:
+        updated = conn.execute(text(CHAT_SUMMARY_BACKFILL)).rowcount
+    logger.info(f"Rebuilt summary columns of {updated} chats")
+    return updated
+
+
+def rebuild_unread_counts(engine: Engine) -> int:
+    """Recompute every member's unread_count from messages. Returns members updated."""
+    with engine.begin() as conn:
+        updated = conn.execute(text(UNREAD_COUNT_BACKFILL)).rowcount
+    logger.info(f"Rebuilt unread counts of {updated} chat members")
+    return updated
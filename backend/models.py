@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base  # <- import Base from database.py
@@ -29,6 +29,11 @@ class Chat(Base):
     type = Column(String(16), nullable=False)  # "direct" or "group"
     title = Column(String(128), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # Summary of the newest message, kept up to date in the transaction inserting
+    # messages (crud.chat_summary_update) so the chat list never reads messages
+    last_message_id = Column(Integer, nullable=True)
+    last_message_at = Column(DateTime, nullable=True)
+    message_count = Column(Integer, nullable=False, default=0)
 
     members = relationship("ChatMember", back_populates="chat")
     messages = relationship("Message", back_populates="chat")
@@ -44,11 +49,23 @@ class ChatMember(Base):
     chat_id = Column(Integer, ForeignKey("chats.id"), nullable=False)
     user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
     last_seen_at = Column(DateTime, nullable=True)
+    # Read watermark: every message in the chat with id <= this has been read by the member
+    last_read_message_id = Column(Integer, nullable=True)
     active_chat_id = Column(Integer, nullable=True)
+    # Others' messages after last_seen_at, counted as they are stored (crud.unread_increment)
+    # and recounted when last_seen_at moves (crud.unread_recount)
+    unread_count = Column(Integer, nullable=False, default=0)
 
     chat = relationship("Chat", back_populates="members")
     user = relationship("User", back_populates="chats")
 
+    __table_args__ = (
+        # One membership per user and chat; also serves every lookup by chat
+        Index("uq_chat_members_chat_user", "chat_id", "user_id", unique=True),
+        # A user's chats (chat list, presence peers)
+        Index("ix_chat_members_user_chat", "user_id", "chat_id"),
+    )
+
 
 # -------------------------------
 # MESSAGES
@@ -62,12 +79,22 @@ class Message(Base):
     type = Column(String(16), nullable=False)  # "text", "media", or "system"
     text = Column(String(1024), nullable=True)
     media_url = Column(String(1024), nullable=True)
+    # Sender-chosen id for message.send retries; unique per sender so a resend can't create a duplicate
+    client_msg_id = Column(String(64), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
     chat = relationship("Chat", back_populates="messages")
     sender = relationship("User", back_populates="messages")
     statuses = relationship("MessageStatus", back_populates="message")
 
+    __table_args__ = (
+        Index("uq_messages_sender_client_msg", "sender_id", "client_msg_id", unique=True),
+        # Keyset pagination of a chat's history (crud.get_chat_history)
+        Index("ix_messages_chat_id_id", "chat_id", "id"),
+        # Newest message per chat and unread counts (messages after a member's last_seen_at)
+        Index("ix_messages_chat_created", "chat_id", "created_at"),
+    )
+
 
 # -------------------------------
 # MESSAGE STATUS
@@ -83,3 +110,8 @@ class MessageStatus(Base):
 
     message = relationship("Message", back_populates="statuses")
     user = relationship("User", back_populates="message_statuses")
+
+    __table_args__ = (
+        # One receipt per user and message
+        Index("uq_message_status_message_user", "message_id", "user_id", unique=True),
+    )
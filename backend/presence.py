@@ -0,0 +1,197 @@
+# presence.py
+"""
+In-memory presence (online / offline / last active) pushed over the existing
+WebSocket as `presence.update` frames.
+
+Changes are collected and flushed every WS_PRESENCE_INTERVAL seconds as one
+frame per interested user, so a burst of connects and disconnects (a reconnect
+storm, a tab reload) costs one frame per peer instead of one per change, and a
+user who drops and comes back within the interval causes no frame at all.
+Nothing is written to the database.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from fastapi import WebSocket
+from starlette.concurrency import run_in_threadpool
+
+from connection_manager import ConnectionManager
+
+logger = logging.getLogger("websocket")
+
+# Seconds between presence.update flushes
+WS_PRESENCE_INTERVAL = float(os.getenv("WS_PRESENCE_INTERVAL", "0.5"))
+# Seconds a user's list of chat peers is cached
+WS_PRESENCE_PEERS_TTL = float(os.getenv("WS_PRESENCE_PEERS_TTL", "30"))
+
+CHANNEL_PRESENCE = "presence"
+
+
+class PresenceService:
+    """
+    Tracks which users are online on any worker and tells their chat peers.
+    Each worker learns about the others' users over the backplane and only
+    sends frames to the sockets it holds itself.
+    """
+
+    def __init__(self, manager: ConnectionManager, peers_loader: Callable[[int], Iterable[int]],
+                 interval: float = WS_PRESENCE_INTERVAL, peers_ttl: float = WS_PRESENCE_PEERS_TTL):
+        self.manager = manager
+        # user_id -> ids of users sharing a chat with them; awaited if async, else run in the threadpool
+        self.peers_loader = peers_loader
+        self.interval = interval
+        self.peers_ttl = peers_ttl
+        # Dict[user_id, Set[node_id]] - workers holding at least one socket of the user
+        self.nodes_by_user: Dict[int, Set[str]] = {}
+        # Dict[user_id, unix time] - last connect, disconnect or activity seen
+        self.last_active: Dict[int, float] = {}
+        # Users whose state changed since the last flush
+        self._dirty: Set[int] = set()
+        # Online users as last told to their peers (so flapping within one interval sends nothing)
+        self._announced: Set[int] = set()
+        # Dict[user_id, (expires_at, peer ids)]
+        self._peers: Dict[int, Tuple[float, Set[int]]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.stats = {"flushes": 0, "updates": 0, "frames": 0}
+
+        manager.add_user_listener(self._on_local_change)
+        manager.add_membership_listener(lambda chat_id: self.invalidate_peers())
+        manager.add_channel_handler(CHANNEL_PRESENCE, self._on_remote_change)
+
+    async def start(self):
+        """Start flushing; call after manager.start(). Asks the other workers who they hold."""
+        self._task = asyncio.create_task(self._run())
+        await self.manager.publish(CHANNEL_PRESENCE, {"hello": True})
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        # Tell the other workers that the users held here are gone
+        now = time.time()
+        for user_id in list(self.manager.user_connections):
+            await self.manager.publish(CHANNEL_PRESENCE, {"user_id": user_id, "online": False, "last_active": now})
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Presence flush failed: {e}", exc_info=True)
+
+    # -------------------------------
+    # STATE
+    # -------------------------------
+    def is_online(self, user_id: int) -> bool:
+        return bool(self.nodes_by_user.get(user_id))
+
+    def status(self, user_id: int) -> dict:
+        last_active = self.last_active.get(user_id)
+        return {
+            "user_id": user_id,
+            "online": self.is_online(user_id),
+            "last_active": datetime.utcfromtimestamp(last_active).isoformat() if last_active else None,
+        }
+
+    def touch(self, user_id: int):
+        """Record activity (any frame from the user). Memory only, never sent on its own."""
+        self.last_active[user_id] = time.time()
+
+    def _on_local_change(self, user_id: int, online: bool):
+        now = time.time()
+        self._apply(self.manager.node_id, user_id, online, now)
+        self.manager.publish_soon(CHANNEL_PRESENCE, {"user_id": user_id, "online": online, "last_active": now})
+
+    async def _on_remote_change(self, payload: dict):
+        node = payload["origin"]
+        if payload.get("hello"):
+            # A worker just started: tell it who is online here
+            await self.manager.publish(CHANNEL_PRESENCE, {
+                "users": [[user_id, self.last_active.get(user_id, 0)] for user_id in self.manager.user_connections]
+            })
+        elif "users" in payload:
+            for user_id, last_active in payload["users"]:
+                self._apply(node, user_id, True, last_active)
+        else:
+            self._apply(node, payload["user_id"], payload["online"], payload["last_active"])
+
+    def _apply(self, node: str, user_id: int, online: bool, last_active: float):
+        nodes = self.nodes_by_user.setdefault(user_id, set())
+        if online:
+            nodes.add(node)
+        else:
+            nodes.discard(node)
+            if not nodes:
+                del self.nodes_by_user[user_id]
+        self.last_active[user_id] = max(self.last_active.get(user_id, 0), last_active)
+        self._dirty.add(user_id)
+
+    # -------------------------------
+    # DELIVERY
+    # -------------------------------
+    async def get_peers(self, user_id: int) -> Set[int]:
+        cached = self._peers.get(user_id)
+        if cached is not None and cached[0] > time.monotonic():
+            return cached[1]
+        if asyncio.iscoroutinefunction(self.peers_loader):
+            peers = set(await self.peers_loader(user_id))
+        else:
+            peers = set(await run_in_threadpool(self.peers_loader, user_id))
+        self._peers[user_id] = (time.monotonic() + self.peers_ttl, peers)
+        return peers
+
+    def invalidate_peers(self):
+        """Forget cached peer lists (called on every membership change, which is rare)."""
+        self._peers.clear()
+
+    async def flush(self):
+        """Send one presence.update frame per local user with at least one changed peer."""
+        dirty, self._dirty = self._dirty, set()
+        changed: List[int] = []
+        for user_id in dirty:
+            online = self.is_online(user_id)
+            if online == (user_id in self._announced):
+                continue
+            if online:
+                self._announced.add(user_id)
+            else:
+                self._announced.discard(user_id)
+            changed.append(user_id)
+        if not changed:
+            return
+
+        # Dict[recipient user_id, updates] - only users with a socket on this worker
+        batches: Dict[int, List[dict]] = {}
+        for user_id in changed:
+            update = self.status(user_id)
+            for peer in await self.get_peers(user_id):
+                if peer in self.manager.user_connections:
+                    batches.setdefault(peer, []).append(update)
+
+        self.stats["flushes"] += 1
+        self.stats["updates"] += len(changed)
+        for peer, updates in batches.items():
+            if self.manager.send_to_local_user(peer, json.dumps({"type": "presence.update", "users": updates})):
+                self.stats["frames"] += 1
+
+    async def send_snapshot(self, websocket: WebSocket, user_id: int):
+        """
+        Send a newly connected socket the state of the user's peers as of the last
+        flush, so the next flush's updates apply on top of it without gaps.
+        """
+        peers = await self.get_peers(user_id)
+        users = [
+            {**self.status(peer), "online": peer in self._announced}
+            for peer in sorted(peers) if peer in self.last_active
+        ]
+        if users:
+            await self.manager.send_personal(websocket, json.dumps({"type": "presence.update", "users": users}))
+
+    def get_stats(self) -> dict:
+        return {"online_users": len(self.nodes_by_user), "interval": self.interval, **self.stats}
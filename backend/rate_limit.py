@@ -0,0 +1,138 @@
+# rate_limit.py
+"""
+Per-connection token buckets for inbound WebSocket events.
+
+Each socket gets one bucket per event type, checked right after the frame is
+parsed and before any database work, so a client flooding message.send,
+message.read or ping only slows itself down. An over-limit event is dropped and
+answered with an error frame carrying retry_after (seconds until the bucket
+has a token again); while a bucket stays empty only the first rejected event
+gets that frame, so the flood isn't echoed back.
+
+Limits come from WS_RATE_LIMITS as "event=rate/burst" pairs, rate in events per
+second, e.g. "message.send=5/20,ping=1/5". "*" covers every other event type.
+Pairs given there replace the matching defaults below; rate 0 disables the limit.
+"""
+import logging
+import os
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger("websocket")
+
+DEFAULT_LIMITS: Dict[str, Tuple[float, float]] = {
+    "message.send": (5, 20),
+    "message.read": (10, 30),
+    "chat.open": (5, 20),
+    "typing.start": (5, 10),
+    "typing.stop": (5, 10),
+    "ping": (1, 5),
+    "*": (20, 50),
+}
+
+
+def parse_limits(spec: str) -> Dict[str, Tuple[float, float]]:
+    """Parse WS_RATE_LIMITS ("event=rate/burst,...") on top of DEFAULT_LIMITS."""
+    limits = dict(DEFAULT_LIMITS)
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        event, _, value = item.partition("=")
+        rate, _, burst = value.partition("/")
+        try:
+            rate = float(rate)
+            limits[event.strip()] = (rate, float(burst) if burst else max(rate, 1))
+        except ValueError:
+            logger.warning(f"Ignoring invalid WS_RATE_LIMITS entry: {item!r}")
+    return limits
+
+
+WS_RATE_LIMITS = parse_limits(os.getenv("WS_RATE_LIMITS", ""))
+
+
+class TokenBucket:
+    """Refills `rate` tokens per second up to `burst`; each event takes one."""
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "notified")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        # Whether the client was already told about the current empty spell
+        self.notified = False
+
+    def take(self, now: float) -> float:
+        """Take a token. Returns 0 if one was available, else seconds until one is."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            self.notified = False
+            return 0
+        return (1 - self.tokens) / self.rate
+
+
+class ConnectionLimiter:
+    """The buckets of one socket, created on first use of each event type."""
+
+    def __init__(self, limiter: "RateLimiter"):
+        self.limiter = limiter
+        self.buckets: Dict[str, TokenBucket] = {}
+
+    def check(self, event: Optional[str]) -> Optional[dict]:
+        """
+        Account for one inbound event. Returns None if it may be handled, else the
+        error frame to send back (or {} when the client was already told).
+        """
+        key = event if event in self.limiter.limits else "*"
+        rate, burst = self.limiter.limits[key]
+        if rate <= 0:
+            return None
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = TokenBucket(rate, burst)
+
+        retry_after = bucket.take(time.monotonic())
+        if not retry_after:
+            self.limiter.stats["allowed"] += 1
+            return None
+
+        self.limiter.throttled(key)
+        if bucket.notified:
+            return {}
+        bucket.notified = True
+        return {
+            "type": "error",
+            "error": "Rate limit exceeded",
+            "code": "rate_limited",
+            "event": event,
+            "retry_after": round(retry_after, 3),
+        }
+
+
+class RateLimiter:
+    """Shared limits and throttle counters for every socket of this worker."""
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[float, float]]] = None):
+        self.limits = dict(limits if limits is not None else WS_RATE_LIMITS)
+        self.limits.setdefault("*", DEFAULT_LIMITS["*"])
+        self.stats = {"allowed": 0, "throttled": 0}
+        # Dict[event type, throttled count]
+        self.throttled_by_event: Dict[str, int] = {}
+
+    def for_connection(self) -> ConnectionLimiter:
+        return ConnectionLimiter(self)
+
+    def throttled(self, key: str):
+        self.stats["throttled"] += 1
+        self.throttled_by_event[key] = self.throttled_by_event.get(key, 0) + 1
+
+    def get_stats(self) -> dict:
+        return {
+            "limits": {event: {"rate": rate, "burst": burst} for event, (rate, burst) in self.limits.items()},
+            **self.stats,
+            "throttled_by_event": dict(self.throttled_by_event),
+        }
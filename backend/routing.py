@@ -0,0 +1,294 @@
+# routing.py
+"""
+Chat-affinity routing for multi-node deployments (enable with WS_ROUTING=true).
+
+Without routing every broadcast goes out on the shared "chat" channel, so every
+node wakes up for every message even if it holds none of the chat's members.
+With routing:
+- a consistent-hash ring maps user ids and chat ids onto the configured nodes;
+  GET /api/ws/route tells a client which node to open /api/ws on, so a user's
+  devices (and most members of a chat) end up together;
+- each node announces which users it holds on the "directory" channel, and a
+  broadcast is published only to the nodes holding at least one chat member
+  (each node listens on its own "node:<node_id>" channel).
+
+All nodes of a deployment must run with the same WS_ROUTING setting.
+"""
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set
+
+from connection_manager import CHANNEL_CHAT, CHANNEL_MEMBERSHIP, ConnectionManager
+
+logger = logging.getLogger("websocket")
+
+WS_ROUTING = os.getenv("WS_ROUTING", "false").lower() == "true"
+# Name of this node on the ring (defaults to a unique per-process id)
+WS_NODE_ID = os.getenv("WS_NODE_ID") or None
+# Nodes on the ring with the URL clients should use for them: "a=http://host:8001,b=http://host:8002"
+WS_NODES = os.getenv("WS_NODES", "")
+# Seconds between full re-announcements of the users a node holds (heals lost directory events)
+WS_DIRECTORY_REFRESH = float(os.getenv("WS_DIRECTORY_REFRESH", "30"))
+
+CHANNEL_DIRECTORY = "directory"
+
+
+def parse_nodes(spec: str) -> Dict[str, str]:
+    """Parse WS_NODES ("id=url,id=url") into {node_id: url}."""
+    nodes = {}
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        node_id, _, url = item.partition("=")
+        nodes[node_id.strip()] = url.strip().rstrip("/")
+    return nodes
+
+
+def node_channel(node_id: str) -> str:
+    return f"node:{node_id}"
+
+
+class HashRing:
+    """
+    Consistent-hash ring with virtual nodes: adding or removing a node only
+    moves the keys that node owns, the rest keep their placement.
+    """
+
+    def __init__(self, nodes: Iterable[str] = (), replicas: int = 100):
+        self.replicas = replicas
+        self.nodes: Set[str] = set()
+        # Sorted hash points and the node owning each point
+        self._points: List[int] = []
+        self._owners: Dict[int, str] = {}
+        for node in nodes:
+            self.add(node)
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def add(self, node: str):
+        if node in self.nodes:
+            return
+        self.nodes.add(node)
+        for replica in range(self.replicas):
+            point = self._hash(f"{node}#{replica}")
+            self._owners[point] = node
+            bisect.insort(self._points, point)
+
+    def remove(self, node: str):
+        if node not in self.nodes:
+            return
+        self.nodes.discard(node)
+        self._points = [p for p in self._points if self._owners[p] != node]
+        self._owners = {p: n for p, n in self._owners.items() if n != node}
+
+    def node_for(self, key: Hashable) -> Optional[str]:
+        """First node clockwise from the key's hash."""
+        if not self._points:
+            return None
+        index = bisect.bisect(self._points, self._hash(str(key))) % len(self._points)
+        return self._owners[self._points[index]]
+
+    def node_for_user(self, user_id: int) -> Optional[str]:
+        return self.node_for(f"user:{user_id}")
+
+    def node_for_chat(self, chat_id: int) -> Optional[str]:
+        return self.node_for(f"chat:{chat_id}")
+
+
+class NodeDirectory:
+    """
+    Which nodes currently hold at least one socket of each user, as announced
+    on the directory channel. Stale entries (e.g. a node that crashed without
+    saying goodbye) only cost an extra publish. A missing entry (a lost
+    "online" event) does cost deliveries: broadcasts from other nodes skip
+    that user's sockets until the next snapshot, at most WS_DIRECTORY_REFRESH
+    seconds later. The messages are stored either way and show up when the
+    chat history is loaded.
+    """
+
+    def __init__(self):
+        self.nodes_by_user: Dict[int, Set[str]] = {}
+        self.users_by_node: Dict[str, Set[int]] = {}
+
+    def add(self, node: str, user_id: int):
+        self.nodes_by_user.setdefault(user_id, set()).add(node)
+        self.users_by_node.setdefault(node, set()).add(user_id)
+
+    def remove(self, node: str, user_id: int):
+        nodes = self.nodes_by_user.get(user_id)
+        if nodes is not None:
+            nodes.discard(node)
+            if not nodes:
+                del self.nodes_by_user[user_id]
+        users = self.users_by_node.get(node)
+        if users is not None:
+            users.discard(user_id)
+
+    def drop_node(self, node: str):
+        for user_id in self.users_by_node.pop(node, set()):
+            self.remove(node, user_id)
+
+    def replace_node(self, node: str, user_ids: Iterable[int]):
+        """Apply a full snapshot of the users a node holds."""
+        self.drop_node(node)
+        for user_id in user_ids:
+            self.add(node, user_id)
+
+    def nodes_for(self, user_ids: Iterable[int]) -> Set[str]:
+        nodes: Set[str] = set()
+        for user_id in user_ids:
+            nodes.update(self.nodes_by_user.get(user_id, ()))
+        return nodes
+
+
+class RoutedConnectionManager(ConnectionManager):
+    """
+    ConnectionManager that publishes broadcasts and direct sends only to the
+    nodes holding a recipient, instead of to every node.
+    """
+
+    def __init__(self, *args, node_urls: Optional[Dict[str, str]] = None,
+                 refresh_interval: float = WS_DIRECTORY_REFRESH, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Dict[node_id, base URL] - the ring; defaults to just this node
+        self.node_urls = node_urls or {self.node_id: ""}
+        self.ring = HashRing(self.node_urls)
+        self.directory = NodeDirectory()
+        self.refresh_interval = refresh_interval
+        self._refresh_task: Optional[asyncio.Task] = None
+        self.routing_stats = {"routed_broadcasts": 0, "node_publishes": 0, "local_only": 0}
+        self.add_user_listener(self._announce)
+
+    @property
+    def node_channel(self) -> str:
+        return node_channel(self.node_id)
+
+    def backplane_channels(self) -> List[str]:
+        # The shared chat channel stays for broadcasts without a member list
+        # (legacy endpoint); the user channel is replaced by per-node channels
+        return [CHANNEL_CHAT, CHANNEL_MEMBERSHIP, CHANNEL_DIRECTORY, self.node_channel, *self._channel_handlers]
+
+    async def start(self):
+        await super().start()
+        if self.backplane is not None:
+            await self.publish(CHANNEL_DIRECTORY, {"op": "hello", "users": list(self.user_connections)})
+            self._refresh_task = asyncio.create_task(self._refresh())
+
+    async def stop(self):
+        if self._refresh_task is not None:
+            self._refresh_task.cancel()
+            self._refresh_task = None
+        await self.publish(CHANNEL_DIRECTORY, {"op": "bye"})
+        await super().stop()
+
+    async def _refresh(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            await self.publish(CHANNEL_DIRECTORY, {"op": "snapshot", "users": list(self.user_connections)})
+
+    def _announce(self, user_id: int, online: bool):
+        self.publish_soon(CHANNEL_DIRECTORY, {"op": "online" if online else "offline", "user_id": user_id})
+
+    async def _on_backplane_message(self, channel: str, payload: dict):
+        if payload.get("origin") == self.node_id:
+            return
+        if channel == CHANNEL_DIRECTORY:
+            await self._apply_directory(payload)
+        elif channel == self.node_channel:
+            if payload.get("kind") == "user":
+                self.send_to_local_user(payload["user_id"], payload["message"])
+            else:
+                await super()._on_backplane_message(CHANNEL_CHAT, payload)
+        else:
+            await super()._on_backplane_message(channel, payload)
+
+    async def _apply_directory(self, payload: dict):
+        node, op = payload["origin"], payload["op"]
+        if op == "online":
+            self.directory.add(node, payload["user_id"])
+        elif op == "offline":
+            self.directory.remove(node, payload["user_id"])
+        elif op == "bye":
+            self.directory.drop_node(node)
+        else:
+            self.directory.replace_node(node, payload["users"])
+            if op == "hello":
+                # Let the newcomer learn about the users held here
+                await self.publish(CHANNEL_DIRECTORY, {"op": "snapshot", "users": list(self.user_connections)})
+
+    async def _publish_to_nodes(self, nodes: Set[str], payload: dict):
+        nodes = nodes - {self.node_id}
+        self.routing_stats["node_publishes"] += len(nodes)
+        await asyncio.gather(*(self.publish(node_channel(node), payload) for node in sorted(nodes)))
+
+    async def broadcast(
+        self,
+        chat_id: int,
+        message: str,
+        get_chat_members_fn: Optional[Callable] = None,
+        coalesce_key: Optional[Hashable] = None
+    ):
+        """
+        Like ConnectionManager.broadcast, but only the other nodes the directory
+        lists for a member receive it (see NodeDirectory for what it can miss).
+        """
+        report = await self._deliver_chat(chat_id, message, get_chat_members_fn, coalesce_key)
+        payload = self._chat_payload(chat_id, message, get_chat_members_fn, coalesce_key)
+        member_ids = None
+        if get_chat_members_fn is not None:
+            try:
+                member_ids = await self.get_chat_member_ids(chat_id, get_chat_members_fn)
+            except Exception:
+                member_ids = None
+        if member_ids is None:
+            # Without a member list we can't tell which nodes care
+            await self.publish(CHANNEL_CHAT, payload)
+            return report
+
+        nodes = self.directory.nodes_for(member_ids) - {self.node_id}
+        self.routing_stats["routed_broadcasts"] += 1
+        if not nodes:
+            self.routing_stats["local_only"] += 1
+        await self._publish_to_nodes(nodes, {"kind": "chat", **payload})
+        return report
+
+    async def send_to_user(self, user_id: int, message: str):
+        delivered = self.send_to_local_user(user_id, message)
+        await self._publish_to_nodes(
+            self.directory.nodes_for([user_id]),
+            {"kind": "user", "user_id": user_id, "message": message}
+        )
+        return delivered
+
+    def route(self, user_id: int, chat_id: Optional[int] = None) -> dict:
+        """Where a user's sockets (and optionally a chat) belong on the ring."""
+        node = self.ring.node_for_user(user_id)
+        route = {"node": node, "url": self.node_urls.get(node) or None}
+        if chat_id is not None:
+            chat_node = self.ring.node_for_chat(chat_id)
+            route["chat_node"] = chat_node
+            route["chat_url"] = self.node_urls.get(chat_node) or None
+        return route
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        stats["routing"] = {
+            "node": self.node_id,
+            "ring": sorted(self.ring.nodes),
+            "directory_users": len(self.directory.nodes_by_user),
+            **self.routing_stats,
+        }
+        return stats
+
+
+def create_manager(backplane=None) -> ConnectionManager:
+    """Build the manager selected by WS_ROUTING / WS_NODE_ID / WS_NODES."""
+    if not WS_ROUTING:
+        return ConnectionManager(backplane=backplane, node_id=WS_NODE_ID)
+    return RoutedConnectionManager(backplane=backplane, node_id=WS_NODE_ID, node_urls=parse_nodes(WS_NODES))
@@ -60,7 +60,9 @@ class ChatOut(ChatBase):
     id: int
     created_at: datetime
     other_user_name: Optional[str] = None
+    other_user_id: Optional[int] = None
     unread_count: Optional[int] = 0  # Number of unread messages for the current user
+    last_message_at: Optional[datetime] = None  # Time of the newest message (creation time if none)
 
     model_config = ConfigDict(from_attributes=True)
 
@@ -70,6 +72,7 @@ class ChatOut(ChatBase):
 # -----------------------
 class ChatMemberBase(BaseModel):
     last_seen_at: Optional[datetime] = None
+    last_read_message_id: Optional[int] = None
     active_chat_id: Optional[int] = None
 
 
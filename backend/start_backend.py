@@ -1,11 +1,13 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, WebSocket, WebSocketDisconnect, APIRouter, Query, Request, BackgroundTasks
+from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, WebSocket, WebSocketDisconnect, APIRouter, Query, Request, Response, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 from sqlalchemy.orm import Session
-from sqlalchemy import desc
-from database import get_db, engine, Base, SessionLocal, DATABASE_URL
+from database import get_db, engine, Base, DATABASE_URL, async_session, dispose_async_engine
+import crud_async
+from migrations import run_migrations, rebuild_chat_summaries, rebuild_unread_counts
 from pathlib import Path
+from typing import Optional, Union
 from models import ChatMember
 from crud import (
     create_user,
@@ -18,16 +20,12 @@ from crud import (
     get_chat_members_with_users,
     remove_member_from_chat,
     create_message,
-    get_messages_for_chat,
-    list_chats_for_user,
+    get_chat_history,
+    list_chat_summaries,
     list_all_users,
     update_user,
     delete_user,
-    get_unread_count,
-    update_last_seen,
-    mark_messages_as_read,
-    get_message_status,
-    get_read_statuses_for_message
+    update_last_seen
 )
 from schema import (
     UserCreate, UserOut,
@@ -58,6 +56,18 @@ if 'connection_manager' in sys.modules:
 # Re-import to get the updated class
 import connection_manager
 ConnectionManager = connection_manager.ConnectionManager
+from backplane import create_backplane
+from routing import RoutedConnectionManager, create_manager
+from presence import PresenceService
+from typing_indicators import TypingService
+from heartbeat import HeartbeatService
+from admission import AdmissionController
+from message_writer import MessageWriter, DuplicateMessage
+from rate_limit import RateLimiter
+import wire
+from wire import FrameDecodeError, choose_codec
+from ws_events import (EventRegistry, WsContext, ChatOpen, MessageSend, MessageRead, TypingStart, TypingStop,
+                       Ping, Pong)
 # #region agent log
 import inspect
 reload_sig = inspect.signature(ConnectionManager.connect)
@@ -78,7 +88,6 @@ log_data = {
 with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
     f.write(__import__('json').dumps(log_data) + '\n')
 # #endregion
-from starlette.concurrency import run_in_threadpool
 
 # Load .env from root directory first (takes precedence), then backend/.env as fallback
 root_dir = Path(__file__).parent.parent
@@ -163,7 +172,44 @@ logging.getLogger('uvicorn.access').setLevel(logging.WARNING)
 active_sessions: dict[str, dict] = {}
 
 # Create manager instance after reload to ensure we use the latest class definition
-manager = ConnectionManager()
+# WS_BACKPLANE_URL selects how workers share broadcasts (memory://, sqlite:///file.db, redis://host:port);
+# WS_ROUTING=true publishes broadcasts only to the nodes holding chat members (see routing.py)
+manager = create_manager(backplane=create_backplane())
+
+async def load_chat_members(chat_id: int):
+    """Load chat members with a short-lived async session (membership index misses, relayed broadcasts)."""
+    async with async_session() as db:
+        return await crud_async.get_chat_members(db, chat_id)
+
+manager.members_loader = load_chat_members
+
+# Sessions live in memory per worker, so replicate logins/logouts over the backplane
+# to let a WebSocket land on a different worker than the one that handled the login
+async def apply_session_event(payload: dict):
+    if payload["op"] == "add":
+        active_sessions[payload["session_id"]] = payload["session"]
+    else:
+        active_sessions.pop(payload["session_id"], None)
+
+manager.add_channel_handler("sessions", apply_session_event)
+
+async def load_chat_peers(user_id: int):
+    """Users sharing a chat with user_id (who should see their presence)."""
+    async with async_session() as db:
+        return await crud_async.get_chat_peer_ids(db, user_id)
+
+# Online/offline state pushed to chat peers in batches (memory only, see presence.py)
+presence = PresenceService(manager, load_chat_peers)
+# typing.start / typing.stop handling (memory only, see typing_indicators.py)
+typing_indicators = TypingService(manager, load_chat_members)
+# message.send inserts from all sockets are committed together in small batches
+message_writer = MessageWriter(async_session)
+# Per-socket token buckets for inbound events (WS_RATE_LIMITS, see rate_limit.py)
+rate_limiter = RateLimiter()
+# Server pings for quiet /api/ws sockets; silent ones are closed (see heartbeat.py)
+heartbeat = HeartbeatService(manager)
+# Socket caps and handshake rate for this worker (see admission.py)
+admission = AdmissionController(manager)
 # #region agent log
 import inspect
 manager_sig = inspect.signature(manager.connect)
@@ -216,6 +262,21 @@ app = FastAPI(
     The WebSocket endpoint is available at `/api/ws` with the following query parameters:
     - `token`: JWT token (obtained from `/api/auth/login`)
     - `session_id`: Session ID (obtained from `/api/auth/login`)
+    - `stream`, `last_seq` (optional, when reconnecting): the `stream` of the previous
+      `session.ready` and the highest `seq` received; the events missed in between are
+      replayed right after `session.ready`
+    
+    A worker at capacity (`WS_MAX_SOCKETS` sockets, `WS_MAX_SOCKETS_PER_USER` per user, or more
+    than `WS_ACCEPT_RATE` handshakes per second) accepts the socket and closes it right away with
+    code `1013` and a reason like `Server busy, retry in 3.7s`; wait that long before reconnecting.
+    
+    Every event sent to you (everything except direct replies such as `session.ready`,
+    `message.ack`, `pong` and errors) carries a `seq` field, increasing by one per event.
+    
+    Frames are JSON text by default. Clients that offer the `wazzap.msgpack.v1` subprotocol
+    (`new WebSocket(url, ['wazzap.msgpack.v1', 'wazzap.json'])`) get binary MessagePack frames
+    both ways instead, with short field names (see `wire.py`) and without the duplicate
+    `content` / `timestamp` fields of `message.new`. The examples below use the JSON form.
     
     ### WebSocket Message Types
     
@@ -238,11 +299,14 @@ app = FastAPI(
       "sender_id": 1,
       "content": "Hello!",
       "msg_type": "text",
-      "media_url": null
+      "media_url": null,
+      "client_msg_id": "optional, unique per sender (e.g. a UUID)"
     }
     ```
+    Resending with the same `client_msg_id` (e.g. after a reconnect) is safe: the
+    message is not stored or broadcast again, you just get its `message.ack`.
     
-    **`message.read`** - Mark message as read
+    **`message.read`** - Mark the chat as read up to and including this message
     ```json
     {
       "type": "message.read",
@@ -251,6 +315,15 @@ app = FastAPI(
     }
     ```
     
+    **`typing.start`** / **`typing.stop`** - The user started/stopped typing in a chat
+    (resend `typing.start` every few seconds while typing; it expires otherwise)
+    ```json
+    {
+      "type": "typing.start",
+      "chat_id": 1
+    }
+    ```
+    
     **`ping`** - Keep-alive ping (sent every 30 seconds)
     ```json
     {
@@ -258,15 +331,41 @@ app = FastAPI(
     }
     ```
     
+    **`pong`** - Answer to a server `ping`
+    ```json
+    {
+      "type": "pong"
+    }
+    ```
+    
     #### Server → Client:
     
     **`session.ready`** - Connection established
     ```json
     {
       "type": "session.ready",
-      "session_id": "session-123"
+      "session_id": "session-123",
+      "node": "node-a",
+      "stream": "3f9a0c1b7e2d",
+      "seq": 42,
+      "resync": false,
+      "replayed": 3
+    }
+    ```
+    `replayed` missed events follow, up to `seq`. If `resync` is true they could not
+    be replayed (too many, too long ago, or another server): refetch chats and messages.
+    
+    **`message.ack`** - Your `message.send` was stored (sent only to you, before `message.new`)
+    ```json
+    {
+      "type": "message.ack",
+      "chat_id": 1,
+      "message_id": 123,
+      "client_msg_id": "optional id you sent with message.send",
+      "duplicate": false
     }
     ```
+    `duplicate` is true when the message was already stored by an earlier send.
     
     **`message.new`** - New message received
     ```json
@@ -290,15 +389,14 @@ app = FastAPI(
     }
     ```
     
-    **`message.read.update`** - Message read status update
+    **`chat.read.update`** - A member has read the chat up to a message (their read watermark).
+    Every message with `id <= up_to_message_id` not sent by `user_id` counts as read by them.
     ```json
     {
-      "type": "message.read.update",
+      "type": "chat.read.update",
       "chat_id": 1,
-      "message_id": 123,
-      "read_by": [2, 3],
-      "read_count": 2,
-      "read_by_user_id": 2
+      "user_id": 2,
+      "up_to_message_id": 123
     }
     ```
     
@@ -322,6 +420,28 @@ app = FastAPI(
     }
     ```
     
+    **`typing.update`** - A chat member started/stopped typing
+    ```json
+    {
+      "type": "typing.update",
+      "chat_id": 1,
+      "user_id": 2,
+      "typing": true,
+      "expires_in": 6
+    }
+    ```
+    
+    **`presence.update`** - Online state of chat peers (batched, sent at most every 500ms,
+    plus once right after connecting)
+    ```json
+    {
+      "type": "presence.update",
+      "users": [
+        {"user_id": 2, "online": true, "last_active": "2024-01-01T12:00:00"}
+      ]
+    }
+    ```
+    
     **`pong`** - Response to ping
     ```json
     {
@@ -329,6 +449,27 @@ app = FastAPI(
     }
     ```
     
+    **`ping`** - Sent after `WS_PING_AFTER` seconds (default 45) without any frame from the
+    client, which should answer with `pong`. A socket that stays silent for `WS_IDLE_TIMEOUT`
+    seconds (default 90) is closed with code `4408` ("Idle timeout"); reconnect as usual.
+    ```json
+    {
+      "type": "ping"
+    }
+    ```
+    
+    **`error`** - An event was rejected for going over its rate limit (it was not handled;
+    sent once per limited event type until it may be sent again)
+    ```json
+    {
+      "type": "error",
+      "error": "Rate limit exceeded",
+      "code": "rate_limited",
+      "event": "message.send",
+      "retry_after": 0.2
+    }
+    ```
+    
     ## Admin Mode
     
     Admin endpoints require PIN authentication. Use the `/api/admin/auth` endpoint to authenticate and get an admin token.
@@ -349,7 +490,11 @@ app = FastAPI(
     
     ## Rate Limiting
     
-    Currently, there are no rate limits implemented. Consider implementing rate limiting for production use.
+    WebSocket events are rate limited per connection and per event type (token buckets,
+    configured with `WS_RATE_LIMITS`, e.g. `message.send=5/20,ping=1/5`). An event over
+    its limit is dropped and answered with the `rate_limited` error frame described above.
+    New WebSocket connections are also subject to admission control and may be closed with
+    `1013` ("Server busy, retry in Xs"). HTTP endpoints are not rate limited.
     """,
     version="1.0.0",
     docs_url="/docs",
@@ -389,9 +534,14 @@ def create_tables():
     """Create all database tables if they don't exist."""
     from models import User, Chat, ChatMember, Message, MessageStatus
     from sqlalchemy import inspect, text
+    from sqlalchemy.exc import OperationalError
     # Import all models to ensure they're registered with Base.metadata
     # This will create all tables defined in models.py if they don't exist
-    Base.metadata.create_all(bind=engine)
+    try:
+        Base.metadata.create_all(bind=engine)
+    except OperationalError:
+        # With several workers another process may have created the tables concurrently
+        Base.metadata.create_all(bind=engine)
     
     # Migrate sender_id column to allow NULL if needed (for system messages)
     # Check if the column exists and if it's nullable
@@ -418,11 +568,32 @@ def create_tables():
     except Exception as e:
         db_logger.warning(f"Could not migrate sender_id column: {e}. System messages may fail. Consider resetting the database.")
     
+    # Add columns introduced after the tables were created (e.g. chat_members.last_read_message_id)
+    run_migrations(engine)
+    
     db_logger.info("Database tables initialized")
     # Clear all sessions on startup (sessions don't survive server restart)
     active_sessions.clear()
     auth_logger.info("All sessions cleared (server restart)")
 
+@app.on_event("startup")
+async def start_websocket_backplane():
+    """Subscribe this worker to the WebSocket backplane (WS_BACKPLANE_URL)."""
+    await manager.start()
+    await presence.start()
+    await typing_indicators.start()
+    await message_writer.start()
+    await heartbeat.start()
+
+@app.on_event("shutdown")
+async def stop_websocket_backplane():
+    await heartbeat.stop()
+    await message_writer.stop()
+    await typing_indicators.stop()
+    await presence.stop()
+    await manager.stop()
+    await dispose_async_engine()
+
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
@@ -430,6 +601,8 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # History pagination cursors (GET /api/chats/{chat_id}/messages)
+    expose_headers=["X-Prev-Cursor", "X-Next-Cursor"],
 )
 
 # Create API router with /api prefix
@@ -514,6 +687,7 @@ def login(user: UserCreate, db: Session = Depends(get_db)):
         "user_id": db_user.id,
         "username": db_user.username
     }
+    manager.publish_soon("sessions", {"op": "add", "session_id": session_id, "session": active_sessions[session_id]})
     
     auth_logger.info(f"User logged in: {user.username} (ID: {db_user.id}), session_id={session_id}")
     return LoginResponse(
@@ -547,6 +721,7 @@ def logout(session_id: str = Query(..., description="Session ID")):
     if session_id in active_sessions:
         username = active_sessions[session_id].get("username", "unknown")
         del active_sessions[session_id]
+        manager.publish_soon("sessions", {"op": "remove", "session_id": session_id})
         auth_logger.info(f"User logged out: {username}, session_id={session_id}")
     return LogoutResponse(message="Logout successful")
 
@@ -601,6 +776,38 @@ def get_all_users(db: Session = Depends(get_db)):
     """Get all users in the system (for regular users to see who they can chat with)."""
     return list_all_users(db)
 
+@api_router.get(
+    "/ws/route",
+    summary="Get WebSocket node for a user",
+    description="""
+    Tell a client which backend node to open `/api/ws` on.
+    
+    With `WS_ROUTING=true`, user and chat ids are placed on a consistent-hash ring of the
+    nodes listed in `WS_NODES`, so all devices of a user connect to the same node.
+    Without routing every node is equivalent and `url` is `null`.
+    
+    **Query Parameters:**
+    - `user_id`: User ID
+    - `chat_id`: Chat ID (optional) - also return the node the chat hashes to
+    
+    **Response:**
+    - `node`: Node id the user belongs to
+    - `url`: Base URL of that node (`null` = the current server)
+    - `chat_node`, `chat_url`: Same for the chat, if `chat_id` was given
+    """,
+    tags=["Users"]
+)
+def get_ws_route(
+    user_id: int = Query(..., description="User ID"),
+    chat_id: int = Query(None, description="Chat ID (optional)")
+):
+    if not isinstance(manager, RoutedConnectionManager):
+        route = {"node": manager.node_id, "url": None}
+        if chat_id is not None:
+            route.update(chat_node=manager.node_id, chat_url=None)
+        return route
+    return manager.route(user_id, chat_id)
+
 
 # -------------------------------
 # CHATS
@@ -636,54 +843,8 @@ def get_chats(
         else:
             raise HTTPException(status_code=400, detail="Either user_id or username must be provided")
     
-    chats = list_chats_for_user(db, user_id)
-    
-    # Enrich direct message chats with other_user_name, unread_count, and last_message_at
-    enriched_chats = []
-    for chat in chats:
-        # Calculate unread count for this user in this chat
-        unread_count = get_unread_count(db, chat.id, user_id)
-        
-        # Get the last message timestamp for sorting
-        from models import Message
-        last_message = db.query(Message).filter(
-            Message.chat_id == chat.id
-        ).order_by(desc(Message.created_at)).first()
-        
-        last_message_at = last_message.created_at if last_message else chat.created_at
-        
-        chat_dict = {
-            "id": chat.id,
-            "type": chat.type,
-            "title": chat.title,
-            "created_at": chat.created_at,
-            "last_message_at": last_message_at.isoformat() if last_message_at else chat.created_at.isoformat() if chat.created_at else None,
-            "other_user_name": None,
-            "unread_count": unread_count
-        }
-        
-        # For direct messages, find the other user's name
-        if chat.type == "direct":
-            members = get_chat_members(db, chat.id)
-            for member in members:
-                if member.user_id != user_id:
-                    other_user = get_user(db, member.user_id)
-                    if other_user:
-                        chat_dict["other_user_name"] = other_user.username
-                    break
-        
-        enriched_chats.append(chat_dict)
-    
-    # Sort chats by most recent message at the top
-    def sort_key(c):
-        last_msg = c.get("last_message_at") or c.get("created_at") or ""
-        # Convert ISO string to comparable value (newer = larger)
-        timestamp = last_msg.replace("T", " ").replace("Z", "").replace("+00:00", "") if last_msg else ""
-        return timestamp
-    
-    enriched_chats.sort(key=sort_key, reverse=True)  # Reverse=True: newest first
-    
-    return enriched_chats
+    # One query: last message time, unread count and DM peer for every chat, newest first
+    return list_chat_summaries(db, user_id)
 
 @api_router.get(
     "/chats/me",
@@ -707,54 +868,8 @@ def get_chats(
     tags=["Chats"]
 )
 def get_my_chats(user_id: int, db: Session = Depends(get_db)):
-    chats = list_chats_for_user(db, user_id)
-    
-    # Enrich direct message chats with other_user_name, unread_count, and last_message_at
-    enriched_chats = []
-    for chat in chats:
-        # Calculate unread count for this user in this chat
-        unread_count = get_unread_count(db, chat.id, user_id)
-        
-        # Get the last message timestamp for sorting
-        from models import Message
-        last_message = db.query(Message).filter(
-            Message.chat_id == chat.id
-        ).order_by(desc(Message.created_at)).first()
-        
-        last_message_at = last_message.created_at if last_message else chat.created_at
-        
-        chat_dict = {
-            "id": chat.id,
-            "type": chat.type,
-            "title": chat.title,
-            "created_at": chat.created_at,
-            "last_message_at": last_message_at.isoformat() if last_message_at else chat.created_at.isoformat() if chat.created_at else None,
-            "other_user_name": None,
-            "unread_count": unread_count
-        }
-        
-        # For direct messages, find the other user's name
-        if chat.type == "direct":
-            members = get_chat_members(db, chat.id)
-            for member in members:
-                if member.user_id != user_id:
-                    other_user = get_user(db, member.user_id)
-                    if other_user:
-                        chat_dict["other_user_name"] = other_user.username
-                    break
-        
-        enriched_chats.append(chat_dict)
-    
-    # Sort chats by most recent message at the top
-    def sort_key(c):
-        last_msg = c.get("last_message_at") or c.get("created_at") or ""
-        # Convert ISO string to comparable value (newer = larger)
-        timestamp = last_msg.replace("T", " ").replace("Z", "").replace("+00:00", "") if last_msg else ""
-        return timestamp
-    
-    enriched_chats.sort(key=sort_key, reverse=True)  # Reverse=True: newest first
-    
-    return enriched_chats
+    # One query: last message time, unread count and DM peer for every chat, newest first
+    return list_chat_summaries(db, user_id)
 
 @api_router.post(
     "/chats/dm",
@@ -828,6 +943,7 @@ def create_dm(dm: DMCreate, db: Session = Depends(get_db)):
     chat = create_chat(db, "direct", None)
     add_member_to_chat(db, chat.id, dm.user1_id)
     add_member_to_chat(db, chat.id, dm.user2_id)
+    manager.invalidate_chat_members(chat.id)
     
     # #region agent log
     log_data = {
@@ -876,6 +992,7 @@ def create_group(group_data: GroupChatCreate, db: Session = Depends(get_db)):
     # Add all members to the chat
     for user_id in group_data.member_ids:
         add_member_to_chat(db, chat_obj.id, user_id)
+    manager.invalidate_chat_members(chat_obj.id)
     
     return chat_obj
 
@@ -989,6 +1106,7 @@ def add_member(
     
     # Add member to chat
     member = add_member_to_chat(db, chat_id, member_request.user_id)
+    manager.invalidate_chat_members(chat_id)
     
     # Create a system message indicating the user was added
     try:
@@ -1126,6 +1244,7 @@ def remove_member(
     success = remove_member_from_chat(db, chat_id, user_id)
     if not success:
         raise HTTPException(status_code=404, detail="Member not found in chat")
+    manager.invalidate_chat_members(chat_id)
     
     # Create a system message indicating the user was removed
     try:
@@ -1236,6 +1355,7 @@ def leave_chat(
     success = remove_member_from_chat(db, chat_id, user_id)
     if not success:
         raise HTTPException(status_code=400, detail="Failed to remove user from chat")
+    manager.invalidate_chat_members(chat_id)
     
     # Create a system message for group chats
     if chat.type == "group":
@@ -1332,16 +1452,21 @@ def send_message(msg: MessageCreate, db: Session = Depends(get_db)):
     "/chats/{chat_id}/messages",
     summary="Get chat messages",
     description="""
-    Get all messages for a specific chat with read status information.
+    Get one page of a chat's messages with read status information.
     
     **Path Parameters:**
     - `chat_id`: ID of the chat
     
     **Query Parameters:**
     - `user_id`: User ID (optional) - If provided, includes read status for this user
+    - `limit`: Page size (default 100, at most 500)
+    - `before_id`: Return the messages just older than this message ID
+    - `after_id`: Return the messages just newer than this message ID
+    
+    Without `before_id` / `after_id` the newest messages are returned.
     
     **Response:**
-    - Returns a list of enriched message objects with:
+    - Returns a list of enriched message objects, oldest first, with:
       - Message content (text or media_url)
       - Sender information
       - Read status (if user_id provided)
@@ -1352,29 +1477,46 @@ def send_message(msg: MessageCreate, db: Session = Depends(get_db)):
     - `sent`: Message sent but not read by anyone
     - `read`: Message has been read (by at least one recipient for sent messages, or by current user for received messages)
     - `unread`: Message not yet read by current user
+    
+    **Cursors (response headers):**
+    - `X-Prev-Cursor`: Pass as `before_id` to get the next older page (absent when there is none)
+    - `X-Next-Cursor`: Pass as `after_id` to get the next newer page (absent when there is none)
     """,
     tags=["Messages"]
 )
 def get_chat_messages(
     chat_id: int,
+    response: Response,
     user_id: int = Query(None, description="User ID to get read status for"),
+    limit: int = Query(100, ge=1, le=500, description="Page size"),
+    before_id: Optional[int] = Query(None, description="Messages older than this message ID"),
+    after_id: Optional[int] = Query(None, description="Messages newer than this message ID"),
     db: Session = Depends(get_db)
 ):
-    messages = get_messages_for_chat(db, chat_id)
+    if before_id is not None and after_id is not None:
+        raise HTTPException(status_code=400, detail="Use either before_id or after_id, not both")
+    
+    # Two queries in all: one page of messages joined with their senders' usernames, and the members
+    messages, more = get_chat_history(db, chat_id, before_id, after_id, limit)
+    if messages:
+        older = more if after_id is None else True
+        newer = more if after_id is not None else before_id is not None
+        if older:
+            response.headers["X-Prev-Cursor"] = str(messages[0][0].id)
+        if newer:
+            response.headers["X-Next-Cursor"] = str(messages[-1][0].id)
     
     # Get all chat members to check read status
     members = get_chat_members(db, chat_id)
     member_ids = [m.user_id for m in members]
+    # Read state comes from each member's read watermark (no per-message status queries)
+    read_up_to = {m.user_id: m.last_read_message_id or 0 for m in members}
     
     # Enrich messages with sender_username, content field, and read status
     enriched_messages = []
-    for msg in messages:
-        sender = get_user(db, msg.sender_id)
-        
-        # Get read status for this message (all users who have read it)
-        read_by = get_read_statuses_for_message(db, msg.id)
-        # Remove sender from read_by (sender doesn't count as "read")
-        read_by = [uid for uid in read_by if uid != msg.sender_id]
+    for msg, sender_username in messages:
+        # Users who have read this message (sender doesn't count as "read")
+        read_by = [uid for uid, up_to in read_up_to.items() if up_to >= msg.id and uid != msg.sender_id]
         
         # Determine status for current user (if provided)
         user_read_status = None
@@ -1384,14 +1526,13 @@ def get_chat_messages(
                 user_read_status = "read" if len(read_by) > 0 else "sent"
             else:
                 # For received messages, show if read by current user
-                status = get_message_status(db, msg.id, user_id)
-                user_read_status = "read" if (status and status.read_at) else "unread"
+                user_read_status = "read" if read_up_to.get(user_id, 0) >= msg.id else "unread"
         
         message_dict = {
             "id": msg.id,
             "chat_id": msg.chat_id,
             "sender_id": msg.sender_id,
-            "sender_username": sender.username if sender else None,
+            "sender_username": sender_username,
             "type": msg.type,
             "text": msg.text,
             "media_url": msg.media_url,
@@ -1723,6 +1864,74 @@ def create_user_admin(
     new_user = create_user(db, user.username, pin_hash)
     return new_user
 
+@api_router.get(
+    "/admin/ws/stats",
+    summary="WebSocket outbound queue stats (Admin)",
+    description="""
+    Outbound queue statistics for all connected WebSockets.
+    
+    **Query Parameters:**
+    - `admin_pin`: Admin PIN
+    
+    **Response:**
+    - `policy` / `outbox_size`: Configured backpressure policy and queue bound
+    - `totals`: Frames sent, dropped, coalesced, currently queued, and overflow disconnects
+    - `per_connection`: Queue depth, high-water mark and drop counters per socket (worst first)
+    - `presence`: Online users and presence.update flush counters
+    - `typing`: Typing events received, broadcast, throttled, expired and rejected
+    - `writer`: Messages written, commits used for them, and the largest batch so far
+    - `heartbeat`: Sockets watched, server pings sent and idle sockets reaped
+    - `admission`: Sockets held against the configured caps (`utilisation`), and handshakes
+      admitted or refused by reason
+    
+    **Errors:**
+    - `401`: Invalid admin PIN
+    """,
+    tags=["Admin"]
+)
+def websocket_stats(admin_pin: str = Query(..., description="Admin PIN")):
+    """Outbound queue depth and drop counters per WebSocket. Requires admin PIN."""
+    if not verify_admin_pin(admin_pin):
+        raise HTTPException(status_code=401, detail="Invalid admin PIN")
+    
+    return {
+        **manager.get_stats(),
+        "presence": presence.get_stats(),
+        "typing": typing_indicators.get_stats(),
+        "writer": message_writer.get_stats(),
+        "rate_limits": rate_limiter.get_stats(),
+        "wire": wire.get_stats(),
+        "inbound": ws_handlers.get_stats(),
+        "heartbeat": heartbeat.get_stats(),
+        "admission": admission.get_stats()
+    }
+
+@api_router.post(
+    "/admin/rebuild-chat-summaries",
+    response_model=MessageResponse,
+    summary="Rebuild chat summaries (Admin)",
+    description="""
+    Recompute every chat's `message_count`, `last_message_id` and `last_message_at`, and
+    every member's `unread_count`, from the messages table. These columns are kept up to
+    date whenever a message is stored or read; this repairs them after messages were
+    written or removed outside the application.
+    
+    **Query Parameters:**
+    - `admin_pin`: Admin PIN
+    
+    **Errors:**
+    - `401`: Invalid admin PIN
+    """,
+    tags=["Admin"]
+)
+def rebuild_summaries(admin_pin: str = Query(..., description="Admin PIN")):
+    """Recompute the denormalized chat summary columns and unread counters. Requires admin PIN."""
+    if not verify_admin_pin(admin_pin):
+        raise HTTPException(status_code=401, detail="Invalid admin PIN")
+    chats = rebuild_chat_summaries(engine)
+    members = rebuild_unread_counts(engine)
+    return MessageResponse(message=f"Rebuilt summaries of {chats} chats and unread counts of {members} members")
+
 @api_router.post(
     "/admin/reset-database",
     response_model=ResetDatabaseResponse,
@@ -1816,6 +2025,175 @@ app.mount("/api/media", StaticFiles(directory=str(MEDIA_DIR)), name="media")
 from fastapi import WebSocket, WebSocketDisconnect
 import json
 
+# Inbound /api/ws events: each is decoded and validated by ws_handlers before its
+# handler runs (see ws_events.py)
+ws_handlers = EventRegistry()
+
+
+@ws_handlers.on(ChatOpen)
+async def handle_chat_open(ctx: WsContext, event: ChatOpen):
+    chat_id = event.chat_id
+    # Always the session's user: the socket only ever receives its own user's events
+    user_id = ctx.user_id
+    # Validate user is member of chat
+    async with async_session() as db:
+        chat = await crud_async.get_chat(db, chat_id)
+    member_ids = await manager.get_chat_member_ids(chat_id, load_chat_members) if chat else set()
+    
+    if not chat or user_id not in member_ids:
+        ws_logger.warning(f"Chat open failed: chat_id={chat_id}, user_id={user_id} (not found or not a member)")
+        await manager.send_personal(ctx.websocket, json.dumps({"error": "Chat not found or not a member"}))
+        return
+    
+    await manager.connect(ctx.websocket, chat_id, user_id)
+    ws_logger.info(f"Chat opened: chat_id={chat_id}, user_id={user_id}")
+
+
+@ws_handlers.on(MessageSend)
+async def handle_message_send(ctx: WsContext, event: MessageSend):
+    websocket = ctx.websocket
+    chat_id = event.chat_id
+    # Always the session's user; a client can't send on someone else's behalf
+    sender_id = ctx.user_id
+    content = event.content
+    media_url = event.media_url
+    msg_type_content = event.msg_type
+    client_msg_id = event.client_msg_id
+    
+    try:
+        # Create message in database (committed together with other sockets' messages)
+        try:
+            message = await message_writer.submit(
+                chat_id=chat_id,
+                sender_id=sender_id,
+                msg_type=msg_type_content,
+                text=content if msg_type_content == "text" else None,
+                media_url=media_url if msg_type_content == "media" else None,
+                client_msg_id=client_msg_id
+            )
+        except DuplicateMessage as dup:
+            # A resend of a stored message: ack the original, don't broadcast it again
+            await manager.send_personal(websocket, json.dumps({
+                "type": "message.ack",
+                "chat_id": chat_id,
+                "message_id": dup.message_id,
+                "client_msg_id": client_msg_id,
+                "duplicate": True
+            }))
+            ws_logger.info(
+                f"Duplicate message.send ignored: sender_id={sender_id}, "
+                f"client_msg_id={client_msg_id}, message_id={dup.message_id}"
+            )
+            return
+        
+        # Acknowledge to the sender with the assigned id
+        await manager.send_personal(websocket, json.dumps({
+            "type": "message.ack",
+            "chat_id": chat_id,
+            "message_id": message.id,
+            "client_msg_id": client_msg_id,
+            "duplicate": False
+        }))
+        
+        # Sender username for broadcast (known from the session)
+        sender_username = ctx.session.get('username')
+        
+        # Get initial read status (empty for new messages)
+        read_by = []
+        
+        # Broadcast to chat members
+        broadcast_data = {
+            "type": "message.new",
+            "chat_id": chat_id,
+            "message": {
+                "id": message.id,
+                "chat_id": chat_id,
+                "sender_id": sender_id,
+                "sender_username": sender_username,
+                "type": msg_type_content,
+                "text": content,
+                "media_url": media_url,
+                "content": content if msg_type_content == "text" else media_url,
+                "created_at": message.created_at.isoformat() if hasattr(message, 'created_at') else None,
+                "timestamp": message.created_at.isoformat() if hasattr(message, 'created_at') else None,
+                "read_by": read_by,
+                "read_count": 0,
+                "status": None  # Will be set by frontend based on user
+            }
+        }
+        # Broadcast to all chat members (including those who haven't opened the chat)
+        report = await manager.broadcast(chat_id, json.dumps(broadcast_data), load_chat_members)
+        if not report.ok:
+            ws_logger.warning(
+                f"Broadcast backpressure: chat_id={chat_id}, queued={report.queued}, "
+                f"dropped={len(report.dropped)}, disconnected={len(report.disconnected)}"
+            )
+        # The message ends the sender's typing indicator (clients clear it on message.new)
+        typing_indicators.clear(chat_id, sender_id)
+        preview = content[:30] + "..." if content and len(content) > 30 else content or "[media]"
+        ws_logger.info(f"Message sent via WS: chat_id={chat_id}, sender_id={sender_id}, preview='{preview}'")
+    except Exception as e:
+        ws_logger.error(f"Error processing message.send: {e}", exc_info=True)
+        try:
+            await manager.send_personal(websocket, json.dumps({"error": "Failed to send message"}))
+        except Exception:
+            pass
+
+
+@ws_handlers.on(MessageRead)
+async def handle_message_read(ctx: WsContext, event: MessageRead):
+    chat_id = event.chat_id
+    message_id = event.message_id
+    user_id = ctx.user_id
+    
+    async with async_session() as db:
+        # Move this member's read watermark forward (also updates last_seen_at)
+        up_to_message_id = await crud_async.advance_read_watermark(db, chat_id, user_id, message_id)
+    
+    # One event for the whole range instead of one per message; clients derive
+    # per-message read state from each member's watermark
+    if up_to_message_id is not None:
+        await manager.broadcast(
+            chat_id,
+            json.dumps({
+                "type": "chat.read.update",
+                "chat_id": chat_id,
+                "user_id": user_id,
+                "up_to_message_id": up_to_message_id
+            }),
+            load_chat_members,
+            # A queued update for the same reader is superseded by this (higher) one
+            coalesce_key=("chat.read.update", chat_id, user_id)
+        )
+    
+    # Also send confirmation to the sender
+    await manager.send_personal(ctx.websocket, json.dumps({
+        "type": "message.status",
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "status": "read"
+    }))
+
+
+@ws_handlers.on(TypingStart)
+@ws_handlers.on(TypingStop)
+async def handle_typing(ctx: WsContext, event: Union[TypingStart, TypingStop]):
+    # Memory only: no DB session, no threadpool (see typing_indicators.py)
+    if not await typing_indicators.handle(event.chat_id, ctx.user_id, event.type == "typing.start"):
+        await manager.send_personal(ctx.websocket, json.dumps({"error": "Chat not found or not a member"}))
+
+
+@ws_handlers.on(Ping)
+async def handle_ping(ctx: WsContext, event: Ping):
+    await manager.send_personal(ctx.websocket, json.dumps({"type": "pong"}))
+
+
+@ws_handlers.on(Pong)
+async def handle_pong(ctx: WsContext, event: Pong):
+    # Answer to a server ping; receiving it already refreshed the heartbeat
+    pass
+
+
 
 @app.websocket(
     "/api/ws",
@@ -1824,7 +2202,9 @@ import json
 async def websocket_endpoint(
     websocket: WebSocket,
     token: str = Query(..., description="JWT token obtained from /api/auth/login"),
-    session_id: str = Query(..., description="Session ID obtained from /api/auth/login")
+    session_id: str = Query(..., description="Session ID obtained from /api/auth/login"),
+    stream: Optional[str] = Query(None, description="`stream` from the previous session.ready (when reconnecting)"),
+    last_seq: Optional[int] = Query(None, description="Highest `seq` received on the previous connection")
 ):
     # Validate session - reject if session doesn't exist (e.g., after server restart)
     # Use 1001 (Going Away) for server restarts - this allows frontend to reconnect
@@ -1840,22 +2220,22 @@ async def websocket_endpoint(
         await websocket.close(code=1008, reason="Invalid token. Please log in again.")
         return
     
-    await websocket.accept()
+    # JSON text frames, or MessagePack if the client offers it as subprotocol (see wire.py)
+    codec, subprotocol = choose_codec(websocket.scope.get("subprotocols", ()))
+    await websocket.accept(subprotocol=subprotocol)
     
-    # Create database session for this WebSocket connection
-    db = SessionLocal()
+    # Shed load before registering anything (accepted first, so the client sees the 1013)
+    refused = admission.admit(session["user_id"])
+    if refused is not None:
+        await admission.reject(websocket, refused)
+        return
     
+    # No database session is held for the connection: each operation below opens
+    # a short-lived async session, so idle sockets don't occupy pool connections
     try:
         # Track user connection
         user_id = session['user_id']
         
-        # Send session ready confirmation
-        await websocket.send_text(json.dumps({
-            "type": "session.ready",
-            "session_id": session_id
-        }))
-        ws_logger.info(f"WebSocket connected: session_id={session_id}, user_id={user_id}")
-        
         # #region agent log
         import inspect
         import os
@@ -1888,7 +2268,7 @@ async def websocket_endpoint(
         
         # Register user connection (connect to a dummy chat_id 0 to track the user)
         try:
-            await manager.connect(websocket, 0, user_id)
+            await manager.connect(websocket, 0, user_id, codec)
         except TypeError as e:
             # #region agent log
             log_data = {
@@ -1910,9 +2290,27 @@ async def websocket_endpoint(
             # #endregion
             raise
         
+        # Send session ready confirmation, then whatever the client missed since last_seq
+        # (queued before any live event, so the client sees one gap-free sequence)
+        ready = manager.resume(websocket, user_id, {
+            "type": "session.ready",
+            "session_id": session_id,
+            "node": manager.node_id
+        }, stream, last_seq)
+        ws_logger.info(
+            f"WebSocket connected: session_id={session_id}, user_id={user_id}, "
+            f"last_seq={last_seq}, replayed={ready['replayed']}, resync={ready['resync']}"
+        )
+        
+        # Tell the new socket who among the user's chat peers is online
+        await presence.send_snapshot(websocket, user_id)
+        
+        ctx = WsContext(websocket, session, user_id, codec)
+        limits = rate_limiter.for_connection()
+        heartbeat.track(websocket)
         while True:
             try:
-                data = await websocket.receive_text()
+                data = await codec.receive(websocket)
             except WebSocketDisconnect:
                 # Normal disconnection - let it propagate to outer handler
                 raise
@@ -1921,214 +2319,33 @@ async def websocket_endpoint(
                 ws_logger.error(f"Error receiving WebSocket message: {e}", exc_info=True)
                 # Don't break on other errors - continue the loop to keep connection alive
                 continue
+            presence.touch(user_id)
+            heartbeat.touch(websocket)
             
-            # Parse incoming JSON
+            # Decode and validate; malformed or unknown events never reach a handler
             try:
-                payload = json.loads(data)
-                msg_type = payload.get("type")
-                
-                # Handle different message types
-                if msg_type == "chat.open":
-                    chat_id = payload.get("chat_id")
-                    user_id = payload.get("user_id")
-                    # Validate user is member of chat
-                    chat = await run_in_threadpool(get_chat, db, chat_id)
-                    members = await run_in_threadpool(get_chat_members, db, chat_id)
-                    member_ids = [m.user_id for m in members]
-                    
-                    if not chat or user_id not in member_ids:
-                        ws_logger.warning(f"Chat open failed: chat_id={chat_id}, user_id={user_id} (not found or not a member)")
-                        await websocket.send_text(json.dumps({"error": "Chat not found or not a member"}))
-                        continue
-                    
-                    await manager.connect(websocket, chat_id, user_id)
-                    ws_logger.info(f"Chat opened: chat_id={chat_id}, user_id={user_id}")
-                    
-                elif msg_type == "message.send":
-                    chat_id = payload.get("chat_id")
-                    sender_id = payload.get("sender_id")
-                    content = payload.get("content")
-                    media_url = payload.get("media_url")
-                    msg_type_content = payload.get("msg_type", "text")
-                    
-                    try:
-                        # Create message in database
-                        message = await run_in_threadpool(
-                            create_message,
-                            db,
-                            chat_id=chat_id,
-                            sender_id=sender_id,
-                            msg_type=msg_type_content,
-                            text=content if msg_type_content == "text" else None,
-                            media_url=media_url if msg_type_content == "media" else None
-                        )
-                        
-                        # Get sender username for broadcast
-                        sender = await run_in_threadpool(get_user, db, sender_id)
-                        sender_username = sender.username if sender else None
-                        
-                        # Get initial read status (empty for new messages)
-                        read_by = []
-                        
-                        # Broadcast to chat members
-                        broadcast_data = {
-                            "type": "message.new",
-                            "chat_id": chat_id,
-                            "message": {
-                                "id": message.id,
-                                "chat_id": chat_id,
-                                "sender_id": sender_id,
-                                "sender_username": sender_username,
-                                "type": msg_type_content,
-                                "text": content,
-                                "media_url": media_url,
-                                "content": content if msg_type_content == "text" else media_url,
-                                "created_at": message.created_at.isoformat() if hasattr(message, 'created_at') else None,
-                                "timestamp": message.created_at.isoformat() if hasattr(message, 'created_at') else None,
-                                "read_by": read_by,
-                                "read_count": 0,
-                                "status": None  # Will be set by frontend based on user
-                            }
-                        }
-                        # Broadcast to all chat members (including those who haven't opened the chat)
-                        def get_members_for_broadcast(chat_id):
-                            return get_chat_members(db, chat_id)
-                        await manager.broadcast(chat_id, json.dumps(broadcast_data), get_members_for_broadcast)
-                        preview = content[:30] + "..." if content and len(content) > 30 else content or "[media]"
-                        ws_logger.info(f"Message sent via WS: chat_id={chat_id}, sender_id={sender_id}, preview='{preview}'")
-                    except Exception as e:
-                        ws_logger.error(f"Error processing message.send: {e}", exc_info=True)
-                        try:
-                            await websocket.send_text(json.dumps({"error": "Failed to send message"}))
-                        except Exception:
-                            pass
-                    
-                elif msg_type == "message.read":
-                    chat_id = payload.get("chat_id")
-                    message_id = payload.get("message_id")
-                    
-                    # #region agent log
-                    import json as json_module
-                    import time
-                    log_data = {
-                        "sessionId": "debug-session",
-                        "runId": "run1",
-                        "hypothesisId": "K",
-                        "location": "start_backend.py:1230",
-                        "message": "message.read handler entry",
-                        "data": {
-                            "chat_id": chat_id,
-                            "message_id": message_id,
-                            "user_id": user_id,
-                            "chat_id_is_none": chat_id is None,
-                            "message_id_is_none": message_id is None
-                        },
-                        "timestamp": int(time.time() * 1000)
-                    }
-                    with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                        f.write(json_module.dumps(log_data) + '\n')
-                    # #endregion
-                    
-                    # Validate required parameters
-                    if not chat_id or not message_id:
-                        ws_logger.warning(f"message.read missing required parameters: chat_id={chat_id}, message_id={message_id}")
-                        await websocket.send_text(json.dumps({
-                            "error": "Missing chat_id or message_id",
-                            "type": "error"
-                        }))
-                        continue
-                    
-                    # Update last_seen_at in database
-                    await run_in_threadpool(update_last_seen, db, chat_id, user_id, message_id)
-                    # Mark messages as read in MessageStatus table
-                    marked_message_ids = await run_in_threadpool(
-                        mark_messages_as_read, db, chat_id, user_id, message_id
-                    )
-                    
-                    # Broadcast read status updates to all chat members
-                    # Get all chat members
-                    members = await run_in_threadpool(get_chat_members, db, chat_id)
-                    
-                    # For each marked message, get read status and broadcast update
-                    for marked_msg_id in marked_message_ids:
-                        # Get all read statuses for this message in one query
-                        # This returns a list of user IDs who have read the message
-                        read_by_all = await run_in_threadpool(get_read_statuses_for_message, db, marked_msg_id)
-                        # Remove the current user from read_by (they just read it, but we show who else has read it)
-                        read_by = [uid for uid in read_by_all if uid != user_id]
-                        
-                        # #region agent log
-                        log_data = {
-                            "sessionId": "debug-session",
-                            "runId": "run1",
-                            "hypothesisId": "L",
-                            "location": "start_backend.py:1277",
-                            "message": "Broadcasting read status update",
-                            "data": {
-                                "chat_id": chat_id,
-                                "message_id": marked_msg_id,
-                                "read_by_all": read_by_all,
-                                "read_by": read_by,
-                                "read_count": len(read_by_all),
-                                "read_by_user_id": user_id,
-                                "marked_message_ids_count": len(marked_message_ids)
-                            },
-                            "timestamp": int(time.time() * 1000)
-                        }
-                        with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                            f.write(json_module.dumps(log_data) + '\n')
-                        # #endregion
-                        
-                        # Broadcast to all chat members
-                        broadcast_data = {
-                            "type": "message.read.update",
-                            "chat_id": chat_id,
-                            "message_id": marked_msg_id,
-                            "read_by": read_by,
-                            "read_count": len(read_by_all),  # Total count including current user
-                            "read_by_user_id": user_id
-                        }
-                        def get_members_for_broadcast(chat_id):
-                            return get_chat_members(db, chat_id)
-                        await manager.broadcast(chat_id, json.dumps(broadcast_data), get_members_for_broadcast)
-                        
-                        # #region agent log
-                        log_data = {
-                            "sessionId": "debug-session",
-                            "runId": "run1",
-                            "hypothesisId": "L",
-                            "location": "start_backend.py:1300",
-                            "message": "Read status broadcast sent",
-                            "data": {
-                                "chat_id": chat_id,
-                                "message_id": marked_msg_id,
-                                "broadcast_data": broadcast_data
-                            },
-                            "timestamp": int(time.time() * 1000)
-                        }
-                        with open(r'c:\Users\AX\PycharmProjects\Wazzap\.cursor\debug.log', 'a', encoding='utf-8') as f:
-                            f.write(json_module.dumps(log_data) + '\n')
-                        # #endregion
-                    
-                    # Also send confirmation to the sender
-                    await websocket.send_text(json.dumps({
-                        "type": "message.status",
-                        "chat_id": chat_id,
-                        "message_id": message_id,
-                        "status": "read"
-                    }))
-                    
-                elif msg_type == "ping":
-                    await websocket.send_text(json.dumps({"type": "pong"}))
-                    
-            except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({"error": "Invalid JSON"}))
+                event = ws_handlers.decode(codec, data)
+            except FrameDecodeError as e:
+                # Rejections count against the catch-all bucket so garbage can't be flooded either
+                if limits.check(None) is None:
+                    await manager.send_personal(websocket, json.dumps({"type": "error", "error": str(e)}))
+                continue
+            
+            # Over-limit events are dropped before any DB work
+            rejection = limits.check(event.type)
+            if rejection is not None:
+                if rejection:
+                    ws_logger.warning(f"Rate limited: user_id={user_id}, event={event.type}")
+                    await manager.send_personal(websocket, json.dumps(rejection))
                 continue
+            
+            await ws_handlers.dispatch(ctx, event)
                 
     except WebSocketDisconnect:
         # Disconnect from all chats
         try:
             user_id = session.get('user_id') if 'session' in locals() else None
+            heartbeat.forget(websocket)
             await manager.disconnect(websocket, None, user_id)
         except Exception as e:
             ws_logger.error(f"Error disconnecting WebSocket: {e}")
@@ -2137,27 +2354,19 @@ async def websocket_endpoint(
         ws_logger.error(f"Unexpected error in WebSocket endpoint: {e}", exc_info=True)
         try:
             user_id = session.get('user_id') if 'session' in locals() else None
+            heartbeat.forget(websocket)
             await manager.disconnect(websocket, None, user_id)
         except Exception:
             pass
-    finally:
-        # Close database session
-        try:
-            db.close()
-        except Exception as e:
-            ws_logger.error(f"Error closing database session: {e}")
 
 # Legacy WebSocket endpoint for backward compatibility
 @app.websocket("/ws/{chat_id}/{user_id}")
 async def websocket_endpoint_legacy(websocket: WebSocket, chat_id: int, user_id: int):
-    # Create database session for this WebSocket connection
-    db = SessionLocal()
-    
     try:
-        # Offload initial validation to threads
-        chat = await run_in_threadpool(get_chat, db, chat_id)
-        members = await run_in_threadpool(get_chat_members, db, chat_id)
-        member_ids = [m.user_id for m in members]
+        # Short-lived async session for the initial validation
+        async with async_session() as db:
+            chat = await crud_async.get_chat(db, chat_id)
+        member_ids = await manager.get_chat_member_ids(chat_id, load_chat_members) if chat else set()
 
         if not chat or user_id not in member_ids:
             await websocket.accept()
@@ -2172,8 +2381,15 @@ async def websocket_endpoint_legacy(websocket: WebSocket, chat_id: int, user_id:
             # await websocket.close()
             return
 
+        refused = admission.admit(user_id)
+        if refused is not None:
+            await websocket.accept()
+            await admission.reject(websocket, refused)
+            return
+
         await manager.connect(websocket, chat_id)
 
+        limits = rate_limiter.for_connection()
         while True:
             data = await websocket.receive_text()
 
@@ -2184,7 +2400,7 @@ async def websocket_endpoint_legacy(websocket: WebSocket, chat_id: int, user_id:
                 content = payload.get("content", None)
                 media_url = payload.get("media_url", None)
             except json.JSONDecodeError:
-                await websocket.send_text(json.dumps({"error": "Invalid JSON"}))
+                await manager.send_personal(websocket, json.dumps({"error": "Invalid JSON"}))
                 continue
 
             # Allow client to quit
@@ -2193,17 +2409,19 @@ async def websocket_endpoint_legacy(websocket: WebSocket, chat_id: int, user_id:
                 ws_logger.info(f"User {user_id} disconnected from chat {chat_id}")
                 break
 
-            # New check: User still member?
-            members = await run_in_threadpool(get_chat_members, db, chat_id)
-            member_ids = [m.user_id for m in members]
+            rejection = limits.check("message.send")
+            if rejection is not None:
+                if rejection:
+                    await manager.send_personal(websocket, json.dumps(rejection))
+                continue
+
+            # New check: User still member? (served from the membership index)
+            member_ids = await manager.get_chat_member_ids(chat_id, load_chat_members)
             if user_id not in member_ids:
-                await websocket.send_text(json.dumps({"error": "Not a member"}))
+                await manager.send_personal(websocket, json.dumps({"error": "Not a member"}))
                 continue
 
-            # Offload DB insertion to a thread
-            message = await run_in_threadpool(
-                create_message,
-                db,
+            message = await message_writer.submit(
                 chat_id=chat_id,
                 sender_id=user_id,
                 msg_type=msg_type,
@@ -2226,7 +2444,4 @@ async def websocket_endpoint_legacy(websocket: WebSocket, chat_id: int, user_id:
 
     except WebSocketDisconnect:
         await manager.disconnect(websocket, chat_id)
-        ws_logger.info(f"User {user_id} disconnected from chat {chat_id}")
-    finally:
-        # Close database session
-        db.close()
\ No newline at end of file
+        ws_logger.info(f"User {user_id} disconnected from chat {chat_id}")
\ No newline at end of file
@@ -0,0 +1,56 @@
+import asyncio
+import re
+
+from admission import AdmissionController
+from connection_manager import CLOSE_TRY_AGAIN_LATER, ConnectionManager
+from test_connection_manager import FakeWebSocket
+
+
+class ClosingWebSocket(FakeWebSocket):
+    async def close(self, code: int = 1000, reason: str = None):
+        self.closed = (code, reason)
+
+
+def test_caps_per_user_and_per_process():
+    async def scenario():
+        manager = ConnectionManager()
+        admission = AdmissionController(manager, max_sockets=3, max_per_user=2, accept_rate=0)
+        for user_id in (1, 1, 2):
+            await manager.connect(FakeWebSocket(), 0, user_id)
+
+        assert admission.admit(1) == "max_sockets"
+        await manager.disconnect(next(iter(manager.user_connections[2])), None, 2)
+        assert admission.admit(1) == "max_per_user"
+        assert admission.admit(2) is None
+
+        stats = admission.get_stats()
+        assert stats["sockets"] == 2 and stats["utilisation"] == round(2 / 3, 3)
+        assert stats["rejected_by_reason"] == {"max_sockets": 1, "max_per_user": 1, "accept_rate": 0}
+
+    asyncio.run(scenario())
+
+
+def test_accept_rate_sheds_bursts():
+    admission = AdmissionController(ConnectionManager(), max_sockets=0, max_per_user=0,
+                                    accept_rate=1, accept_burst=3)
+
+    results = [admission.admit(user_id) for user_id in range(5)]
+
+    assert results == [None, None, None, "accept_rate", "accept_rate"]
+    assert admission.get_stats()["utilisation"] is None
+
+
+def test_rejection_closes_with_1013_and_a_jittered_delay():
+    async def scenario():
+        admission = AdmissionController(ConnectionManager(), retry_after=4)
+        delays = set()
+        for _ in range(20):
+            websocket = ClosingWebSocket()
+            await admission.reject(websocket, "max_sockets")
+            code, reason = websocket.closed
+            assert code == CLOSE_TRY_AGAIN_LATER
+            delays.add(float(re.search(r"retry in ([\d.]+)s", reason).group(1)))
+
+        assert all(2 <= delay <= 6 for delay in delays) and len(delays) > 1
+
+    asyncio.run(scenario())
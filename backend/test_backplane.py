@@ -0,0 +1,169 @@
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+from backplane import InProcessBackplane, InProcessHub, RedisBackplane, SQLiteBackplane, _encode_command, _read_reply
+from connection_manager import ConnectionManager
+from test_connection_manager import FakeWebSocket, MembersLoader, drain
+
+BACKEND_DIR = Path(__file__).parent
+
+
+async def wait_for(predicate, timeout: float = 2.0):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while not predicate():
+        if loop.time() > deadline:
+            raise AssertionError("condition not met in time")
+        await asyncio.sleep(0.01)
+
+
+async def two_workers(make_backplane):
+    """Two managers (workers) with alice on the first and bob on the second."""
+    workers = []
+    for user_id in (1, 2):
+        manager = ConnectionManager(backplane=make_backplane())
+        manager.members_loader = MembersLoader({10: [1, 2]})
+        await manager.start()
+        socket = FakeWebSocket()
+        await manager.connect(socket, 0, user_id)
+        workers.append((manager, socket))
+    return workers
+
+
+def test_in_process_backplane_reaches_other_manager_once():
+    async def scenario():
+        hub = InProcessHub()
+        (a, alice), (b, bob) = await two_workers(lambda: InProcessBackplane(hub))
+
+        await a.broadcast(10, "hello", MembersLoader({10: [1, 2]}))
+        assert await a.send_to_user(2, "direct") is False  # bob isn't on worker a
+        await drain()
+
+        assert alice.sent == ["hello"]
+        assert bob.sent == ["hello", "direct"]
+        for manager in (a, b):
+            await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_backplane_delivers_and_invalidates_across_workers(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "backplane.db")
+        (a, alice), (b, bob) = await two_workers(lambda: SQLiteBackplane(path, poll_interval=0.005))
+
+        await a.broadcast(10, "hello", MembersLoader({10: [1, 2]}))
+        await wait_for(lambda: bob.sent == ["hello"])
+
+        # b cached chat 10's members while delivering; a membership change on a drops it
+        assert b.chat_members[10] == {1, 2}
+        a.invalidate_chat_members(10)
+        await wait_for(lambda: 10 not in b.chat_members)
+        for manager in (a, b):
+            await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_backplane_skips_malformed_rows(tmp_path):
+    async def scenario():
+        path = str(tmp_path / "backplane.db")
+        (a, alice), (b, bob) = await two_workers(lambda: SQLiteBackplane(path, poll_interval=0.005))
+
+        # A bad row must not kill the subscriber: later traffic still arrives
+        await a.backplane._run(a.backplane._insert, "chat", "{not json")
+        await a.broadcast(10, "hello", MembersLoader({10: [1, 2]}))
+        await wait_for(lambda: bob.sent == ["hello"])
+        for manager in (a, b):
+            await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_sqlite_backplane_across_processes(tmp_path):
+    path = str(tmp_path / "backplane.db")
+    other_worker = f"""
+import asyncio, sys
+sys.path.insert(0, {str(BACKEND_DIR)!r})
+from backplane import SQLiteBackplane
+
+async def main():
+    backplane = SQLiteBackplane({path!r})
+    async def ignore(channel, payload):
+        pass
+    await backplane.start(ignore, [])
+    await backplane.publish("chat", {{"origin": "other-worker", "chat_id": 10, "message": "from afar", "members": True, "coalesce_key": None}})
+    await backplane.stop()
+
+asyncio.run(main())
+"""
+
+    async def scenario():
+        manager = ConnectionManager(backplane=SQLiteBackplane(path, poll_interval=0.005))
+        manager.members_loader = MembersLoader({10: [1]})
+        await manager.start()
+        socket = FakeWebSocket()
+        await manager.connect(socket, 0, 1)
+
+        process = await asyncio.create_subprocess_exec(sys.executable, "-c", other_worker)
+        assert await process.wait() == 0
+        await wait_for(lambda: socket.sent == ["from afar"])
+        await manager.stop()
+
+    asyncio.run(scenario())
+
+
+class FakeRedisServer:
+    """Just enough of the Redis protocol (PUBLISH/SUBSCRIBE) to exercise RedisBackplane."""
+
+    def __init__(self):
+        self.subscribers = {}
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                command = await _read_reply(reader)
+                name = command[0].upper()
+                if name == b"SUBSCRIBE":
+                    for index, channel in enumerate(command[1:], start=1):
+                        self.subscribers.setdefault(channel, []).append(writer)
+                        writer.write(b"*3\r\n$9\r\nsubscribe\r\n" + _bulk(channel) + f":{index}\r\n".encode())
+                elif name == b"PUBLISH":
+                    targets = self.subscribers.get(command[1], [])
+                    for target in targets:
+                        target.write(b"*3\r\n$7\r\nmessage\r\n" + _bulk(command[1]) + _bulk(command[2]))
+                    writer.write(f":{len(targets)}\r\n".encode())
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+
+
+def _bulk(data: bytes) -> bytes:
+    return f"${len(data)}\r\n".encode() + data + b"\r\n"
+
+
+def test_redis_backplane_over_resp():
+    async def scenario():
+        fake = FakeRedisServer()
+        server = await asyncio.start_server(fake.handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        url = f"redis://127.0.0.1:{port}"
+
+        (a, alice), (b, bob) = await two_workers(lambda: RedisBackplane(url))
+        await wait_for(lambda: len(fake.subscribers.get(b"wazzap:chat", [])) == 2)
+
+        await a.broadcast(10, json.dumps({"type": "message.new"}), MembersLoader({10: [1, 2]}))
+        await wait_for(lambda: len(bob.sent) == 1)
+        assert alice.sent == bob.sent
+
+        for manager in (a, b):
+            await manager.stop()
+        server.close()
+
+    asyncio.run(scenario())
+
+
+def test_encode_command_is_resp_array():
+    assert _encode_command("PUBLISH", "c", "hi") == b"*3\r\n$7\r\nPUBLISH\r\n$1\r\nc\r\n$2\r\nhi\r\n"
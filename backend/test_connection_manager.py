@@ -0,0 +1,286 @@
+import asyncio
+import json
+
+import pytest
+
+from starlette.websockets import WebSocketState
+
+from connection_manager import ConnectionManager
+
+
+# -------------------------------
+# Helpers
+# -------------------------------
+class FakeWebSocket:
+    """Minimal stand-in for a Starlette WebSocket that records what it was sent."""
+
+    def __init__(self):
+        self.client_state = WebSocketState.CONNECTED
+        self.sent = []
+        self.closed = False
+
+    async def accept(self):
+        self.client_state = WebSocketState.CONNECTED
+
+    async def send_text(self, message: str):
+        self.sent.append(message)
+
+    async def close(self, code: int = 1000, reason: str = None):
+        self.closed = True
+
+
+class FakeMember:
+    def __init__(self, user_id):
+        self.user_id = user_id
+
+
+async def drain():
+    """Let the per-socket writer tasks flush their queues."""
+    await asyncio.sleep(0.01)
+
+
+class MembersLoader:
+    """Counts how often the (normally DB-backed) member loader is hit."""
+
+    def __init__(self, members_by_chat):
+        self.members_by_chat = members_by_chat
+        self.calls = 0
+
+    def __call__(self, chat_id):
+        self.calls += 1
+        return [FakeMember(uid) for uid in self.members_by_chat.get(chat_id, [])]
+
+
+# -------------------------------
+# Membership index
+# -------------------------------
+def test_broadcast_uses_cached_membership():
+    async def scenario():
+        manager = ConnectionManager()
+        alice, bob = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(alice, 0, 1)
+        await manager.connect(bob, 0, 2)
+        loader = MembersLoader({10: [1, 2]})
+
+        for i in range(5):
+            await manager.broadcast(10, json.dumps({"n": i}), loader)
+        await drain()
+
+        assert loader.calls == 1
+        assert len(alice.sent) == 5
+        assert len(bob.sent) == 5
+
+    asyncio.run(scenario())
+
+
+def test_invalidate_chat_members_reloads_on_next_broadcast():
+    async def scenario():
+        manager = ConnectionManager()
+        alice, carol = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(alice, 0, 1)
+        await manager.connect(carol, 0, 3)
+        loader = MembersLoader({10: [1]})
+
+        await manager.broadcast(10, "first", loader)
+        await drain()
+        assert carol.sent == []
+
+        loader.members_by_chat[10] = [1, 3]
+        manager.invalidate_chat_members(10)
+        await manager.broadcast(10, "second", loader)
+        await drain()
+
+        assert loader.calls == 2
+        assert carol.sent == ["second"]
+        assert manager.chat_members[10] == {1, 3}
+
+    asyncio.run(scenario())
+
+
+# -------------------------------
+# Outbound queues and backpressure
+# -------------------------------
+class SlowWebSocket(FakeWebSocket):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    async def send_text(self, message: str):
+        await asyncio.sleep(self.delay)
+        await super().send_text(message)
+
+
+class BlockedWebSocket(FakeWebSocket):
+    """A peer that never reads: every send blocks until the test releases it."""
+
+    def __init__(self):
+        super().__init__()
+        self.release = asyncio.Event()
+        self.close_code = None
+
+    async def send_text(self, message: str):
+        await self.release.wait()
+        await super().send_text(message)
+
+    async def close(self, code: int = 1000, reason: str = None):
+        self.closed = True
+        self.close_code = code
+
+
+def test_slow_socket_does_not_delay_broadcast_or_other_recipients():
+    async def scenario():
+        manager = ConnectionManager(send_timeout=0.05)
+        fast, slow = FakeWebSocket(), SlowWebSocket(delay=1)
+        await manager.connect(fast, 0, 1)
+        await manager.connect(slow, 0, 2)
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        report = await manager.broadcast(10, "hello", MembersLoader({10: [1, 2]}))
+        assert loop.time() - started < 0.05
+        assert report.queued == 2 and report.ok
+
+        # The writers report back later: one frame written, one send timed out
+        assert await report.wait(1)
+        assert report.delivered == 1 and report.failed == [slow] and not report.ok
+        assert fast.sent == ["hello"]
+        # The stalled socket's writer timed out, so it was dropped and closed
+        assert slow.closed
+        assert set(manager.user_connections) == {1}
+
+    asyncio.run(scenario())
+
+
+def test_drop_oldest_policy_keeps_newest_frames():
+    async def scenario():
+        manager = ConnectionManager(outbox_size=2, outbox_policy="drop_oldest")
+        peer = BlockedWebSocket()
+        await manager.connect(peer, 0, 1)
+        loader = MembersLoader({10: [1]})
+
+        # The writer picks up "m0" and blocks on it; the queue then holds at most 2
+        for i in range(5):
+            await manager.broadcast(10, f"m{i}", loader)
+            await asyncio.sleep(0)
+
+        stats = manager.get_stats()["per_connection"][0]
+        assert stats["depth"] == 2
+        assert stats["dropped"] == 2
+
+        peer.release.set()
+        await drain()
+        assert peer.sent == ["m0", "m3", "m4"]
+
+    asyncio.run(scenario())
+
+
+def test_coalesce_policy_replaces_queued_read_receipts():
+    async def scenario():
+        manager = ConnectionManager(outbox_size=8, outbox_policy="coalesce")
+        peer = BlockedWebSocket()
+        await manager.connect(peer, 0, 1)
+        loader = MembersLoader({10: [1]})
+
+        await manager.broadcast(10, "message", loader)
+        await asyncio.sleep(0)
+        reports = [await manager.broadcast(10, f"read {count}", loader, coalesce_key=("read", 10, 5))
+                   for count in range(1, 4)]
+
+        assert manager.get_stats()["totals"]["coalesced"] == 2
+        assert [r.superseded for r in reports] == [1, 1, 0] and reports[2].pending == 1
+        peer.release.set()
+        await drain()
+        assert peer.sent == ["message", "read 3"]
+        assert reports[2].delivered == 1 and await reports[2].wait(0)
+
+    asyncio.run(scenario())
+
+
+def test_disconnect_policy_closes_with_1013_on_overflow():
+    async def scenario():
+        manager = ConnectionManager(outbox_size=1, outbox_policy="disconnect")
+        peer = BlockedWebSocket()
+        await manager.connect(peer, 0, 1)
+        loader = MembersLoader({10: [1]})
+
+        await manager.broadcast(10, "m0", loader)
+        await asyncio.sleep(0)
+        await manager.broadcast(10, "m1", loader)
+        report = await manager.broadcast(10, "m2", loader)
+        await drain()
+
+        assert report.disconnected == [peer]
+        assert peer.close_code == 1013
+        assert manager.user_connections == {}
+        assert manager.get_stats()["totals"]["overflow_disconnects"] == 1
+
+    asyncio.run(scenario())
+
+
+# -------------------------------
+# Multi-device
+# -------------------------------
+def test_every_device_of_a_user_receives_once():
+    async def scenario():
+        manager = ConnectionManager()
+        web, phone = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(web, 0, 1)
+        await manager.connect(phone, 0, 1)
+        # The web tab also opened the chat; it must still get each frame only once
+        await manager.connect(web, 10, 1)
+
+        await manager.broadcast(10, "broadcast", MembersLoader({10: [1]}))
+        assert await manager.send_to_user(1, "direct")
+        await drain()
+
+        assert web.sent == ["broadcast", "direct"]
+        assert phone.sent == ["broadcast", "direct"]
+
+        await manager.disconnect(web, None, 1)
+        assert manager.user_connections == {1: {phone}}
+        assert await manager.send_to_user(1, "after")
+        await drain()
+        assert phone.sent[-1] == "after"
+
+    asyncio.run(scenario())
+
+
+def test_socket_cannot_be_moved_to_another_user():
+    async def scenario():
+        manager = ConnectionManager()
+        socket = FakeWebSocket()
+        await manager.connect(socket, 0, 1)
+
+        with pytest.raises(ValueError):
+            await manager.connect(socket, 10, 2)
+
+        # Nothing changed: not subscribed to the chat, still only user 1's socket
+        assert manager.subscriptions[socket] == {0}
+        assert manager.user_connections == {1: {socket}}
+
+    asyncio.run(scenario())
+
+
+# -------------------------------
+# Subscription index
+# -------------------------------
+def test_disconnect_only_touches_the_sockets_own_subscriptions():
+    async def scenario():
+        manager = ConnectionManager()
+        leaving, staying = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(leaving, 0, 1)
+        await manager.connect(staying, 0, 2)
+        for chat_id in (10, 11, 10, 10):  # repeated chat.open is a no-op
+            await manager.connect(leaving, chat_id, 1)
+        await manager.connect(staying, 11, 2)
+
+        assert manager.subscriptions[leaving] == {0, 10, 11}
+        assert manager.active_connections[10] == {leaving}
+
+        await manager.disconnect(leaving, None, 1)
+
+        assert leaving not in manager.subscriptions
+        assert leaving not in manager.outboxes
+        assert manager.active_connections == {0: {staying}, 11: {staying}}
+
+    asyncio.run(scenario())
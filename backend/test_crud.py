@@ -0,0 +1,220 @@
+import os
+from datetime import datetime, timedelta
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+
+import crud
+from database import Base
+from migrations import rebuild_chat_summaries, rebuild_unread_counts
+from models import Chat, ChatMember, Message, User
+
+T0 = datetime(2024, 1, 1, 12, 0, 0)
+
+
+class QueryCounter:
+    """Counts the SQL statements an engine runs."""
+
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, "before_cursor_execute", self)
+
+    def __call__(self, *args):
+        self.count += 1
+
+
+@pytest.fixture
+def db(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'crud.db'}")
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    yield session
+    session.close()
+    engine.dispose()
+
+
+def seed(db):
+    alice, bob, carol = (User(username=name, pin_hash="x") for name in ("alice", "bob", "carol"))
+    dm, group, empty = Chat(type="direct", created_at=T0), Chat(type="group", title="g", created_at=T0), \
+        Chat(type="group", title="empty", created_at=T0 + timedelta(minutes=5))
+    db.add_all([alice, bob, carol, dm, group, empty])
+    db.flush()
+    db.add_all([
+        ChatMember(chat_id=dm.id, user_id=alice.id, last_seen_at=T0 + timedelta(minutes=1)),
+        ChatMember(chat_id=dm.id, user_id=bob.id),
+        ChatMember(chat_id=group.id, user_id=alice.id),
+        ChatMember(chat_id=group.id, user_id=bob.id),
+        ChatMember(chat_id=group.id, user_id=carol.id),
+        ChatMember(chat_id=empty.id, user_id=alice.id),
+        # Not alice's chat: must not leak into her list
+        ChatMember(chat_id=empty.id + 1, user_id=bob.id),
+    ])
+    db.add_all([
+        Message(chat_id=dm.id, sender_id=bob.id, type="text", text="old", created_at=T0),
+        Message(chat_id=dm.id, sender_id=bob.id, type="text", text="new", created_at=T0 + timedelta(minutes=2)),
+        Message(chat_id=dm.id, sender_id=bob.id, type="text", text="newer", created_at=T0 + timedelta(minutes=3)),
+        Message(chat_id=dm.id, sender_id=alice.id, type="text", text="mine", created_at=T0 + timedelta(minutes=4)),
+        Message(chat_id=group.id, sender_id=carol.id, type="text", text="hi", created_at=T0 + timedelta(hours=1)),
+    ])
+    db.commit()
+    # Rows added directly rather than through create_message: fill the chat summaries and counters
+    rebuild_chat_summaries(db.get_bind())
+    rebuild_unread_counts(db.get_bind())
+    return alice.id, bob.id, dm, group, empty
+
+
+def test_chat_summaries_in_one_query(db):
+    alice_id, bob_id, dm, group, empty = seed(db)
+    counter = QueryCounter(db.get_bind())
+
+    summaries = crud.list_chat_summaries(db, alice_id)
+
+    assert counter.count == 1
+    # Newest activity first; a chat without messages counts from its creation
+    assert [c["id"] for c in summaries] == [group.id, empty.id, dm.id]
+    by_id = {c["id"]: c for c in summaries}
+    assert by_id[dm.id]["last_message_at"] == T0 + timedelta(minutes=4)
+    assert by_id[empty.id]["last_message_at"] == empty.created_at
+    assert (by_id[dm.id]["other_user_id"], by_id[dm.id]["other_user_name"]) == (bob_id, "bob")
+    assert by_id[group.id]["other_user_name"] is None
+    # Others' messages after last_seen_at (everything when never seen)
+    assert [by_id[chat.id]["unread_count"] for chat in (dm, group, empty)] == [2, 1, 0]
+
+
+def test_chat_history_joins_sender_usernames(db):
+    alice_id, bob_id, dm, group, empty = seed(db)
+    dm_id = dm.id
+    db.add(Message(chat_id=dm_id, sender_id=None, type="system", text="renamed", created_at=T0 + timedelta(hours=1)))
+    db.commit()
+    counter = QueryCounter(db.get_bind())
+
+    history, more = crud.get_chat_history(db, dm_id)
+
+    assert counter.count == 1
+    assert [(msg.text, username) for msg, username in history] == [
+        ("old", "bob"), ("new", "bob"), ("newer", "bob"), ("mine", "alice"), ("renamed", None)
+    ]
+    assert not more
+
+
+def test_chat_history_pages_by_message_id(db):
+    chat = Chat(type="group", title="long")
+    db.add(chat)
+    db.flush()
+    db.add_all(Message(chat_id=chat.id, type="text", text=str(n), created_at=T0) for n in range(10))
+    db.commit()
+    chat_id = chat.id
+
+    def texts(rows):
+        return [msg.text for msg, _ in rows]
+
+    newest, older_exists = crud.get_chat_history(db, chat_id, limit=4)
+    assert texts(newest) == ["6", "7", "8", "9"] and older_exists
+    older, older_exists = crud.get_chat_history(db, chat_id, before_id=newest[0][0].id, limit=4)
+    assert texts(older) == ["2", "3", "4", "5"] and older_exists
+    oldest, older_exists = crud.get_chat_history(db, chat_id, before_id=older[0][0].id, limit=4)
+    assert texts(oldest) == ["0", "1"] and not older_exists
+
+    newer, newer_exists = crud.get_chat_history(db, chat_id, after_id=oldest[-1][0].id, limit=4)
+    assert texts(newer) == ["2", "3", "4", "5"] and newer_exists
+    newer, newer_exists = crud.get_chat_history(db, chat_id, after_id=newer[-1][0].id, limit=4)
+    assert texts(newer) == ["6", "7", "8", "9"] and not newer_exists
+
+
+def test_hot_queries_never_scan_a_table(db):
+    """Every statement the hot crud paths run must be an index search (SQLite EXPLAIN QUERY PLAN)."""
+    alice_id, bob_id, dm, group, empty = seed(db)
+    dm_id = dm.id
+    engine = db.get_bind()
+    statements = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().split(None, 1)[0].upper() in ("SELECT", "UPDATE", "DELETE"):
+            statements.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", record)
+    crud.list_chat_summaries(db, alice_id)
+    crud.get_chat_history(db, dm_id)
+    crud.get_chat_history(db, dm_id, before_id=3)
+    crud.get_chat_history(db, dm_id, after_id=1)
+    crud.get_unread_count(db, dm_id, alice_id)
+    crud.get_chat_members(db, dm_id)
+    crud.get_chat_peer_ids(db, alice_id)
+    crud.list_chats_for_user(db, alice_id)
+    crud.get_user_by_username(db, "bob")
+    crud.find_existing_dm(db, alice_id, bob_id)
+    crud.add_member_to_chat(db, dm_id, alice_id)
+    crud.mark_messages_as_read(db, dm_id, alice_id, 3)
+    crud.update_last_seen(db, dm_id, alice_id, 2)
+    event.remove(engine, "before_cursor_execute", record)
+
+    connection = engine.raw_connection()
+    try:
+        scans = []
+        for statement, parameters in statements:
+            plan = connection.cursor().execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+            scans += [(row[-1], statement) for row in plan if row[-1].startswith("SCAN ")]
+    finally:
+        connection.close()
+    assert statements and scans == []
+
+
+def test_chat_summary_columns_follow_new_messages(db):
+    alice_id, bob_id, dm, group, empty = seed(db)
+    empty_id = empty.id
+
+    first = crud.create_message(db, empty_id, alice_id, "text", text="first")
+    second = crud.create_message(db, empty_id, bob_id, "text", text="second")
+
+    chat = db.get(Chat, empty_id)
+    assert (chat.message_count, chat.last_message_id, chat.last_message_at) == (2, second.id, second.created_at)
+    assert [c.id for c in crud.list_chats_for_user(db, alice_id)][0] == empty_id
+    assert crud.list_chat_summaries(db, alice_id)[0]["last_message_at"] == second.created_at
+
+    # An older id arriving late (another worker's batch) doesn't move the last message back
+    db.execute(crud.chat_summary_update(empty_id, first.id, first.created_at))
+    db.commit()
+    db.refresh(chat)
+    assert (chat.message_count, chat.last_message_id) == (3, second.id)
+    rebuild_chat_summaries(db.get_bind())
+    db.refresh(chat)
+    assert chat.message_count == 2
+
+
+def test_unread_counters_follow_messages_and_reads(db):
+    alice_id, bob_id, dm, group, empty = seed(db)
+    group_id = group.id
+    carol_id = crud.get_user_by_username(db, "carol").id
+    counter = QueryCounter(db.get_bind())
+
+    def unread():
+        return [crud.get_unread_count(db, group_id, user_id) for user_id in (alice_id, bob_id, carol_id)]
+
+    assert unread() == [1, 1, 0]
+    crud.create_message(db, group_id, bob_id, "text", text="a")
+    crud.create_message(db, group_id, None, "system", text="renamed")
+    assert unread() == [2, 1, 1]
+
+    # Reading up to bob's message clears it; a later message still counts
+    crud.update_last_seen(db, group_id, alice_id, db.query(Message.id).filter_by(text="a").scalar())
+    crud.create_message(db, group_id, carol_id, "text", text="b")
+    assert unread() == [1, 2, 1]
+
+    # The batched writer's statement: several senders in one chat
+    db.execute(crud.unread_increment(group_id, [alice_id, alice_id, bob_id, None]))
+    db.commit()
+    assert unread() == [2, 4, 4]
+    assert crud.unread_increment(group_id, [None]) is None
+
+    # A new member starts with the chat's earlier messages unread
+    dave = crud.create_user(db, "dave", "x")
+    crud.add_member_to_chat(db, group_id, dave.id)
+    assert crud.get_unread_count(db, group_id, dave.id) == 3
+
+    # Reading the count never touches messages
+    counter.count = 0
+    crud.get_unread_count(db, group_id, alice_id)
+    assert counter.count == 1
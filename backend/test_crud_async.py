@@ -0,0 +1,69 @@
+import asyncio
+import os
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+import crud_async
+from database import Base, to_async_url
+from models import Chat, ChatMember, Message, User
+
+
+def test_to_async_url_picks_the_async_driver():
+    assert to_async_url("sqlite:///./wazzap.db") == "sqlite+aiosqlite:///./wazzap.db"
+    assert to_async_url("mysql+pymysql://u:p@db/wazzap") == "mysql+aiomysql://u:p@db/wazzap"
+    assert to_async_url("postgresql://u@db/wazzap") == "postgresql+asyncpg://u@db/wazzap"
+    assert to_async_url("mariadb+pymysql://u:p@db/wazzap") == "mariadb+aiomysql://u:p@db/wazzap"
+    with pytest.raises(ValueError):
+        to_async_url("oracle://db")
+
+
+def test_ws_crud_round_trip(tmp_path):
+    async def scenario():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'async.db'}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        sessions = async_sessionmaker(engine, expire_on_commit=False)
+
+        async with sessions() as db:
+            alice, bob, chat = User(username="alice", pin_hash="x"), User(username="bob", pin_hash="x"), Chat(type="direct")
+            db.add_all([alice, bob, chat])
+            await db.flush()
+            db.add_all([ChatMember(chat_id=chat.id, user_id=alice.id, unread_count=2),
+                        ChatMember(chat_id=chat.id, user_id=bob.id, unread_count=2)])
+            # Messages are written by MessageWriter in production; add them directly here
+            first = Message(chat_id=chat.id, sender_id=alice.id, type="text", text="hi")
+            second = Message(chat_id=chat.id, sender_id=alice.id, type="text", text="there")
+            db.add_all([first, second])
+            await db.commit()
+
+        # One short-lived session per operation, as the WebSocket handler does
+        async with sessions() as db:
+            assert (await crud_async.get_chat(db, chat.id)).type == "direct"
+            assert {m.user_id for m in await crud_async.get_chat_members(db, chat.id)} == {alice.id, bob.id}
+            assert await crud_async.get_chat_peer_ids(db, alice.id) == {bob.id}
+            assert await crud_async.get_chat_peer_ids(db, 999) == set()
+            assert (await crud_async.get_user(db, alice.id)).username == "alice"
+        async with sessions() as db:
+            assert await crud_async.advance_read_watermark(db, chat.id, bob.id, first.id) == first.id
+            # The counter is recounted from the new position: only "there" is left
+            members = await crud_async.get_chat_members(db, chat.id)
+            assert next(m for m in members if m.user_id == bob.id).unread_count == 1
+            # Ids past the newest message are clamped to it
+            assert await crud_async.advance_read_watermark(db, chat.id, bob.id, second.id + 100) == second.id
+            # Never moves backwards, and repeating is a no-op
+            assert await crud_async.advance_read_watermark(db, chat.id, bob.id, first.id) is None
+            assert await crud_async.advance_read_watermark(db, chat.id, bob.id, second.id) is None
+            # Not a member of this chat
+            assert await crud_async.advance_read_watermark(db, chat.id, 999, second.id) is None
+        async with sessions() as db:
+            members = await crud_async.get_chat_members(db, chat.id)
+            bob_member = next(m for m in members if m.user_id == bob.id)
+            assert bob_member.last_read_message_id == second.id
+            assert bob_member.last_seen_at == second.created_at
+
+        await engine.dispose()
+
+    asyncio.run(scenario())
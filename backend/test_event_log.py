@@ -0,0 +1,120 @@
+import asyncio
+import json
+
+from connection_manager import ConnectionManager
+from event_log import EventLog, event_type
+from test_connection_manager import FakeWebSocket, MembersLoader, drain
+
+
+def frames(websocket):
+    return [json.loads(message) for message in websocket.sent]
+
+
+def test_stamp_numbers_each_users_events():
+    log = EventLog(size=4)
+    log.attach(1)
+    log.attach(2)
+
+    assert log.stamp(1, '{"type": "message.new"}') == '{"seq": 1, "type": "message.new"}'
+    assert log.stamp(1, '{"chat_id": 1, "type": "chat.read.update"}') == \
+        '{"seq": 2, "chat_id": 1, "type": "chat.read.update"}'
+    assert log.stamp(2, '{"type": "message.new"}') == '{"seq": 1, "type": "message.new"}'
+    # Users who never connected here are not numbered
+    assert log.stamp(3, '{"type": "message.new"}') == '{"type": "message.new"}'
+    assert log.last_seq(1) == 2
+
+
+def test_ephemeral_events_are_neither_numbered_nor_buffered():
+    log = EventLog(size=2)
+    log.attach(1)
+    log.stamp(1, '{"type": "message.new", "n": 1}')
+    for frame in ('{"type": "typing.update"}', '{"type": "presence.update"}', "{}", "not json"):
+        assert log.stamp(1, frame) == frame
+
+    assert log.last_seq(1) == 1
+    assert [json.loads(f)["n"] for f in log.since(1, log.stream, 0)] == [1]
+    assert event_type('{"message": {"type": "text"}, "type": "message.new"}') == "message.new"
+
+
+def test_since_replays_the_gap_or_asks_for_resync():
+    log = EventLog(size=3)
+    log.attach(1)
+    for i in range(5):
+        log.stamp(1, json.dumps({"type": "message.new", "n": i}))
+
+    assert [json.loads(f)["n"] for f in log.since(1, log.stream, 3)] == [3, 4]
+    assert log.since(1, log.stream, 5) == []
+    # seq 2 already rolled out of the 3-event buffer
+    assert log.since(1, log.stream, 1) is None
+    # Another worker's (or a previous process's) numbers can't be resumed
+    assert log.since(1, "other", 4) is None
+    assert log.get_stats()["resyncs"] == 2
+
+
+def test_buffer_outlives_a_short_disconnect_only():
+    log = EventLog(size=8, ttl=60)
+    log.attach(1)
+    log.detach(1)
+    assert log.tracks(1)
+
+    log.ttl = 0
+    log.expire()
+    assert not log.tracks(1)
+
+
+def test_reconnect_replays_events_missed_while_away():
+    async def scenario():
+        manager = ConnectionManager()
+        loader = MembersLoader({10: [1, 2]})
+        first, other = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(first, 0, 1)
+        await manager.connect(other, 0, 2)
+        ready = manager.resume(first, 1, {"type": "session.ready"})
+        await manager.broadcast(10, json.dumps({"type": "message.new", "n": 1}), loader)
+        await drain()
+        last_seq = frames(first)[-1]["seq"]
+
+        # Network blip: two events go out while user 1 has no socket
+        await manager.disconnect(first, None, 1)
+        await manager.broadcast(10, json.dumps({"type": "message.new", "n": 2}), loader)
+        await manager.send_to_user(1, json.dumps({"type": "chat.member.added", "n": 3}))
+
+        second = FakeWebSocket()
+        await manager.connect(second, 0, 1)
+        resumed = manager.resume(second, 1, {"type": "session.ready"}, ready["stream"], last_seq)
+        await manager.broadcast(10, json.dumps({"type": "message.new", "n": 4}), loader)
+        await drain()
+
+        assert resumed["resync"] is False and resumed["replayed"] == 2
+        # Not the newest seq: the replayed frames carry the client forward from its own
+        assert resumed["seq"] == last_seq
+        received = frames(second)
+        assert received[0]["type"] == "session.ready"
+        assert [(f["seq"], f["n"]) for f in received[1:]] == [(2, 2), (3, 3), (4, 4)]
+        # User 2 has its own sequence
+        assert [f["seq"] for f in frames(other)] == [1, 2, 3]
+
+    asyncio.run(scenario())
+
+
+def test_reconnect_after_rollover_or_to_unknown_stream_requires_resync():
+    async def scenario():
+        manager = ConnectionManager(event_log=EventLog(size=2))
+        loader = MembersLoader({10: [1, 2]})
+        first, other = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(first, 0, 1)
+        await manager.connect(other, 0, 2)
+        stream = manager.resume(first, 1, {"type": "session.ready"})["stream"]
+        await manager.disconnect(first, None, 1)
+        for i in range(3):
+            await manager.broadcast(10, json.dumps({"type": "message.new", "n": i}), loader)
+
+        second = FakeWebSocket()
+        await manager.connect(second, 0, 1)
+        assert manager.resume(second, 1, {}, stream, 0)["resync"] is True
+        assert manager.resume(second, 1, {}, "restarted", 3)["resync"] is True
+        # A first connect (no last_seq) is neither a replay nor a resync
+        fresh = manager.resume(second, 1, {})
+        assert fresh["resync"] is False and fresh["seq"] == 3
+
+    asyncio.run(scenario())
@@ -0,0 +1,102 @@
+import asyncio
+import json
+
+from connection_manager import ConnectionManager
+from heartbeat import CLOSE_IDLE_TIMEOUT, HeartbeatService, TimingWheel
+from test_connection_manager import FakeWebSocket, drain
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class ClosingWebSocket(FakeWebSocket):
+    async def close(self, code: int = 1000, reason: str = None):
+        self.closed = (code, reason)
+
+
+def run_ticks(service, clock, seconds):
+    async def ticks():
+        for _ in range(int(seconds / service.wheel.tick)):
+            clock.now += service.wheel.tick
+            await service.tick()
+    return ticks()
+
+
+def test_timing_wheel_returns_keys_when_due():
+    wheel = TimingWheel(1, 10)
+    wheel.schedule("a", 2)
+    wheel.schedule("b", 3)
+    wheel.schedule("c", 3)
+    wheel.cancel("c")
+
+    assert [wheel.advance(), wheel.advance(), wheel.advance()] == [set(), {"a"}, {"b"}]
+    assert len(wheel) == 0
+    # Longer delays than the wheel covers land in its last slot
+    wheel.schedule("d", 60)
+    assert sum(1 for _ in range(9) if "d" in wheel.advance()) == 1
+
+
+def test_quiet_socket_is_pinged_then_reaped():
+    async def scenario():
+        clock = Clock()
+        manager = ConnectionManager()
+        service = HeartbeatService(manager, ping_after=5, idle_timeout=10, tick=1, clock=clock)
+        websocket = ClosingWebSocket()
+        await manager.connect(websocket, 0, 1)
+        service.track(websocket)
+
+        await run_ticks(service, clock, 5)
+        await drain()
+        assert [json.loads(frame)["type"] for frame in websocket.sent] == ["ping"]
+
+        await run_ticks(service, clock, 5)
+        assert websocket.closed == (CLOSE_IDLE_TIMEOUT, "Idle timeout")
+        assert websocket not in manager.outboxes
+        assert manager.user_connections.get(1) is None
+        assert service.get_stats()["reaped"] == 1 and service.get_stats()["tracked"] == 0
+
+    asyncio.run(scenario())
+
+
+def test_active_socket_is_left_alone():
+    async def scenario():
+        clock = Clock()
+        manager = ConnectionManager()
+        service = HeartbeatService(manager, ping_after=5, idle_timeout=10, tick=1, clock=clock)
+        websocket = ClosingWebSocket()
+        await manager.connect(websocket, 0, 1)
+        service.track(websocket)
+
+        for _ in range(6):
+            await run_ticks(service, clock, 4)
+            service.touch(websocket)
+        await drain()
+
+        assert websocket.sent == [] and websocket.closed is False
+        assert service.get_stats()["pings"] == 0 and websocket in service.wheel
+
+    asyncio.run(scenario())
+
+
+def test_disconnected_socket_is_dropped_without_a_close():
+    async def scenario():
+        clock = Clock()
+        manager = ConnectionManager()
+        service = HeartbeatService(manager, ping_after=5, idle_timeout=10, tick=1, clock=clock)
+        websocket = ClosingWebSocket()
+        await manager.connect(websocket, 0, 1)
+        service.track(websocket)
+        await manager.disconnect(websocket, None, 1)
+
+        websocket.closed = False
+
+        await run_ticks(service, clock, 5)
+        assert websocket.closed is False
+        assert websocket not in service.last_activity and service.get_stats()["tracked"] == 0
+
+    asyncio.run(scenario())
@@ -0,0 +1,191 @@
+import asyncio
+import os
+
+os.environ.setdefault("DATABASE_URL", "sqlite:///:memory:")
+
+import pytest
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from database import Base
+from message_writer import DuplicateMessage, MessageWriter
+from models import Chat, Message
+
+
+class CountingSessions:
+    """async_sessionmaker wrapper that counts commits."""
+
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.commits = 0
+
+    def __call__(self):
+        session = self.sessions()
+        commit = session.commit
+
+        async def counted_commit():
+            self.commits += 1
+            await commit()
+
+        session.commit = counted_commit
+        return session
+
+
+async def make_db(tmp_path):
+    engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path / 'writer.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    sessions = async_sessionmaker(engine, expire_on_commit=False)
+    async with sessions() as db:
+        db.add(Chat(id=1, type="group"))
+        await db.commit()
+    return engine, CountingSessions(sessions)
+
+
+def test_concurrent_sends_share_one_commit(tmp_path):
+    async def scenario():
+        engine, sessions = await make_db(tmp_path)
+        writer = MessageWriter(sessions, max_delay_ms=50, max_batch=100)
+        await writer.start()
+
+        messages = await asyncio.gather(*[
+            writer.submit(1, sender_id, "text", text=f"hi {sender_id}") for sender_id in range(50)
+        ])
+        await writer.stop()
+
+        # Every sender gets its own row back, with a distinct id
+        assert [m.text for m in messages] == [f"hi {i}" for i in range(50)]
+        assert len({m.id for m in messages}) == 50
+        assert all(m.created_at is not None for m in messages)
+        assert sessions.commits == 1
+        assert writer.get_stats()["largest_batch"] == 50
+        # The chat's summary is updated in the same commit
+        async with sessions.sessions() as db:
+            chat = await db.get(Chat, 1)
+        newest = max(messages, key=lambda m: m.id)
+        assert (chat.message_count, chat.last_message_id, chat.last_message_at) == (50, newest.id, newest.created_at)
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_full_batch_is_written_without_waiting(tmp_path):
+    async def scenario():
+        engine, sessions = await make_db(tmp_path)
+        writer = MessageWriter(sessions, max_delay_ms=10_000, max_batch=10)
+        await writer.start()
+
+        messages = await asyncio.wait_for(
+            asyncio.gather(*[writer.submit(1, 1, "text", text=str(i)) for i in range(20)]), timeout=5
+        )
+        await writer.stop()
+
+        assert len(messages) == 20
+        assert sessions.commits == 2
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_bad_message_does_not_fail_the_batch(tmp_path):
+    async def scenario():
+        engine, sessions = await make_db(tmp_path)
+        writer = MessageWriter(sessions, max_delay_ms=50)
+        await writer.start()
+
+        # type is NOT NULL: this row fails, the other two must still be stored
+        results = await asyncio.gather(
+            writer.submit(1, 1, "text", text="a"),
+            writer.submit(1, 1, None, text="broken"),
+            writer.submit(1, 2, "text", text="b"),
+            return_exceptions=True
+        )
+        await writer.stop()
+
+        assert isinstance(results[1], Exception)
+        assert results[0].id and results[2].id
+        async with sessions.sessions() as db:
+            stored = (await db.execute(select(Message.text).order_by(Message.id))).scalars().all()
+        assert stored == ["a", "b"]
+        assert writer.stats["batch_failures"] == 1
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_stop_flushes_pending_and_unstarted_writer_writes_directly(tmp_path):
+    async def scenario():
+        engine, sessions = await make_db(tmp_path)
+        writer = MessageWriter(sessions, max_delay_ms=10_000)
+
+        # Not started: written immediately on its own
+        alone = await writer.submit(1, 1, "text", text="alone")
+        assert alone.id is not None
+
+        await writer.start()
+        pending = asyncio.create_task(writer.submit(1, 1, "text", text="queued"))
+        await asyncio.sleep(0)
+        await writer.stop()
+        assert (await pending).id is not None
+        assert writer.get_stats()["pending"] == 0
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_resend_with_same_client_msg_id_returns_original(tmp_path):
+    async def scenario():
+        engine, sessions = await make_db(tmp_path)
+        writer = MessageWriter(sessions, max_delay_ms=50)
+        await writer.start()
+
+        # The original and a retry racing it in the same batch window
+        results = await asyncio.gather(
+            writer.submit(1, 1, "text", text="hi", client_msg_id="c1"),
+            writer.submit(1, 1, "text", text="hi", client_msg_id="c1"),
+            return_exceptions=True
+        )
+        original, retry = results
+        assert isinstance(retry, DuplicateMessage) and retry.message_id == original.id
+
+        # A later retry is answered from the LRU without touching the database
+        commits = sessions.commits
+        with pytest.raises(DuplicateMessage) as dup:
+            await writer.submit(1, 1, "text", text="hi", client_msg_id="c1")
+        assert dup.value.message_id == original.id
+        assert sessions.commits == commits
+
+        # The id is scoped to the sender
+        other = await writer.submit(1, 2, "text", text="hi", client_msg_id="c1")
+        assert other.id != original.id
+        await writer.stop()
+
+        async with sessions.sessions() as db:
+            assert (await db.execute(select(func.count(Message.id)))).scalar() == 2
+        assert writer.stats["duplicates"] == 2
+        await engine.dispose()
+
+    asyncio.run(scenario())
+
+
+def test_resend_after_cache_loss_is_caught_by_unique_index(tmp_path):
+    async def scenario():
+        engine, sessions = await make_db(tmp_path)
+        first = MessageWriter(sessions, max_delay_ms=5)
+        await first.start()
+        original = await first.submit(1, 1, "text", text="hi", client_msg_id="c1")
+        await first.stop()
+
+        # e.g. another worker, or this one after a restart: empty LRU
+        second = MessageWriter(sessions, max_delay_ms=5)
+        await second.start()
+        with pytest.raises(DuplicateMessage) as dup:
+            await second.submit(1, 1, "text", text="hi", client_msg_id="c1")
+        await second.stop()
+
+        assert dup.value.message_id == original.id
+        async with sessions.sessions() as db:
+            assert (await db.execute(select(func.count(Message.id)))).scalar() == 1
+        await engine.dispose()
+
+    asyncio.run(scenario())
@@ -0,0 +1,141 @@
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+
+import migrations
+from migrations import run_migrations
+
+
+def test_read_watermark_column_is_added_and_backfilled(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    # Schema as it was before chat_members.last_read_message_id existed
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE chat_members (id INTEGER PRIMARY KEY, chat_id INTEGER, user_id INTEGER)"))
+        conn.execute(text(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, chat_id INTEGER, sender_id INTEGER, created_at DATETIME)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE message_status (id INTEGER PRIMARY KEY, message_id INTEGER, user_id INTEGER, read_at DATETIME)"
+        ))
+        conn.execute(text("INSERT INTO chat_members (chat_id, user_id) VALUES (1, 1), (1, 2), (2, 2)"))
+        conn.execute(text("INSERT INTO messages (id, chat_id) VALUES (1, 1), (2, 1), (3, 1), (4, 2)"))
+        conn.execute(text(
+            "INSERT INTO message_status (message_id, user_id, read_at) VALUES "
+            "(1, 2, '2024-01-01'), (2, 2, '2024-01-01'), (3, 2, NULL), (4, 1, '2024-01-01')"
+        ))
+
+    assert run_migrations(engine) == [
+        "chat_members.last_read_message_id", "messages.client_msg_id", "uq_messages_sender_client_msg",
+        "ix_messages_chat_id_id", "ix_messages_chat_created", "uq_chat_members_chat_user",
+        "ix_chat_members_user_chat", "uq_message_status_message_user"
+    ]
+    # Second run (or another worker) finds nothing to do
+    assert run_migrations(engine) == []
+
+    assert "last_read_message_id" in {c["name"] for c in inspect(engine).get_columns("chat_members")}
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT chat_id, user_id, last_read_message_id FROM chat_members ORDER BY id"
+        )).all()
+    # Only messages actually read, and only in the member's own chat
+    assert rows == [(1, 1, None), (1, 2, 2), (2, 2, None)]
+
+
+def test_client_msg_id_index_is_unique(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE messages (id INTEGER PRIMARY KEY, chat_id INTEGER, sender_id INTEGER)"))
+        conn.execute(text("INSERT INTO messages (chat_id, sender_id) VALUES (1, 1), (1, 1)"))
+    run_migrations(engine)
+
+    indexes = {i["name"]: i for i in inspect(engine).get_indexes("messages")}
+    assert indexes["uq_messages_sender_client_msg"]["unique"]
+    with engine.begin() as conn:
+        # Old rows have no client_msg_id; NULLs never collide
+        conn.execute(text("INSERT INTO messages (chat_id, sender_id, client_msg_id) VALUES (1, 1, 'a'), (1, 2, 'a')"))
+    with pytest.raises(IntegrityError):
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO messages (chat_id, sender_id, client_msg_id) VALUES (1, 1, 'a')"))
+
+
+def test_duplicates_are_removed_before_unique_indexes(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE chat_members (id INTEGER PRIMARY KEY, chat_id INTEGER, user_id INTEGER)"))
+        conn.execute(text("INSERT INTO chat_members (id, chat_id, user_id) VALUES (1, 1, 1), (2, 1, 2), (3, 1, 1)"))
+
+    assert "uq_chat_members_chat_user" in run_migrations(engine)
+
+    with engine.connect() as conn:
+        # The oldest membership of each pair is kept
+        assert conn.execute(text("SELECT id FROM chat_members ORDER BY id")).scalars().all() == [1, 2]
+    with pytest.raises(IntegrityError):
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO chat_members (chat_id, user_id) VALUES (1, 2)"))
+
+
+def test_invalid_index_is_dropped_and_rebuilt(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE chat_members (id INTEGER PRIMARY KEY, chat_id INTEGER, user_id INTEGER)"))
+        # What an interrupted CREATE UNIQUE INDEX CONCURRENTLY leaves behind: the name, enforcing nothing
+        conn.execute(text("CREATE INDEX uq_chat_members_chat_user ON chat_members (chat_id, user_id)"))
+        conn.execute(text("INSERT INTO chat_members (id, chat_id, user_id) VALUES (1, 1, 1), (2, 1, 1)"))
+    monkeypatch.setattr(migrations, "_invalid_indexes", lambda engine: {"uq_chat_members_chat_user"})
+
+    assert "uq_chat_members_chat_user" in run_migrations(engine)
+
+    indexes = {i["name"]: i for i in inspect(engine).get_indexes("chat_members")}
+    assert indexes["uq_chat_members_chat_user"]["unique"]
+    with engine.connect() as conn:
+        assert conn.execute(text("SELECT id FROM chat_members")).scalars().all() == [1]
+
+
+def test_chat_summary_columns_are_backfilled(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE chats (id INTEGER PRIMARY KEY, type VARCHAR(16))"))
+        conn.execute(text(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, chat_id INTEGER, sender_id INTEGER, created_at DATETIME)"
+        ))
+        conn.execute(text("INSERT INTO chats (id, type) VALUES (1, 'group'), (2, 'direct')"))
+        conn.execute(text(
+            "INSERT INTO messages (id, chat_id, created_at) VALUES "
+            "(1, 1, '2024-01-01 10:00:00'), (2, 1, '2024-01-01 11:00:00'), (3, 1, '2024-01-01 09:00:00')"
+        ))
+
+    added = run_migrations(engine)
+
+    assert {"chats.last_message_id", "chats.last_message_at", "chats.message_count"} <= set(added)
+    with engine.connect() as conn:
+        rows = conn.execute(text(
+            "SELECT id, message_count, last_message_id, last_message_at FROM chats ORDER BY id"
+        )).all()
+    # The newest message is the highest id, whatever its timestamp says
+    assert rows == [(1, 3, 3, "2024-01-01 09:00:00"), (2, 0, None, None)]
+
+
+def test_unread_counts_are_backfilled(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'old.db'}")
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE chat_members (id INTEGER PRIMARY KEY, chat_id INTEGER, user_id INTEGER, last_seen_at DATETIME)"
+        ))
+        conn.execute(text(
+            "CREATE TABLE messages (id INTEGER PRIMARY KEY, chat_id INTEGER, sender_id INTEGER, created_at DATETIME)"
+        ))
+        conn.execute(text(
+            "INSERT INTO chat_members (chat_id, user_id, last_seen_at) VALUES "
+            "(1, 1, NULL), (1, 2, '2024-01-01 10:30:00'), (1, 3, '2024-01-02 00:00:00')"
+        ))
+        conn.execute(text(
+            "INSERT INTO messages (chat_id, sender_id, created_at) VALUES "
+            "(1, 1, '2024-01-01 10:00:00'), (1, 3, '2024-01-01 11:00:00'), (1, NULL, '2024-01-01 12:00:00')"
+        ))
+
+    assert "chat_members.unread_count" in run_migrations(engine)
+
+    with engine.connect() as conn:
+        counts = conn.execute(text("SELECT unread_count FROM chat_members ORDER BY user_id")).scalars().all()
+    # Others' messages after last_seen_at; system messages don't count
+    assert counts == [1, 1, 0]
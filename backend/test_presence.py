@@ -0,0 +1,136 @@
+import asyncio
+import json
+
+from backplane import InProcessBackplane, InProcessHub
+from connection_manager import ConnectionManager
+from presence import PresenceService
+from test_connection_manager import FakeWebSocket, drain
+
+
+class PeersLoader:
+    """Counts how often the (normally DB-backed) peer lookup is hit."""
+
+    def __init__(self, peers_by_user):
+        self.peers_by_user = peers_by_user
+        self.calls = 0
+
+    def __call__(self, user_id):
+        self.calls += 1
+        return self.peers_by_user.get(user_id, set())
+
+
+def presence_frames(socket):
+    return [json.loads(m)["users"] for m in socket.sent if json.loads(m)["type"] == "presence.update"]
+
+
+def test_changes_are_batched_into_one_frame_per_peer():
+    async def scenario():
+        manager = ConnectionManager()
+        loader = PeersLoader({1: {2, 3}, 2: {1}, 3: {1}})
+        presence = PresenceService(manager, loader, interval=60)
+        alice = FakeWebSocket()
+        await manager.connect(alice, 0, 1)
+        await presence.flush()
+        await drain()
+
+        await manager.connect(FakeWebSocket(), 0, 2)
+        await manager.connect(FakeWebSocket(), 0, 3)
+        await presence.flush()
+        await drain()
+
+        [users] = presence_frames(alice)
+        assert sorted((u["user_id"], u["online"]) for u in users) == [(2, True), (3, True)]
+        assert all(u["last_active"] for u in users)
+        assert presence.stats["frames"] == 1
+
+    asyncio.run(scenario())
+
+
+def test_reconnect_within_one_interval_sends_nothing():
+    async def scenario():
+        manager = ConnectionManager()
+        presence = PresenceService(manager, PeersLoader({1: {2}, 2: {1}}), interval=60)
+        alice, bob = FakeWebSocket(), FakeWebSocket()
+        await manager.connect(alice, 0, 1)
+        await manager.connect(bob, 0, 2)
+        await presence.flush()
+        await drain()
+        alice.sent.clear()
+
+        await manager.disconnect(bob, None, 2)
+        await manager.connect(FakeWebSocket(), 0, 2)
+        await presence.flush()
+        await drain()
+        assert alice.sent == []
+
+        await manager.disconnect(alice, None, 1)
+        assert not presence.is_online(1)
+
+    asyncio.run(scenario())
+
+
+def test_snapshot_and_remote_workers():
+    async def scenario():
+        hub = InProcessHub()
+        loader = PeersLoader({1: {2}, 2: {1}})
+        workers = []
+        for _ in range(2):
+            manager = ConnectionManager(backplane=InProcessBackplane(hub))
+            presence = PresenceService(manager, loader, interval=60)
+            await manager.start()
+            await presence.start()
+            workers.append((manager, presence))
+        (a, presence_a), (b, presence_b) = workers
+
+        bob = FakeWebSocket()
+        await b.connect(bob, 0, 2)
+        await drain()
+        assert presence_a.is_online(2)
+        await presence_a.flush()
+
+        # alice connects to worker a and gets bob's state right away
+        alice = FakeWebSocket()
+        await a.connect(alice, 0, 1)
+        await presence_a.send_snapshot(alice, 1)
+        await drain()
+        assert presence_frames(alice)[0][0]["online"] is True
+
+        # bob leaves worker b; worker a tells alice on its next flush
+        await b.disconnect(bob, None, 2)
+        await drain()
+        await presence_a.flush()
+        await drain()
+        assert presence_frames(alice)[-1][0] == {**presence_a.status(2), "online": False}
+        # Peers were looked up once per user and then served from the cache
+        assert loader.calls <= 4
+
+        for manager, presence in workers:
+            await presence.stop()
+            await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_membership_change_clears_cached_peers():
+    async def scenario():
+        manager = ConnectionManager()
+        loader = PeersLoader({1: set()})
+        presence = PresenceService(manager, loader, interval=60)
+        assert await presence.get_peers(1) == set()
+
+        loader.peers_by_user[1] = {5}
+        manager.invalidate_chat_members(10)
+        assert await presence.get_peers(1) == {5}
+
+    asyncio.run(scenario())
+
+
+def test_async_peers_loader_is_awaited():
+    async def load_peers(user_id):
+        return {user_id + 1}
+
+    async def scenario():
+        presence = PresenceService(ConnectionManager(), load_peers, interval=60)
+        assert await presence.get_peers(1) == {2}
+
+    asyncio.run(scenario())
@@ -0,0 +1,55 @@
+from rate_limit import DEFAULT_LIMITS, RateLimiter, TokenBucket, parse_limits
+
+
+def test_bucket_allows_burst_then_refills_at_rate():
+    bucket = TokenBucket(rate=2, burst=3)
+    now = bucket.updated
+
+    assert [bucket.take(now) for _ in range(3)] == [0, 0, 0]
+    assert bucket.take(now) == 0.5
+    # Half a second later one token is back
+    assert bucket.take(now + 0.5) == 0
+
+
+def test_flood_is_rejected_with_one_error_frame_per_empty_spell():
+    limiter = RateLimiter({"message.send": (1, 2), "*": (0, 0)})
+    limits = limiter.for_connection()
+
+    results = [limits.check("message.send") for _ in range(5)]
+    assert results[:2] == [None, None]
+    assert results[2]["code"] == "rate_limited"
+    assert results[2]["event"] == "message.send"
+    assert 0 < results[2]["retry_after"] <= 1
+    # Still limited, but the client was already told
+    assert results[3:] == [{}, {}]
+
+    # Other event types have their own buckets ("*" = 0 disables the limit)
+    assert all(limits.check("ping") is None for _ in range(100))
+    assert limiter.get_stats()["throttled_by_event"] == {"message.send": 3}
+
+
+def test_connections_do_not_share_buckets():
+    limiter = RateLimiter({"ping": (1, 1)})
+    first, second = limiter.for_connection(), limiter.for_connection()
+
+    assert first.check("ping") is None
+    assert first.check("ping")
+    assert second.check("ping") is None
+
+
+def test_unknown_events_fall_into_the_wildcard_bucket():
+    limiter = RateLimiter({"*": (1, 2)})
+    limits = limiter.for_connection()
+
+    assert limits.check("no.such.event") is None
+    assert limits.check(None) is None
+    assert limits.check("other") is not None
+
+
+def test_parse_limits_overrides_defaults():
+    limits = parse_limits("message.send=2/4, ping=0, bogus=x")
+
+    assert limits["message.send"] == (2, 4)
+    assert limits["ping"] == (0, 1)
+    assert limits["message.read"] == DEFAULT_LIMITS["message.read"]
+    assert "bogus" not in limits
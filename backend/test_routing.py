@@ -0,0 +1,122 @@
+import asyncio
+
+from backplane import InProcessBackplane, InProcessHub
+from routing import HashRing, NodeDirectory, RoutedConnectionManager, parse_nodes
+from test_connection_manager import FakeWebSocket, MembersLoader, drain
+
+
+class CountingBackplane(InProcessBackplane):
+    """Records every channel published on."""
+
+    def __init__(self, hub):
+        super().__init__(hub)
+        self.published = []
+
+    async def publish(self, channel, payload):
+        self.published.append(channel)
+        await super().publish(channel, payload)
+
+
+def test_hash_ring_only_moves_keys_of_the_changed_node():
+    ring = HashRing(["a", "b", "c"])
+    before = {user_id: ring.node_for_user(user_id) for user_id in range(1000)}
+    assert set(before.values()) == {"a", "b", "c"}
+
+    ring.add("d")
+    after = {user_id: ring.node_for_user(user_id) for user_id in range(1000)}
+    moved = [user_id for user_id in before if before[user_id] != after[user_id]]
+    assert all(after[user_id] == "d" for user_id in moved)
+    assert 100 < len(moved) < 400
+
+    ring.remove("d")
+    assert {user_id: ring.node_for_user(user_id) for user_id in range(1000)} == before
+
+
+def test_node_directory_snapshots_and_goodbyes():
+    directory = NodeDirectory()
+    directory.add("a", 1)
+    directory.add("b", 1)
+    directory.replace_node("b", [2, 3])
+    assert directory.nodes_for([1]) == {"a"}
+    assert directory.nodes_for([1, 3]) == {"a", "b"}
+
+    directory.drop_node("a")
+    assert directory.nodes_by_user == {2: {"b"}, 3: {"b"}}
+
+
+def test_parse_nodes():
+    assert parse_nodes("a=http://h:8001/, b=http://h:8002") == {"a": "http://h:8001", "b": "http://h:8002"}
+    assert parse_nodes("") == {}
+
+
+def test_broadcast_is_published_only_to_nodes_holding_members():
+    async def scenario():
+        hub = InProcessHub()
+        nodes = {}
+        for node_id in ("a", "b", "c"):
+            manager = RoutedConnectionManager(backplane=CountingBackplane(hub), node_id=node_id,
+                                              node_urls={"a": "", "b": "", "c": ""})
+            manager.members_loader = MembersLoader({10: [1, 2], 20: [1, 3]})
+            await manager.start()
+            nodes[node_id] = manager
+
+        # alice on a (two devices), bob on b, carol on c
+        sockets = {}
+        for node_id, user_id in (("a", 1), ("a", 1), ("b", 2), ("c", 3)):
+            socket = FakeWebSocket()
+            await nodes[node_id].connect(socket, 0, user_id)
+            sockets.setdefault(user_id, []).append(socket)
+        await drain()
+        assert nodes["a"].directory.nodes_by_user == {2: {"b"}, 3: {"c"}}
+
+        a = nodes["a"]
+        a.backplane.published.clear()
+        await a.broadcast(10, "to chat 10", MembersLoader({10: [1, 2]}))
+        await a.send_to_user(3, "to carol")
+        await drain()
+
+        assert a.backplane.published == ["node:b", "node:c"]
+        assert [s.sent for s in sockets[1]] == [["to chat 10"], ["to chat 10"]]
+        assert sockets[2][0].sent == ["to chat 10"]
+        assert sockets[3][0].sent == ["to carol"]
+
+        # Once bob leaves, node b drops out of chat 10's fan-out
+        await nodes["b"].disconnect(sockets[2][0], None, 2)
+        await drain()
+        a.backplane.published.clear()
+        await a.broadcast(10, "again", MembersLoader({10: [1, 2]}))
+        assert a.backplane.published == []
+        assert a.get_stats()["routing"]["local_only"] == 1
+
+        for manager in nodes.values():
+            await manager.stop()
+
+    asyncio.run(scenario())
+
+
+def test_late_node_learns_the_directory_and_forgets_stopped_nodes():
+    async def scenario():
+        hub = InProcessHub()
+        first = RoutedConnectionManager(backplane=InProcessBackplane(hub), node_id="a")
+        await first.start()
+        await first.connect(FakeWebSocket(), 0, 1)
+        await drain()
+
+        late = RoutedConnectionManager(backplane=InProcessBackplane(hub), node_id="b")
+        await late.start()
+        await drain()
+        assert late.directory.nodes_for([1]) == {"a"}
+
+        await first.stop()
+        assert late.directory.nodes_for([1]) == set()
+        await late.stop()
+
+    asyncio.run(scenario())
+
+
+def test_route_uses_configured_node_urls():
+    manager = RoutedConnectionManager(node_id="a", node_urls={"a": "http://h:8001", "b": "http://h:8002"})
+    route = manager.route(7, chat_id=10)
+    assert route["node"] in ("a", "b")
+    assert route["url"] == manager.node_urls[route["node"]]
+    assert route["chat_url"] == manager.node_urls[route["chat_node"]]
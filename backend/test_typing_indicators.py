@@ -0,0 +1,89 @@
+import asyncio
+import json
+
+from connection_manager import ConnectionManager
+from test_connection_manager import FakeWebSocket, MembersLoader, drain
+from typing_indicators import TypingService
+
+
+def typing_frames(socket):
+    return [
+        (frame["user_id"], frame["typing"])
+        for frame in map(json.loads, socket.sent) if frame["type"] == "typing.update"
+    ]
+
+
+async def chat_with_two_members(**kwargs):
+    manager = ConnectionManager()
+    loader = MembersLoader({10: [1, 2]})
+    service = TypingService(manager, loader, **kwargs)
+    alice, bob = FakeWebSocket(), FakeWebSocket()
+    await manager.connect(alice, 0, 1)
+    await manager.connect(bob, 0, 2)
+    return manager, loader, service, alice, bob
+
+
+def test_typing_is_throttled_and_only_loads_members_once():
+    async def scenario():
+        manager, loader, service, alice, bob = await chat_with_two_members(throttle=60, ttl=60)
+
+        for _ in range(100):
+            assert await service.handle(10, 1, True)
+        await drain()
+        await service.handle(10, 1, False)
+        await service.handle(10, 1, False)  # already stopped: nothing to send
+        await drain()
+
+        assert typing_frames(bob) == [(1, True), (1, False)]
+        assert service.stats["throttled"] == 99
+        # Membership came from the cached index: one load for 102 events
+        assert loader.calls == 1
+
+    asyncio.run(scenario())
+
+
+def test_typing_expires_and_non_members_are_rejected():
+    async def scenario():
+        manager, loader, service, alice, bob = await chat_with_two_members(throttle=0, ttl=0.05)
+
+        assert not await service.handle(10, 3, True)
+        await service.handle(10, 1, True)
+        await asyncio.sleep(0.06)
+        await service.expire()
+        await drain()
+
+        assert typing_frames(bob) == [(1, True), (1, False)]
+        assert service.get_stats() == {
+            "typing_now": 0, "events": 2, "broadcasts": 2, "throttled": 0, "expired": 1, "rejected": 1
+        }
+
+    asyncio.run(scenario())
+
+
+def test_typing_stops_when_the_users_last_device_leaves():
+    async def scenario():
+        manager, loader, service, alice, bob = await chat_with_two_members(throttle=60, ttl=60)
+
+        await service.handle(10, 1, True)
+        await drain()
+        await manager.disconnect(alice, None, 1)
+        await service.expire()
+        await drain()
+
+        assert typing_frames(bob) == [(1, True), (1, False)]
+
+    asyncio.run(scenario())
+
+
+def test_queued_typing_frames_are_superseded():
+    async def scenario():
+        manager, loader, service, alice, bob = await chat_with_two_members(throttle=0, ttl=60)
+
+        # Neither writer has run yet, so "stopped" replaces the queued "started"
+        await service.handle(10, 1, True)
+        await service.handle(10, 1, False)
+        await drain()
+
+        assert typing_frames(bob) == [(1, False)]
+
+    asyncio.run(scenario())
@@ -0,0 +1,98 @@
+import asyncio
+import json
+
+import pytest
+
+msgpack = pytest.importorskip("msgpack")
+
+from connection_manager import ConnectionManager
+from test_connection_manager import FakeWebSocket, MembersLoader, drain
+from wire import (JSON_CODEC, MSGPACK_CODEC, SUBPROTOCOL_JSON, SUBPROTOCOL_MSGPACK, FrameDecodeError,
+                  JsonCodec, choose_codec, expand)
+
+
+class BinaryWebSocket(FakeWebSocket):
+    async def send_bytes(self, data: bytes):
+        self.sent.append(data)
+
+
+MESSAGE_NEW = {
+    "type": "message.new",
+    "chat_id": 1,
+    "message": {
+        "id": 7, "chat_id": 1, "sender_id": 2, "sender_username": "bob", "type": "text",
+        "text": "hi", "media_url": None, "content": "hi",
+        "created_at": "2024-01-01T00:00:00", "timestamp": "2024-01-01T00:00:00",
+        "read_by": [], "read_count": 0, "status": None,
+    },
+}
+
+
+def test_subprotocol_negotiation_prefers_msgpack():
+    assert choose_codec([SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON]) == (MSGPACK_CODEC, SUBPROTOCOL_MSGPACK)
+    assert choose_codec([SUBPROTOCOL_JSON]) == (JSON_CODEC, SUBPROTOCOL_JSON)
+    # Clients that offer nothing keep plain JSON
+    assert choose_codec([]) == (JSON_CODEC, None)
+
+
+def test_message_new_is_compact_and_drops_duplicate_fields():
+    frame = json.dumps(MESSAGE_NEW)
+    packed = MSGPACK_CODEC.encode(frame)
+    decoded = msgpack.unpackb(packed)
+
+    assert decoded["t"] == "message.new"
+    assert "ct" not in decoded["m"] and "ts" not in decoded["m"]
+    assert decoded["m"]["x"] == "hi"
+    assert len(packed) < len(frame) * 0.6
+
+
+def test_seq_prefix_is_added_to_the_cached_body():
+    body = json.dumps(MESSAGE_NEW)
+    first = msgpack.unpackb(MSGPACK_CODEC.encode('{"seq": 3, ' + body[1:]))
+    second = msgpack.unpackb(MSGPACK_CODEC.encode('{"seq": 12, ' + body[1:]))
+
+    assert first["q"] == 3 and second["q"] == 12
+    assert {k: v for k, v in first.items() if k != "q"} == msgpack.unpackb(MSGPACK_CODEC.encode(body))
+    assert msgpack.unpackb(MSGPACK_CODEC.encode('{"seq": 4}')) == {"q": 4}
+
+
+def test_inbound_frames_are_expanded_and_validated():
+    data = msgpack.packb({"t": "message.send", "c": 1, "ct": "hello", "ci": "abc"})
+    assert MSGPACK_CODEC.decode(data) == {
+        "type": "message.send", "chat_id": 1, "content": "hello", "client_msg_id": "abc"
+    }
+    assert expand({"unknown": 1}) == {"unknown": 1}
+
+    for bad in (b"\xc1", msgpack.packb([1, 2])):
+        with pytest.raises(FrameDecodeError):
+            MSGPACK_CODEC.decode(bad)
+    with pytest.raises(FrameDecodeError):
+        JSON_CODEC.decode("[1, 2]")
+
+
+def test_msgpack_and_json_sockets_get_the_same_broadcast():
+    async def scenario():
+        manager = ConnectionManager()
+        binary, text = BinaryWebSocket(), FakeWebSocket()
+        await manager.connect(binary, 0, 1, MSGPACK_CODEC)
+        await manager.connect(text, 0, 2)
+
+        await manager.broadcast(1, json.dumps(MESSAGE_NEW), MembersLoader({1: [1, 2]}))
+        await drain()
+
+        as_json = json.loads(text.sent[0])
+        as_msgpack = expand(msgpack.unpackb(binary.sent[0]))
+        assert as_msgpack["seq"] == as_json["seq"] == 1
+        assert as_msgpack["message"]["text"] == as_json["message"]["text"] == "hi"
+        assert manager.get_stats()["per_connection"][0]["codec"] in (SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON)
+
+    asyncio.run(scenario())
+
+
+def test_json_codec_counts_utf8_bytes():
+    async def scenario():
+        codec = JsonCodec()
+        await codec.send(FakeWebSocket(), '{"text": "héllo ✓"}')
+        assert codec.stats["bytes"] == len('{"text": "héllo ✓"}'.encode())
+
+    asyncio.run(scenario())
@@ -0,0 +1,77 @@
+import asyncio
+
+import pytest
+
+from wire import JSON_CODEC, MSGPACK_CODEC, FrameDecodeError
+from ws_events import ChatOpen, EventRegistry, MessageRead, MessageSend, Ping, WsContext
+
+
+def make_registry():
+    registry = EventRegistry()
+    handled = []
+
+    @registry.on(MessageSend)
+    @registry.on(MessageRead)
+    @registry.on(ChatOpen)
+    @registry.on(Ping)
+    async def record(ctx, event):
+        handled.append(event)
+
+    return registry, handled
+
+
+def test_json_frames_decode_to_typed_events_and_dispatch():
+    async def scenario():
+        registry, handled = make_registry()
+        event = registry.decode(JSON_CODEC, '{"type": "message.send", "chat_id": 3, "content": "hi", "sender_id": 9, "extra": 1}')
+
+        assert isinstance(event, MessageSend)
+        assert (event.chat_id, event.content, event.msg_type) == (3, "hi", "text")
+        # The sender is the session's user, never a field of the frame
+        assert not hasattr(event, "sender_id")
+        await registry.dispatch(WsContext(None, {}, 1, JSON_CODEC), event)
+        assert handled == [event]
+        assert registry.get_stats()["events"]["message.send"]["decoded"] == 1
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.parametrize("frame, error", [
+    ("not json", "Invalid JSON"),
+    ('{"type": "no.such.event"}', "Unknown event type"),
+    ('{"chat_id": 1}', "Unknown event type"),
+    ('{"type": "message.read", "chat_id": 1}', "Invalid message_id: Field required"),
+    ('{"type": "message.read", "chat_id": 1, "message_id": 0}', "Invalid message_id"),
+    ('{"type": "message.send", "chat_id": "x"}', "Invalid chat_id"),
+    ('{"type": "message.send", "chat_id": 1, "msg_type": "video"}', "Invalid msg_type"),
+    ('{"type": "message.send", "chat_id": 1, "client_msg_id": "%s"}' % ("x" * 65), "Invalid client_msg_id"),
+])
+def test_malformed_frames_are_rejected_before_any_handler(frame, error):
+    registry, handled = make_registry()
+
+    with pytest.raises(FrameDecodeError) as rejected:
+        registry.decode(JSON_CODEC, frame)
+
+    assert str(rejected.value).startswith(error)
+    assert handled == []
+
+
+def test_failures_are_counted_per_event_type():
+    registry, _ = make_registry()
+    for frame in ('{"type": "message.read"}', '{"type": "nope"}', "{"):
+        with pytest.raises(FrameDecodeError):
+            registry.decode(JSON_CODEC, frame)
+
+    stats = registry.get_stats()
+    assert stats["events"]["message.read"]["failed"] == 1
+    assert stats["invalid"] == 2
+
+
+def test_msgpack_frames_use_the_same_schemas():
+    msgpack = pytest.importorskip("msgpack")
+    registry, _ = make_registry()
+
+    event = registry.decode(MSGPACK_CODEC, msgpack.packb({"t": "chat.open", "c": 5}))
+    assert event == ChatOpen(type="chat.open", chat_id=5)
+    with pytest.raises(FrameDecodeError):
+        registry.decode(MSGPACK_CODEC, msgpack.packb({"t": "message.read", "c": 5}))
@@ -0,0 +1,124 @@
+# typing_indicators.py
+"""
+Typing indicators kept entirely in memory (named so it doesn't shadow the
+standard `typing` module).
+
+typing.start / typing.stop from a client never reach the database: membership
+comes from ConnectionManager's cached index, state lives in a dict, and the
+resulting typing.update frames are coalescable so they can never crowd real
+messages out of a slow socket's outbox.
+
+- Throttle: repeated typing.start from the same user in the same chat within
+  WS_TYPING_THROTTLE seconds only extends the expiry, nothing is sent.
+- Expiry: a user who stops sending typing.start (closed tab, lost network) is
+  reported as stopped WS_TYPING_TTL seconds later.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from connection_manager import ConnectionManager
+
+logger = logging.getLogger("websocket")
+
+# Minimum seconds between typing.update broadcasts for one user in one chat
+WS_TYPING_THROTTLE = float(os.getenv("WS_TYPING_THROTTLE", "2"))
+# Seconds after the last typing.start before the user is reported as stopped
+WS_TYPING_TTL = float(os.getenv("WS_TYPING_TTL", "6"))
+
+
+class TypingService:
+    """Tracks who is typing where and fans typing.update out to the chat."""
+
+    def __init__(self, manager: ConnectionManager, members_loader: Callable,
+                 throttle: float = WS_TYPING_THROTTLE, ttl: float = WS_TYPING_TTL):
+        self.manager = manager
+        # Same loader the manager uses for relayed broadcasts; only hit on a membership cache miss
+        self.members_loader = members_loader
+        self.throttle = throttle
+        self.ttl = ttl
+        # Dict[(chat_id, user_id), (expires_at, last_broadcast_at)]
+        self.active: Dict[Tuple[int, int], Tuple[float, float]] = {}
+        self._task: Optional[asyncio.Task] = None
+        # Counters exposed through the admin stats endpoint
+        self.stats = {"events": 0, "broadcasts": 0, "throttled": 0, "expired": 0, "rejected": 0}
+        manager.add_user_listener(self._on_user_change)
+
+    async def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(min(1.0, self.ttl / 2))
+            try:
+                await self.expire()
+            except Exception as e:
+                logger.error(f"Typing expiry failed: {e}", exc_info=True)
+
+    async def handle(self, chat_id: int, user_id: int, typing: bool) -> bool:
+        """
+        Apply a typing.start (typing=True) or typing.stop from a client.
+        Returns False if the user isn't a member of the chat.
+        """
+        self.stats["events"] += 1
+        try:
+            member_ids = await self.manager.get_chat_member_ids(chat_id, self.members_loader)
+        except Exception:
+            member_ids = set()
+        if user_id not in member_ids:
+            self.stats["rejected"] += 1
+            return False
+
+        key = (chat_id, user_id)
+        now = time.monotonic()
+        current = self.active.get(key)
+        if typing:
+            if current is not None and now - current[1] < self.throttle:
+                self.active[key] = (now + self.ttl, current[1])
+                self.stats["throttled"] += 1
+                return True
+            self.active[key] = (now + self.ttl, now)
+            await self._broadcast(chat_id, user_id, True)
+        elif current is not None:
+            del self.active[key]
+            await self._broadcast(chat_id, user_id, False)
+        return True
+
+    def clear(self, chat_id: int, user_id: int):
+        """Forget a typing state without broadcasting (e.g. the message was sent; clients clear on message.new)."""
+        self.active.pop((chat_id, user_id), None)
+
+    async def expire(self):
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self.active.items() if expires_at <= now]:
+            del self.active[key]
+            self.stats["expired"] += 1
+            await self._broadcast(key[0], key[1], False)
+
+    def _on_user_change(self, user_id: int, online: bool):
+        # The user's last device went away: stop their indicators on the next expiry pass
+        if not online:
+            for key, (_, last) in list(self.active.items()):
+                if key[1] == user_id:
+                    self.active[key] = (0, last)
+
+    async def _broadcast(self, chat_id: int, user_id: int, typing: bool):
+        self.stats["broadcasts"] += 1
+        frame = {"type": "typing.update", "chat_id": chat_id, "user_id": user_id, "typing": typing}
+        if typing:
+            frame["expires_in"] = self.ttl
+        await self.manager.broadcast(
+            chat_id, json.dumps(frame), self.members_loader,
+            coalesce_key=("typing.update", chat_id, user_id)
+        )
+
+    def get_stats(self) -> dict:
+        return {"typing_now": len(self.active), **self.stats}
@@ -0,0 +1,237 @@
+# wire.py
+"""
+Frame encodings for /api/ws, picked per socket through the WebSocket subprotocol.
+
+- "wazzap.json" (or no subprotocol): JSON text frames, as always.
+- "wazzap.msgpack.v1": MessagePack binary frames in both directions, with the
+  compact field schema below: known keys are shortened (KEYS) and the fields a
+  message repeats for older clients ("content" = text or media_url, "timestamp" =
+  created_at) are left out; the client restores them.
+
+Frames travel through the manager, the backplane and the replay buffers as JSON
+strings and are only converted when written to a MessagePack socket. A broadcast
+is converted once, not once per recipient: the per-user "seq" prefix (see
+event_log.py) is split off and the packed rest of the frame is cached.
+
+MessagePack needs the optional `msgpack` package; without it only JSON is offered.
+"""
+import json
+import logging
+from functools import lru_cache
+from typing import Any, Iterable, Optional, Tuple, Union
+
+try:
+    import msgpack
+except ImportError:  # optional: clients fall back to JSON
+    msgpack = None
+
+logger = logging.getLogger("websocket")
+
+SUBPROTOCOL_JSON = "wazzap.json"
+SUBPROTOCOL_MSGPACK = "wazzap.msgpack.v1"
+
+# Full field name -> name on the MessagePack wire (keep in sync with frontend/src/services/wire.js)
+KEYS = {
+    "type": "t",
+    "seq": "q",
+    "chat_id": "c",
+    "message": "m",
+    "message_id": "mi",
+    "id": "i",
+    "sender_id": "s",
+    "sender_username": "su",
+    "text": "x",
+    "media_url": "mu",
+    "content": "ct",
+    "created_at": "ca",
+    "timestamp": "ts",
+    "read_by": "rb",
+    "read_count": "rc",
+    "status": "st",
+    "user_id": "u",
+    "username": "un",
+    "users": "us",
+    "online": "o",
+    "last_active": "la",
+    "typing": "ty",
+    "expires_in": "e",
+    "up_to_message_id": "ut",
+    "client_msg_id": "ci",
+    "duplicate": "d",
+    "msg_type": "mt",
+    "error": "er",
+    "code": "co",
+    "retry_after": "ra",
+}
+NAMES = {short: name for name, short in KEYS.items()}
+
+SEQ_PREFIX = '{"seq": '
+
+
+class FrameDecodeError(ValueError):
+    """An inbound frame could not be decoded into an event object."""
+
+
+def _compact_message(message: dict) -> dict:
+    """Leave out the fields of a chat message that only repeat others."""
+    message = dict(message)
+    primary = message.get("media_url") if message.get("type") == "media" else message.get("text")
+    if "content" in message and message["content"] == primary:
+        del message["content"]
+    if "timestamp" in message and message["timestamp"] == message.get("created_at"):
+        del message["timestamp"]
+    return message
+
+
+def compact(value: Any, parent_key: Optional[str] = None) -> Any:
+    """Shorten the keys of a decoded frame (recursively)."""
+    if isinstance(value, dict):
+        if parent_key == "message":
+            value = _compact_message(value)
+        return {KEYS.get(key, key): compact(item, key) for key, item in value.items()}
+    if isinstance(value, list):
+        return [compact(item, parent_key) for item in value]
+    return value
+
+
+def expand(value: Any) -> Any:
+    """Inverse of compact() for the keys (inbound frames)."""
+    if isinstance(value, dict):
+        return {NAMES.get(key, key) if isinstance(key, str) else key: expand(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [expand(item) for item in value]
+    return value
+
+
+def _map_header(size: int) -> bytes:
+    if size < 16:
+        return bytes([0x80 | size])
+    if size < 0x10000:
+        return b"\xde" + size.to_bytes(2, "big")
+    return b"\xdf" + size.to_bytes(4, "big")
+
+
+@lru_cache(maxsize=512)
+def _pack_object(frame: str) -> Tuple[Optional[int], bytes]:
+    """
+    Pack a JSON frame. For objects returns (entry count, packed entries without the
+    map header) so a seq entry can be put in front; otherwise (None, packed value).
+    """
+    try:
+        value = json.loads(frame)
+    except ValueError:
+        return None, msgpack.packb(frame)
+    if not isinstance(value, dict):
+        return None, msgpack.packb(compact(value))
+    value = compact(value)
+    packed = msgpack.packb(value)
+    return len(value), packed[len(_map_header(len(value))):]
+
+
+class JsonCodec:
+    """Text frames, JSON both ways."""
+
+    subprotocol = SUBPROTOCOL_JSON
+    binary = False
+    invalid_error = "Invalid JSON"
+
+    def __init__(self):
+        self.stats = {"frames": 0, "bytes": 0}
+
+    async def send(self, websocket, message: str):
+        await websocket.send_text(message)
+        self.stats["frames"] += 1
+        self.stats["bytes"] += len(message.encode())
+
+    async def receive(self, websocket) -> str:
+        return await websocket.receive_text()
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        try:
+            payload = json.loads(data)
+        except ValueError as e:
+            raise FrameDecodeError(str(e)) from e
+        if not isinstance(payload, dict):
+            raise FrameDecodeError("Frame is not an object")
+        return payload
+
+
+class MsgpackCodec(JsonCodec):
+    """Binary frames, MessagePack with the compact field schema both ways."""
+
+    subprotocol = SUBPROTOCOL_MSGPACK
+    binary = True
+    invalid_error = "Invalid MessagePack"
+
+    def __init__(self):
+        super().__init__()
+        # What the same frames would have cost as JSON text
+        self.stats["json_bytes"] = 0
+
+    def encode(self, message: str) -> bytes:
+        seq = None
+        body = message
+        if message.startswith(SEQ_PREFIX):
+            end = message.find(",", len(SEQ_PREFIX))
+            if end == -1:
+                end = message.find("}", len(SEQ_PREFIX))
+                rest = "{}"
+            else:
+                rest = "{" + message[end + 1:]
+            try:
+                seq = int(message[len(SEQ_PREFIX):end])
+                body = rest
+            except ValueError:
+                seq = None
+        size, packed = _pack_object(body)
+        if size is None:
+            return packed
+        if seq is None:
+            return _map_header(size) + packed
+        return _map_header(size + 1) + msgpack.packb(KEYS["seq"]) + msgpack.packb(seq) + packed
+
+    async def send(self, websocket, message: str):
+        data = self.encode(message)
+        await websocket.send_bytes(data)
+        self.stats["frames"] += 1
+        self.stats["bytes"] += len(data)
+        self.stats["json_bytes"] += len(message.encode())
+
+    async def receive(self, websocket) -> bytes:
+        return await websocket.receive_bytes()
+
+    def decode(self, data: Union[str, bytes]) -> dict:
+        try:
+            payload = msgpack.unpackb(data, raw=False)
+        except Exception as e:
+            raise FrameDecodeError(str(e)) from e
+        if not isinstance(payload, dict):
+            raise FrameDecodeError("Frame is not a map")
+        return expand(payload)
+
+
+JSON_CODEC = JsonCodec()
+MSGPACK_CODEC = MsgpackCodec() if msgpack is not None else None
+
+
+def choose_codec(offered: Iterable[str]) -> Tuple[JsonCodec, Optional[str]]:
+    """
+    Pick the codec for a new socket from the subprotocols the client offered.
+    Returns (codec, subprotocol to accept with, or None if the client offered none we know).
+    """
+    offered = list(offered)
+    if MSGPACK_CODEC is not None and SUBPROTOCOL_MSGPACK in offered:
+        return MSGPACK_CODEC, SUBPROTOCOL_MSGPACK
+    if SUBPROTOCOL_JSON in offered:
+        return JSON_CODEC, SUBPROTOCOL_JSON
+    return JSON_CODEC, None
+
+
+def get_stats() -> dict:
+    stats = {"json": dict(JSON_CODEC.stats), "msgpack_available": MSGPACK_CODEC is not None}
+    if MSGPACK_CODEC is not None:
+        stats["msgpack"] = dict(MSGPACK_CODEC.stats)
+        info = _pack_object.cache_info()
+        stats["msgpack"]["cache_hits"] = info.hits
+        stats["msgpack"]["cache_misses"] = info.misses
+    return stats
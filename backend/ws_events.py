@@ -0,0 +1,166 @@
+# ws_events.py
+"""
+Typed inbound events for /api/ws and the registry that dispatches them.
+
+Each event type is a pydantic model with a `type` literal; handlers register
+for a model and receive the decoded instance. All models are compiled once into
+a single TypeAdapter over a union discriminated by `type`, so a JSON frame is
+parsed and validated in one pass (validate_json, no json.loads first) and a
+MessagePack frame, already a dict, with validate_python. Malformed or unknown
+events are rejected here, before a handler (and any DB work) runs.
+
+Decode time and failures are counted per event type (get_stats()).
+"""
+import logging
+import time
+from dataclasses import dataclass
+from typing import Annotated, Any, Awaitable, Callable, Dict, Literal, Optional, Tuple, Type, Union
+
+from fastapi import WebSocket
+from pydantic import BaseModel, ConfigDict, Field, TypeAdapter, ValidationError
+
+from wire import FrameDecodeError, JsonCodec
+
+logger = logging.getLogger("websocket")
+
+
+# -----------------------
+# EVENTS (client -> server)
+# -----------------------
+class WsEvent(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+
+
+class ChatOpen(WsEvent):
+    type: Literal["chat.open"]
+    chat_id: int
+
+
+class MessageSend(WsEvent):
+    type: Literal["message.send"]
+    chat_id: int
+    content: Optional[str] = Field(None, max_length=1024)
+    media_url: Optional[str] = Field(None, max_length=1024)
+    msg_type: Literal["text", "media"] = "text"
+    client_msg_id: Optional[str] = Field(None, max_length=64)
+
+
+class MessageRead(WsEvent):
+    type: Literal["message.read"]
+    chat_id: int = Field(gt=0)
+    message_id: int = Field(gt=0)
+
+
+class TypingStart(WsEvent):
+    type: Literal["typing.start"]
+    chat_id: int
+
+
+class TypingStop(WsEvent):
+    type: Literal["typing.stop"]
+    chat_id: int
+
+
+class Ping(WsEvent):
+    type: Literal["ping"]
+
+
+class Pong(WsEvent):
+    type: Literal["pong"]
+
+
+@dataclass
+class WsContext:
+    """The connection an event arrived on."""
+    websocket: WebSocket
+    session: dict
+    user_id: int
+    codec: JsonCodec
+
+
+Handler = Callable[[WsContext, Any], Awaitable[None]]
+
+
+class EventRegistry:
+    """Maps event types to their model and handler coroutine."""
+
+    def __init__(self):
+        # Dict[event type, (model, handler)]
+        self.events: Dict[str, Tuple[Type[WsEvent], Handler]] = {}
+        self._adapter: Optional[TypeAdapter] = None
+        # Dict[event type, {"decoded", "failed", "decode_ns"}]
+        self.stats: Dict[str, Dict[str, int]] = {}
+        self.invalid = 0
+
+    def on(self, model: Type[WsEvent]) -> Callable[[Handler], Handler]:
+        """Decorator registering `async handler(ctx, event)` for model's event type."""
+        event_type = model.model_fields["type"].annotation.__args__[0]
+
+        def register(handler: Handler) -> Handler:
+            self.events[event_type] = (model, handler)
+            self.stats[event_type] = {"decoded": 0, "failed": 0, "decode_ns": 0}
+            self._adapter = None
+            return handler
+        return register
+
+    @property
+    def adapter(self) -> TypeAdapter:
+        if self._adapter is None:
+            models = tuple(model for model, _ in self.events.values())
+            union = Union[models] if len(models) > 1 else models[0]
+            self._adapter = TypeAdapter(Annotated[union, Field(discriminator="type")])
+        return self._adapter
+
+    def decode(self, codec: JsonCodec, data: Union[str, bytes]) -> WsEvent:
+        """Decode and validate one frame. Raises FrameDecodeError (with .event_type if known)."""
+        started = time.perf_counter_ns()
+        try:
+            if codec.binary:
+                event = self.adapter.validate_python(codec.decode(data))
+            else:
+                event = self.adapter.validate_json(data)
+        except (ValidationError, FrameDecodeError) as e:
+            self._failed(e)
+            raise FrameDecodeError(self._describe(e)) from e
+        stats = self.stats[event.type]
+        stats["decoded"] += 1
+        stats["decode_ns"] += time.perf_counter_ns() - started
+        return event
+
+    def _failed(self, error: Exception):
+        event_type = None
+        if isinstance(error, ValidationError):
+            for detail in error.errors(include_url=False):
+                if detail["type"] not in ("union_tag_invalid", "union_tag_not_found") and detail["loc"]:
+                    event_type = detail["loc"][0]
+                    break
+        if event_type in self.stats:
+            self.stats[event_type]["failed"] += 1
+        else:
+            self.invalid += 1
+
+    @staticmethod
+    def _describe(error: Exception) -> str:
+        if not isinstance(error, ValidationError):
+            return str(error)
+        detail = error.errors(include_url=False)[0]
+        if detail["type"] in ("union_tag_invalid", "union_tag_not_found"):
+            return "Unknown event type"
+        if detail["type"] == "json_invalid":
+            return "Invalid JSON"
+        field = ".".join(str(part) for part in detail["loc"][1:])
+        return f"Invalid {field}: {detail['msg']}" if field else detail["msg"]
+
+    async def dispatch(self, ctx: WsContext, event: WsEvent):
+        await self.events[event.type][1](ctx, event)
+
+    def get_stats(self) -> dict:
+        per_event = {}
+        for event_type, stats in self.stats.items():
+            decoded = stats["decoded"]
+            per_event[event_type] = {
+                "decoded": decoded,
+                "failed": stats["failed"],
+                "avg_decode_us": round(stats["decode_ns"] / decoded / 1000, 2) if decoded else None,
+            }
+        return {"events": per_event, "invalid": self.invalid}
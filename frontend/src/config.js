@@ -86,5 +86,7 @@ export const config = {
     
     // For production/Docker with domain names, use hostname-based routing
     return `${wsProtocol}://chat-api.${this.domain}/api/ws`;
-  }
+  },
+  // Ask for binary MessagePack frames on the WebSocket (opt-in with VITE_WS_MSGPACK=true)
+  wsMsgpack: import.meta.env.VITE_WS_MSGPACK === 'true'
 };
@@ -32,8 +32,8 @@ async function request(endpoint, options = {}) {
   const url = `${config.apiUrl}${endpoint}`;
   const timeoutMs = options.timeout || 10000; // Default 10 seconds
   
-  // Remove timeout from options before passing to fetch
-  const { timeout, ...fetchOptions } = options;
+  // Remove timeout (and withHeaders) from options before passing to fetch
+  const { timeout, withHeaders, ...fetchOptions } = options;
   
   try {
     const response = await Promise.race([
@@ -73,6 +73,10 @@ async function request(endpoint, options = {}) {
     throw new ApiError(errorMessage, response.status);
   }
 
+    // withHeaders: the caller also needs response headers (e.g. pagination cursors)
+    if (withHeaders) {
+      return { data: await response.json(), headers: response.headers };
+    }
     return response.json();
   } catch (err) {
     // Handle timeout and network errors
@@ -131,14 +135,28 @@ export const api = {
     return request(`/api/chats${queryString ? '?' + queryString : ''}`);
   },
 
-  async getMessages(chatId) {
+  // One page of history, oldest first: the newest messages, or those older than beforeId.
+  // prevCursor is the beforeId for the next older page (null when there is none)
+  async getMessagesPage(chatId, beforeId = null) {
     const authStore = get(auth);
     const params = new URLSearchParams();
     if (authStore.userId) {
       params.append('user_id', authStore.userId.toString());
     }
+    if (beforeId) {
+      params.append('before_id', beforeId.toString());
+    }
     const queryString = params.toString();
-    return request(`/api/chats/${chatId}/messages${queryString ? '?' + queryString : ''}`);
+    const { data, headers } = await request(
+      `/api/chats/${chatId}/messages${queryString ? '?' + queryString : ''}`,
+      { withHeaders: true }
+    );
+    return { messages: data, prevCursor: headers.get('X-Prev-Cursor') };
+  },
+
+  // The newest page of a chat's history
+  async getMessages(chatId) {
+    return (await this.getMessagesPage(chatId)).messages;
   },
 
   async uploadMedia(file) {
@@ -184,6 +202,10 @@ export const api = {
     return request('/api/users');
   },
 
+  async getWsRoute(userId) {
+    return request(`/api/ws/route?user_id=${userId}`);
+  },
+
   async createDM(user1Id, user2Id) {
     return request('/api/chats/dm', {
       method: 'POST',
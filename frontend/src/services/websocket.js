@@ -3,19 +3,30 @@ import { auth } from '../stores/auth.js';
 import { websocket } from '../stores/websocket.js';
 import { chats } from '../stores/chats.js';
 import { messages } from '../stores/messages.js';
+import { presence } from '../stores/presence.js';
+import { typing } from '../stores/typing.js';
 import { activeChatId } from '../stores/chats.js';
 import { api } from './api.js';
 import { get } from 'svelte/store';
 import { debugLog } from '../utils/debugLog.js';
+import { SUBPROTOCOL_JSON, SUBPROTOCOL_MSGPACK, decodeFrame, encodeFrame } from './wire.js';
 
 let socket = null;
 let heartbeatInterval = null;
 let reconnectAttempts = 0;
 const maxReconnectAttempts = 5;
+// message.send payloads not yet acked, by client_msg_id; resent after a reconnect
+const unackedMessages = new Map();
+// Where we are in the server's event sequence, sent back on reconnect so only
+// the events missed in between are replayed
+let eventStream = null;
+let lastSeq = null;
+// True while asking the server which node to connect to
+let resolvingRoute = false;
 
 function sendHeartbeat() {
   if (socket && socket.readyState === WebSocket.OPEN) {
-    socket.send(JSON.stringify({ type: 'ping' }));
+    socket.send(encodeFrame({ type: 'ping' }, socket.protocol));
   }
 }
 
@@ -35,11 +46,21 @@ function stopHeartbeat() {
 
 function handleWebSocketEvent(event) {
   try {
-    const data = JSON.parse(event.data);
+    const data = decodeFrame(event.data, event.target.protocol);
+    // Numbered events move our position; session.ready restates it (our own
+    // last_seq when missed events are being replayed right after it)
+    if (typeof data.seq === 'number') {
+      lastSeq = data.seq;
+    }
     
     switch (data.type) {
       case 'session.ready':
         reconnectAttempts = 0;
+        eventStream = data.stream;
+        if (data.resync) {
+          resyncAfterGap();
+        }
+        resendUnackedMessages();
         break;
       
       case 'message.new':
@@ -50,22 +71,50 @@ function handleWebSocketEvent(event) {
         handleMessageStatus(data);
         break;
       
-      case 'message.read.update':
-        handleMessageReadUpdate(data);
+      case 'chat.read.update':
+        handleChatReadUpdate(data);
         break;
       
       case 'chat.member.added':
         handleChatMemberAdded(data);
         break;
       
+      case 'typing.update':
+        if (data.user_id !== get(auth).userId) {
+          typing.setTyping(data.chat_id, data.user_id, data.typing, data.expires_in);
+        }
+        break;
+      
       case 'presence.update':
-        // Handle presence updates if needed
+        presence.applyUpdates(data.users || []);
+        break;
+      
+      case 'message.ack':
+        // Our message.send was stored (duplicate: a resend of one stored earlier);
+        // the message itself arrives as message.new
+        if (data.client_msg_id) {
+          unackedMessages.delete(data.client_msg_id);
+        }
+        break;
+      
+      case 'error':
+        if (data.code === 'rate_limited' && data.event === 'message.send') {
+          // Dropped by the server's rate limit; still unacked, so send again once allowed
+          setTimeout(resendUnackedMessages, data.retry_after * 1000);
+        } else {
+          console.warn('WebSocket error:', data.error);
+        }
         break;
       
       case 'pong':
         // Heartbeat response
         break;
       
+      case 'ping':
+        // The server checks quiet connections; unanswered ones are closed as idle
+        socket.send(encodeFrame({ type: 'pong' }, socket.protocol));
+        break;
+      
       default:
         console.warn('Unknown WebSocket event type:', data.type);
     }
@@ -111,6 +160,8 @@ async function handleNewMessage(data) {
   
   // Add message to store
   messages.addMessage(chat_id, message);
+  // A sent message ends the sender's typing indicator
+  typing.remove(chat_id, message.sender_id);
   
   // Check if chat exists in the chats list
   const currentChats = get(chats);
@@ -133,8 +184,7 @@ async function handleNewMessage(data) {
   // This ensures we receive future messages for this chat
   if (socket && socket.readyState === WebSocket.OPEN) {
     sendWebSocketMessage('chat.open', {
-      chat_id: chat_id,
-      user_id: authStore.userId
+      chat_id: chat_id
     });
   }
   
@@ -185,27 +235,22 @@ function handleMessageStatus(data) {
   messages.updateMessage(chat_id, message_id, { status });
 }
 
-function handleMessageReadUpdate(data) {
-  const { chat_id, message_id, read_by, read_count } = data;
+function handleChatReadUpdate(data) {
+  const { chat_id, user_id, up_to_message_id } = data;
   const authStore = get(auth);
   
-  const currentMessages = get(messages);
-  const message = currentMessages[chat_id]?.find(m => m.id === message_id);
-  
-  // Update message with read status
-  const newStatus = (() => {
-    if (message && message.sender_id === authStore.userId) {
-      // For own messages: "read" if read_count > 0, "sent" otherwise
-      return read_count > 0 ? 'read' : 'sent';
-    }
-    return message?.status; // Keep existing status for received messages
-  })();
+  messages.applyReadWatermark(chat_id, user_id, up_to_message_id, authStore.userId);
   
-  messages.updateMessage(chat_id, message_id, {
-    read_by: read_by || [],
-    read_count: read_count || 0,
-    status: newStatus
-  });
+  // Read on another of our devices: nothing left unread here either
+  if (user_id === authStore.userId) {
+    chats.update(chatsList => {
+      const chat = chatsList.find(c => c.id === chat_id);
+      if (chat) {
+        chat.unread_count = 0;
+      }
+      return [...chatsList];
+    });
+  }
 }
 
 async function handleChatMemberAdded(data) {
@@ -223,6 +268,19 @@ async function handleChatMemberAdded(data) {
   }
 }
 
+// Missed events could not be replayed: reload the chat list and the open chat
+async function resyncAfterGap() {
+  try {
+    chats.set(await api.getChats());
+    const chatId = get(activeChatId);
+    if (chatId) {
+      messages.setMessages(chatId, await api.getMessages(chatId));
+    }
+  } catch (err) {
+    console.error('Failed to resync after reconnect:', err);
+  }
+}
+
 function markMessagesAsRead(chatId, lastMessageId) {
   // Validate parameters - be strict about types
   if (chatId === null || chatId === undefined || chatId === '' || lastMessageId === null || lastMessageId === undefined || lastMessageId === '') {
@@ -236,7 +294,7 @@ function markMessagesAsRead(chatId, lastMessageId) {
       chat_id: chatId,
       message_id: lastMessageId
     };
-    socket.send(JSON.stringify(payload));
+    socket.send(encodeFrame(payload, socket.protocol));
   }
   
   // Update unread count
@@ -249,8 +307,24 @@ function markMessagesAsRead(chatId, lastMessageId) {
   });
 }
 
-export function connectWebSocket() {
-  const authStore = get(auth);
+// /api/ws URL of the node the user's sockets belong to (WS_ROUTING on the backend),
+// so all of a user's devices land on the same node. Without routing, or if the
+// lookup fails, any node will do: use the configured one.
+async function resolveWsUrl(userId) {
+  try {
+    const route = await api.getWsRoute(userId);
+    if (route.url) {
+      return `${route.url.replace(/^http/, 'ws')}/api/ws`;
+    }
+  } catch (err) {
+    console.warn('WebSocket route lookup failed, using the default node:', err);
+  }
+  // config.wsUrl already includes /api/ws
+  return config.wsUrl;
+}
+
+export async function connectWebSocket() {
+  let authStore = get(auth);
   
   if (!authStore.jwt || !authStore.sessionId) {
     console.error('Cannot connect WebSocket: missing JWT or session_id');
@@ -261,12 +335,32 @@ export function connectWebSocket() {
     console.log('WebSocket already connected');
     return;
   }
+  if (resolvingRoute) {
+    return;
+  }
 
-  // config.wsUrl already includes /api/ws
-  const wsUrl = `${config.wsUrl}?token=${encodeURIComponent(authStore.jwt)}&session_id=${encodeURIComponent(authStore.sessionId)}`;
+  resolvingRoute = true;
+  let baseUrl;
+  try {
+    baseUrl = await resolveWsUrl(authStore.userId);
+  } finally {
+    resolvingRoute = false;
+  }
+  // Logged out (or connected) while we were asking
+  authStore = get(auth);
+  if (!authStore.jwt || !authStore.sessionId || (socket && socket.readyState === WebSocket.OPEN)) {
+    return;
+  }
+
+  let wsUrl = `${baseUrl}?token=${encodeURIComponent(authStore.jwt)}&session_id=${encodeURIComponent(authStore.sessionId)}`;
+  if (eventStream && lastSeq !== null) {
+    wsUrl += `&stream=${encodeURIComponent(eventStream)}&last_seq=${lastSeq}`;
+  }
   
   try {
-    socket = new WebSocket(wsUrl);
+    // The server picks MessagePack if it supports it, JSON otherwise (socket.protocol)
+    socket = new WebSocket(wsUrl, config.wsMsgpack ? [SUBPROTOCOL_MSGPACK, SUBPROTOCOL_JSON] : [SUBPROTOCOL_JSON]);
+    socket.binaryType = 'arraybuffer';
     let connectionRejected = false;
     
     socket.onopen = () => {
@@ -333,7 +427,12 @@ export function connectWebSocket() {
       // This handles server restarts, network issues, etc.
       if (event.code !== 1000 && reconnectAttempts < maxReconnectAttempts) {
         reconnectAttempts++;
-        const delay = Math.min(1000 * Math.pow(2, reconnectAttempts), 30000);
+        let delay = Math.min(1000 * Math.pow(2, reconnectAttempts), 30000);
+        // 1013 = server at capacity; it says how long to wait (already jittered)
+        const retryHint = event.code === 1013 && /retry in ([\d.]+)s/.exec(event.reason || '');
+        if (retryHint) {
+          delay = Math.max(delay, parseFloat(retryHint[1]) * 1000);
+        }
         console.log(`WebSocket closed (code: ${event.code}). Reconnecting in ${delay}ms... (attempt ${reconnectAttempts}/${maxReconnectAttempts})`);
         setTimeout(() => {
           if (get(auth).isAuthenticated) {
@@ -358,19 +457,70 @@ export function disconnectWebSocket() {
     socket.close(1000, 'User logout');
     socket = null;
   }
+  presence.clear();
+  typing.clear();
+  unackedMessages.clear();
+  eventStream = null;
+  lastSeq = null;
   websocket.set({ connected: false, socket: null });
 }
 
 export function sendWebSocketMessage(type, data) {
   const ws = get(websocket);
   if (ws.socket && ws.socket.readyState === WebSocket.OPEN) {
-    ws.socket.send(JSON.stringify({ type, ...data }));
+    ws.socket.send(encodeFrame({ type, ...data }, ws.socket.protocol));
     return true;
   }
   console.warn('Cannot send WebSocket message: not connected');
   return false;
 }
 
+function newClientMsgId() {
+  if (typeof crypto !== 'undefined' && crypto.randomUUID) {
+    return crypto.randomUUID();
+  }
+  return `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 12)}`;
+}
+
+// Send a chat message; it keeps its client_msg_id until acked, so a resend after
+// a reconnect is recognised by the server instead of stored twice
+export function sendChatMessage(message) {
+  const payload = { ...message, client_msg_id: newClientMsgId() };
+  unackedMessages.set(payload.client_msg_id, payload);
+  return sendWebSocketMessage('message.send', payload);
+}
+
+function resendUnackedMessages() {
+  for (const payload of unackedMessages.values()) {
+    sendWebSocketMessage('message.send', payload);
+  }
+}
+
+// Tell the chat we're typing; the server expires it unless repeated, so resend
+// at most every 2 seconds while the user keeps typing
+let lastTypingSent = { chatId: null, at: 0 };
+
+export function sendTyping(chatId) {
+  const now = Date.now();
+  if (lastTypingSent.chatId === chatId && now - lastTypingSent.at < 2000) {
+    return;
+  }
+  if (sendWebSocketMessage('typing.start', { chat_id: chatId })) {
+    lastTypingSent = { chatId, at: now };
+  }
+}
+
+// notify=false only resets the throttle (e.g. after sending a message, which the
+// server already treats as the end of typing)
+export function stopTyping(chatId, notify = true) {
+  if (lastTypingSent.chatId === chatId) {
+    lastTypingSent = { chatId: null, at: 0 };
+    if (notify) {
+      sendWebSocketMessage('typing.stop', { chat_id: chatId });
+    }
+  }
+}
+
 export function markChatAsRead(chatId, lastMessageId) {
   markMessagesAsRead(chatId, lastMessageId);
 }
@@ -0,0 +1,83 @@
+// Frame encoding for /api/ws: JSON text, or MessagePack binary frames with short
+// field names when the server accepted the msgpack subprotocol (see backend/wire.py)
+import { encode, decode } from '@msgpack/msgpack';
+
+export const SUBPROTOCOL_MSGPACK = 'wazzap.msgpack.v1';
+export const SUBPROTOCOL_JSON = 'wazzap.json';
+
+// Full field name -> name on the MessagePack wire (keep in sync with backend/wire.py)
+const KEYS = {
+  type: 't',
+  seq: 'q',
+  chat_id: 'c',
+  message: 'm',
+  message_id: 'mi',
+  id: 'i',
+  sender_id: 's',
+  sender_username: 'su',
+  text: 'x',
+  media_url: 'mu',
+  content: 'ct',
+  created_at: 'ca',
+  timestamp: 'ts',
+  read_by: 'rb',
+  read_count: 'rc',
+  status: 'st',
+  user_id: 'u',
+  username: 'un',
+  users: 'us',
+  online: 'o',
+  last_active: 'la',
+  typing: 'ty',
+  expires_in: 'e',
+  up_to_message_id: 'ut',
+  client_msg_id: 'ci',
+  duplicate: 'd',
+  msg_type: 'mt',
+  error: 'er',
+  code: 'co',
+  retry_after: 'ra'
+};
+const NAMES = Object.fromEntries(Object.entries(KEYS).map(([name, short]) => [short, name]));
+
+function renameKeys(value, table) {
+  if (Array.isArray(value)) {
+    return value.map(item => renameKeys(item, table));
+  }
+  if (value && typeof value === 'object' && !(value instanceof Uint8Array)) {
+    const renamed = {};
+    for (const [key, item] of Object.entries(value)) {
+      renamed[table[key] || key] = renameKeys(item, table);
+    }
+    return renamed;
+  }
+  return value;
+}
+
+// The server leaves out the fields a chat message only repeats
+function restoreMessage(message) {
+  if (message.content === undefined) {
+    message.content = message.type === 'media' ? message.media_url : message.text;
+  }
+  if (message.timestamp === undefined) {
+    message.timestamp = message.created_at;
+  }
+}
+
+export function decodeFrame(data, protocol) {
+  if (protocol !== SUBPROTOCOL_MSGPACK) {
+    return JSON.parse(data);
+  }
+  const frame = renameKeys(decode(new Uint8Array(data)), NAMES);
+  if (frame.message && typeof frame.message === 'object') {
+    restoreMessage(frame.message);
+  }
+  return frame;
+}
+
+export function encodeFrame(frame, protocol) {
+  if (protocol !== SUBPROTOCOL_MSGPACK) {
+    return JSON.stringify(frame);
+  }
+  return encode(renameKeys(frame, KEYS));
+}
@@ -12,6 +12,13 @@ function createMessagesStore() {
       messagesByChat[chatId] = messageList;
       set(messagesByChat);
     },
+    // An older page of history goes in front of what is loaded
+    prependMessages: (chatId, messageList) => {
+      const list = messagesByChat[chatId] || [];
+      const known = new Set(list.map(m => m.id));
+      messagesByChat[chatId] = [...messageList.filter(m => !known.has(m.id)), ...list];
+      set(messagesByChat);
+    },
     addMessage: (chatId, message) => {
       if (!messagesByChat[chatId]) {
         messagesByChat[chatId] = [];
@@ -28,6 +35,29 @@ function createMessagesStore() {
         }
       }
     },
+    // A member has read the chat up to upToMessageId: add them to read_by of every
+    // message up to it that they didn't send, in one store update for the whole range
+    applyReadWatermark: (chatId, userId, upToMessageId, currentUserId) => {
+      const list = messagesByChat[chatId];
+      if (!list) {
+        return;
+      }
+      let changed = false;
+      messagesByChat[chatId] = list.map(m => {
+        const readBy = m.read_by || [];
+        if (!m.id || m.id > upToMessageId || m.sender_id === userId || readBy.includes(userId)) {
+          return m;
+        }
+        changed = true;
+        const read_by = [...readBy, userId];
+        // Own messages become "read" once anyone reads them; received ones once we do
+        const status = (m.sender_id === currentUserId || userId === currentUserId) ? 'read' : m.status;
+        return { ...m, read_by, read_count: read_by.length, status };
+      });
+      if (changed) {
+        set(messagesByChat);
+      }
+    },
     clear: () => {
       Object.keys(messagesByChat).forEach(key => delete messagesByChat[key]);
       set(messagesByChat);
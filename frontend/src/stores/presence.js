@@ -0,0 +1,22 @@
+import { writable } from 'svelte/store';
+
+// Online state of chat peers by user ID: { online, last_active }
+// Filled from presence.update WebSocket events
+function createPresenceStore() {
+  const { subscribe, set, update } = writable({});
+
+  return {
+    subscribe,
+    applyUpdates: (users) => {
+      update(byUser => {
+        for (const user of users) {
+          byUser[user.user_id] = { online: user.online, last_active: user.last_active };
+        }
+        return { ...byUser };
+      });
+    },
+    clear: () => set({})
+  };
+}
+
+export const presence = createPresenceStore();
@@ -0,0 +1,47 @@
+import { writable } from 'svelte/store';
+
+// Users currently typing, by chat ID: { [chatId]: [userId, ...] }
+// Filled from typing.update WebSocket events; entries also expire locally
+// in case the typing.stop never arrives
+const timers = {};
+
+function createTypingStore() {
+  const { subscribe, set, update } = writable({});
+
+  function remove(chatId, userId) {
+    const key = `${chatId}:${userId}`;
+    clearTimeout(timers[key]);
+    delete timers[key];
+    update(byChat => {
+      const users = (byChat[chatId] || []).filter(id => id !== userId);
+      return { ...byChat, [chatId]: users };
+    });
+  }
+
+  return {
+    subscribe,
+    setTyping: (chatId, userId, typing, expiresIn) => {
+      if (!typing) {
+        remove(chatId, userId);
+        return;
+      }
+      const key = `${chatId}:${userId}`;
+      clearTimeout(timers[key]);
+      timers[key] = setTimeout(() => remove(chatId, userId), (expiresIn || 6) * 1000);
+      update(byChat => {
+        const users = byChat[chatId] || [];
+        return users.includes(userId) ? byChat : { ...byChat, [chatId]: [...users, userId] };
+      });
+    },
+    remove,
+    clear: () => {
+      Object.keys(timers).forEach(key => {
+        clearTimeout(timers[key]);
+        delete timers[key];
+      });
+      set({});
+    }
+  };
+}
+
+export const typing = createTypingStore();
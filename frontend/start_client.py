@@ -43,6 +43,17 @@ def check_npm_available():
     except FileNotFoundError:
         return False
 
+def dependencies_outdated(cwd):
+    """True if package.json or package-lock.json changed since the last npm install."""
+    installed_marker = Path(cwd) / "node_modules" / ".package-lock.json"
+    if not installed_marker.exists():
+        return True
+    installed_at = installed_marker.stat().st_mtime
+    return any(
+        (Path(cwd) / name).exists() and (Path(cwd) / name).stat().st_mtime > installed_at
+        for name in ("package.json", "package-lock.json")
+    )
+
 def main():
     """Start the Vite development server."""
     # #region agent log
@@ -82,7 +93,8 @@ def main():
     # #endregion
     
     # Check if dependencies need to be installed
-    if not node_modules_path.exists() or not vite_bin_path.exists():
+    # (also after a pull that added or bumped a dependency)
+    if not node_modules_path.exists() or not vite_bin_path.exists() or dependencies_outdated(cwd):
         # #region agent log
         log_debug("start_client.py:main", "Dependencies missing, installing", {"node_modules_exists": node_modules_path.exists(), "vite_exists": vite_bin_path.exists()}, "A")
         # #endregion
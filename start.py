@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 """Start both the backend and frontend servers."""
+import os
 import subprocess
 import sys
 import platform
@@ -347,8 +348,13 @@ def main():
                     print(f"Backend exited with code {exit_code}. Restarting...")
             
             print("Starting backend server...")
+            # WS_PER_MESSAGE_DEFLATE=false turns WebSocket compression off (e.g. when clients
+            # use the already compact MessagePack subprotocol and CPU matters more than bytes).
+            # It is only an on/off switch: uvicorn's CLI has no window size, compression level
+            # or context takeover settings, so deflate runs with the websockets defaults.
             backend = subprocess.Popen([str(venv_python), "-m", "uvicorn", "start_backend:app", 
-                                        "--reload", "--host", "0.0.0.0", "--port", "8000"],
+                                        "--reload", "--host", "0.0.0.0", "--port", "8000",
+                                        "--ws-per-message-deflate", os.getenv("WS_PER_MESSAGE_DEFLATE", "true")],
                                        cwd=backend_dir, shell=is_windows)
             time.sleep(2)
         
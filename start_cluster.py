@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Start several backend nodes locally with chat-affinity routing (multi-node test setup).
+
+Usage: python3 start_cluster.py [nodes] [first_port]
+
+Every node gets its own port and node id (node-1, node-2, ...), shares the
+database from .env, and talks to the others over a SQLite backplane file.
+Ask any node GET /api/ws/route?user_id=<id> which node a user should use.
+"""
+import os
+import platform
+import signal
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+
+def main():
+    root = Path(__file__).parent
+    backend_dir = root / "backend"
+    nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    first_port = int(sys.argv[2]) if len(sys.argv) > 2 else 8001
+    is_windows = platform.system() == "Windows"
+
+    node_urls = {f"node-{i + 1}": f"http://127.0.0.1:{first_port + i}" for i in range(nodes)}
+    shared_env = {
+        **os.environ,
+        "WS_ROUTING": "true",
+        "WS_NODES": ",".join(f"{node}={url}" for node, url in node_urls.items()),
+        "WS_BACKPLANE_URL": os.getenv("WS_BACKPLANE_URL", f"sqlite:///{backend_dir / 'cluster_backplane.db'}"),
+    }
+
+    processes = []
+    for port, node in enumerate(node_urls, start=first_port):
+        print(f"Starting {node} on port {port}...")
+        processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "start_backend:app", "--host", "127.0.0.1", "--port", str(port),
+             # On/off only, with the websockets defaults (see start.py)
+             "--ws-per-message-deflate", os.getenv("WS_PER_MESSAGE_DEFLATE", "true")],
+            cwd=backend_dir, env={**shared_env, "WS_NODE_ID": node}, shell=is_windows
+        ))
+        # Let the first node create the tables before the others start
+        time.sleep(1 if processes[1:] else 2)
+
+    def cleanup(sig=None, frame=None):
+        print("\nShutting down nodes...")
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+        sys.exit(0)
+
+    signal.signal(signal.SIGINT, cleanup)
+    if not is_windows:
+        signal.signal(signal.SIGTERM, cleanup)
+
+    while True:
+        time.sleep(1)
+        if any(process.poll() is not None for process in processes):
+            print("A node exited. Shutting down the cluster...")
+            cleanup()
+
+
+if __name__ == "__main__":
+    main()